@@ -2,49 +2,134 @@
 Functions to get GPS TS into downsampled format
 """
 
+import numpy as np
 import datetime as dt
+import concurrent.futures
 import matplotlib.pyplot as plt
 import GNSS_TimeSeries_Viewers.gps_tools as gps_tools
 
 
-def get_displacements_show_ts(stations, starttime, endtime, gps_sigma, prep_dir):
-    """Get the values of TS at starttime and endtime"""
-    startlim = starttime - dt.timedelta(days=1065);
-    endlim = endtime + dt.timedelta(days=1065);
-    gps_displacements_object = [];
+def get_displacements_show_ts(stations, starttime, endtime, gps_sigma, prep_dir, plot=True, num_workers=1):
+    """Get the values of TS at starttime and endtime.
+    Plotting is optional, and can be spread over several processes."""
+    gps_displacements_object, start_pos, end_pos = get_displacements(stations, starttime, endtime, gps_sigma);
+    if plot:
+        plot_displacements_ts(stations, starttime, endtime, start_pos, end_pos, prep_dir, num_workers);
+    return gps_displacements_object;
+
 
-    for station in stations:
-        [start_pos, end_pos] = subsample_ts_start_end(station, starttime, endtime);
-        E0, N0, U0 = start_pos[0], start_pos[1], start_pos[2];
-        E1, N1, U1 = end_pos[0], end_pos[1], end_pos[2];
+def get_displacements(stations, starttime, endtime, gps_sigma, window_days=30):
+    """
+    Get the displacement of every station between starttime and endtime, without any plotting.
+    All stations are extracted together from a padded array.
+
+    :param stations: list of GNSS Timeseries objects
+    :param starttime: datetime
+    :param endtime: datetime
+    :param gps_sigma: float, uncertainty assigned to horizontal displacements (vertical gets 3x)
+    :param window_days: int, half-width of the averaging window around each time
+    :returns: list of 2-epoch Timeseries objects, start positions (stations x 3), end positions (stations x 3)
+    """
+    if len(stations) == 0:
+        return [], np.zeros((0, 3)), np.zeros((0, 3));
+    times, disps = stations_to_padded_array(stations);
+    positions = windowed_means_at_times(times, disps, [starttime, endtime], window_days);
+    start_pos, end_pos = positions[:, 0, :], positions[:, 1, :];
+    gps_displacements_object = [];
+    for station, (E0, N0, U0), (E1, N1, U1) in zip(stations, start_pos, end_pos):
         one_object = gps_tools.gps_io_functions.Timeseries(name=station.name, coords=station.coords,
                                                            dtarray=[starttime, endtime], dN=[0, N1 - N0],
                                                            dE=[0, E1 - E0], dU=[0, U1 - U0], Sn=[gps_sigma, gps_sigma],
                                                            Se=[gps_sigma, gps_sigma], Su=[3 * gps_sigma, 3 * gps_sigma],
                                                            EQtimes=station.EQtimes);
         gps_displacements_object.append(one_object);
+    return gps_displacements_object, start_pos, end_pos;
 
-        f, axarr = plt.subplots(3, 1, figsize=(12, 8), dpi=300);
-        axarr[0].plot(station.dtarray, station.dE, '.');
-        axarr[0].set_xlim([startlim, endlim]);
-        axarr[0].plot(starttime, E0, '.', color='red', markersize=15);
-        axarr[0].plot(endtime, E1, '.', color='red', markersize=15);
-        axarr[0].plot([starttime, endtime], [E0, E1], color='red');
-        axarr[0].set_ylabel('East (mm)')
-        axarr[1].plot(station.dtarray, station.dN, '.');
-        axarr[1].set_xlim([startlim, endlim]);
-        axarr[1].plot(starttime, N0, '.', color='red', markersize=15);
-        axarr[1].plot(endtime, N1, '.', color='red', markersize=15);
-        axarr[1].set_ylabel('North (mm)');
-        axarr[2].plot(station.dtarray, station.dU, '.');
-        axarr[2].set_xlim([startlim, endlim]);
-        axarr[2].plot(starttime, U0, '.', color='red', markersize=15);
-        axarr[2].plot(endtime, U1, '.', color='red', markersize=15);
-        axarr[2].set_ylabel('Up (mm)');
-        plt.savefig(prep_dir + "gps_" + station.name + "_ts.png");
-        plt.close();
 
-    return gps_displacements_object;
+def datetimes_to_days(dtarray):
+    """Convert a list of datetimes into float days since 1970-01-01"""
+    seconds = np.array(dtarray, dtype='datetime64[s]').astype(np.int64);
+    return seconds / 86400.0;
+
+
+def stations_to_padded_array(stations):
+    """
+    Convert a list of GNSS Timeseries objects into padded arrays.
+    :returns: times (stations x epochs) in days, and disps (stations x epochs x 3) in ENU, padded with nan
+    """
+    max_epochs = max(len(station.dtarray) for station in stations);
+    times = np.full((len(stations), max_epochs), np.nan);
+    disps = np.full((len(stations), max_epochs, 3), np.nan);
+    for k, station in enumerate(stations):
+        num_epochs = len(station.dtarray);
+        times[k, 0:num_epochs] = datetimes_to_days(station.dtarray);
+        disps[k, 0:num_epochs, :] = np.column_stack((station.dE, station.dN, station.dU));
+    return times, disps;
+
+
+def windowed_means_at_times(times, disps, target_times, window_days=30, min_points=3):
+    """
+    Mean position of every station near several target times, in one pass over the padded arrays.
+    Like gps_ts_functions.subsample_in_time: uses points less than window_days (whole days) from the target,
+    and returns nan where fewer than min_points epochs fall within the window.
+
+    :param times: (stations x epochs) array in days, padded with nan
+    :param disps: (stations x epochs x 3) array, padded with nan
+    :param target_times: list of datetimes
+    :returns: (stations x targets x 3) array of mean positions
+    """
+    targets = datetimes_to_days(target_times);
+    with np.errstate(invalid='ignore'):
+        day_offsets = np.floor(times[:, :, np.newaxis] - targets[np.newaxis, np.newaxis, :]);  # like timedelta.days
+        in_window = np.abs(day_offsets) < window_days;   # (stations x epochs x targets)
+    num_in_window = np.sum(in_window, axis=1);  # (stations x targets)
+    values = np.where(in_window[:, :, :, np.newaxis], disps[:, :, np.newaxis, :], np.nan);
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.nansum(values, axis=1) / np.sum(~np.isnan(values), axis=1);
+    means[num_in_window < min_points] = np.nan;
+    return means;
+
+
+def plot_displacements_ts(stations, starttime, endtime, start_pos, end_pos, prep_dir, num_workers=1):
+    """Plot the time series and extracted displacements of all stations, optionally in parallel processes."""
+    jobs = [(station, starttime, endtime, start, end, prep_dir)
+            for station, start, end in zip(stations, start_pos, end_pos)];
+    if num_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(plot_one_station_ts, jobs));
+    else:
+        for job in jobs:
+            plot_one_station_ts(job);
+    return;
+
+
+def plot_one_station_ts(job):
+    """Three-component plot of one station. job: (station, starttime, endtime, start_pos, end_pos, prep_dir)"""
+    station, starttime, endtime, start_pos, end_pos, prep_dir = job;
+    startlim = starttime - dt.timedelta(days=1065);
+    endlim = endtime + dt.timedelta(days=1065);
+    E0, N0, U0 = start_pos[0], start_pos[1], start_pos[2];
+    E1, N1, U1 = end_pos[0], end_pos[1], end_pos[2];
+    f, axarr = plt.subplots(3, 1, figsize=(12, 8), dpi=300);
+    axarr[0].plot(station.dtarray, station.dE, '.');
+    axarr[0].set_xlim([startlim, endlim]);
+    axarr[0].plot(starttime, E0, '.', color='red', markersize=15);
+    axarr[0].plot(endtime, E1, '.', color='red', markersize=15);
+    axarr[0].plot([starttime, endtime], [E0, E1], color='red');
+    axarr[0].set_ylabel('East (mm)')
+    axarr[1].plot(station.dtarray, station.dN, '.');
+    axarr[1].set_xlim([startlim, endlim]);
+    axarr[1].plot(starttime, N0, '.', color='red', markersize=15);
+    axarr[1].plot(endtime, N1, '.', color='red', markersize=15);
+    axarr[1].set_ylabel('North (mm)');
+    axarr[2].plot(station.dtarray, station.dU, '.');
+    axarr[2].set_xlim([startlim, endlim]);
+    axarr[2].plot(starttime, U0, '.', color='red', markersize=15);
+    axarr[2].plot(endtime, U1, '.', color='red', markersize=15);
+    axarr[2].set_ylabel('Up (mm)');
+    plt.savefig(prep_dir + "gps_" + station.name + "_ts.png");
+    plt.close();
+    return;
 
 
 def subsample_ts_start_end(station, starttime, endtime, window_days=30):
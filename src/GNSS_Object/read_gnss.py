@@ -10,71 +10,173 @@ Reference: Timeseries = collections.namedtuple("Timeseries",
 
 import GNSS_TimeSeries_Viewers.gps_tools as gpstools
 import datetime as dt
+import concurrent.futures
+from .. import cache_utilities
 
 
-def read_station_ts_NBGF(gps_bbox, gps_reference, remove_coseismic=0, network='pbo', blacklist=()):
+# CLEANING STEPS: each takes a Timeseries object, a context dictionary for the station, and keyword parameters.
+# The context holds the station's offsets, earthquakes, data config file, and anything a step saves for a later step.
+def step_impose_time_limits(ts_obj, _context, starttime, endtime):
+    return gpstools.gps_ts_functions.impose_time_limits(ts_obj, dt.datetime.strptime(starttime, "%Y%m%d"),
+                                                        dt.datetime.strptime(endtime, "%Y%m%d"));
+
+
+def step_remove_offsets(ts_obj, context):
+    return gpstools.offsets.remove_offsets(ts_obj, context["offsets"]);  # remove antenna offsets
+
+
+def step_remove_seasonals(ts_obj, context, seasonals_remove=1, seasonals_type="nldas", remove_trend=0):
+    return gpstools.gps_seasonal_removals.make_detrended_ts(ts_obj, seasonals_remove=seasonals_remove,
+                                                            seasonals_type=seasonals_type,
+                                                            data_config_file=context["gps_data_config_file"],
+                                                            remove_trend=remove_trend);
+
+
+def step_remove_coseismic(ts_obj, context):
+    print("Removing coseismic offsets");
+    return gpstools.offsets.remove_offsets(ts_obj, context["eqs"]);
+
+
+def step_remove_outliers(ts_obj, _context, outliers_def=20):
+    return gpstools.gps_ts_functions.remove_outliers(ts_obj, outliers_def);  # 20mm outlier definition
+
+
+def step_fit_slope(ts_obj, context, endtime="20100401", missing_fraction=0.2):
+    """Fit a velocity (saved for step_detrend_by_fitted_slope) without changing the time series"""
+    [east_slope, north_slope, vert_slope, _, _, _] = gpstools.gps_ts_functions.get_slope(
+        ts_obj, endtime=dt.datetime.strptime(endtime, "%Y%m%d"), missing_fraction=missing_fraction);
+    context["slopes"] = [east_slope, north_slope, vert_slope];
+    return ts_obj;
+
+
+def step_remove_hines(ts_obj, context, starttime1, endtime1, starttime2, endtime2):
+    """Remove postseismic transient by Hines model"""
+    model_obj = gpstools.gps_postseismic_remove.get_station_hines(ts_obj.name, context["gps_data_config_file"]);
+    return gpstools.gps_postseismic_remove.remove_by_model(ts_obj, model_obj,
+                                                           dt.datetime.strptime(starttime1, "%Y%m%d"),
+                                                           dt.datetime.strptime(endtime1, "%Y%m%d"),
+                                                           dt.datetime.strptime(starttime2, "%Y%m%d"),
+                                                           dt.datetime.strptime(endtime2, "%Y%m%d"));
+
+
+def step_detrend_by_fitted_slope(ts_obj, context):
+    east_params = [context["slopes"][0], 0, 0, 0, 0];
+    north_params = [context["slopes"][1], 0, 0, 0, 0];
+    vert_params = [context["slopes"][2], 0, 0, 0, 0];
+    return gpstools.gps_ts_functions.detrend_data_by_value(ts_obj, east_params, north_params, vert_params);
+
+
+CLEANING_STEPS = {"impose_time_limits": step_impose_time_limits,
+                  "remove_offsets": step_remove_offsets,
+                  "remove_seasonals": step_remove_seasonals,
+                  "remove_coseismic": step_remove_coseismic,
+                  "remove_outliers": step_remove_outliers,
+                  "fit_slope": step_fit_slope,
+                  "remove_hines": step_remove_hines,
+                  "detrend_by_fitted_slope": step_detrend_by_fitted_slope};
+
+
+def clean_one_station(job):
+    """
+    Read and clean one station, using the on-disk cache if this raw data has been cleaned the same way before.
+    The raw files are always read (their contents are part of the cache key); a cache hit skips only the cleaning.
+    :param job: (station name, network, refframe, gps_data_config_file, cleaning steps, cache_dir)
+    cleaning steps: list of (step name, dictionary of parameters), applied in order
+    :returns: cleaned Timeseries object
+    """
+    name, network, refframe, gps_data_config_file, cleaning_steps, cache_dir = job;
+    [myData, offset_obj, eq_obj] = gpstools.gps_input_pipeline.get_station_data(name, network, gps_data_config_file,
+                                                                                refframe=refframe);
+    key = cache_utilities.hash_of_parameters({"raw": cache_utilities.hash_of_object((myData, offset_obj, eq_obj)),
+                                              "steps": cleaning_steps});
+    if cache_dir is not None:
+        found, cleaned = cache_utilities.read_cached_object(cache_dir, name, key);
+        if found:
+            return cleaned;
+    context = {"offsets": offset_obj, "eqs": eq_obj, "gps_data_config_file": gps_data_config_file};
+    cleaned = myData;
+    for step_name, params in cleaning_steps:
+        cleaned = CLEANING_STEPS[step_name](cleaned, context, **params);
+    if cache_dir is not None:
+        cache_utilities.write_cached_object(cache_dir, name, key, cleaned);
+    return cleaned;
+
+
+def read_and_clean_stations(station_names, gps_data_config_file, cleaning_steps, network='pbo', refframe="NA",
+                            station_networks=None, station_steps=None, cache_dir=None, num_workers=1):
+    """
+    Read and clean a list of GNSS stations in parallel, caching each cleaned station on disk.
+    The cache key covers the station's raw data, offsets, earthquakes, and the cleaning steps with their parameters.
+    Raw data are re-read on every call to compute that key, so the cache saves only the cleaning steps.
+
+    :param station_names: list of strings
+    :param gps_data_config_file: string, config file of the GNSS data
+    :param cleaning_steps: list of (step name, parameter dictionary), step names from CLEANING_STEPS
+    :param network: string, default network of the stations
+    :param refframe: string
+    :param station_networks: optional dictionary of {station name: network} for exceptions to network
+    :param station_steps: optional dictionary of {station name: cleaning steps} for exceptions to cleaning_steps
+    :param cache_dir: string, directory of cached cleaned stations, or None for no caching
+    :param num_workers: int, number of processes
+    :returns: list of cleaned Timeseries objects, in the order of station_names
+    """
+    station_networks = {} if station_networks is None else station_networks;
+    station_steps = {} if station_steps is None else station_steps;
+    jobs = [(name, station_networks.get(name, network), refframe, gps_data_config_file,
+             station_steps.get(name, cleaning_steps), cache_dir) for name in station_names];
+    if num_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            cleaned_objects = list(executor.map(clean_one_station, jobs));
+    else:
+        cleaned_objects = [clean_one_station(job) for job in jobs];
+    return cleaned_objects;
+
+
+def get_NBGF_cleaning_steps(remove_coseismic=0):
+    """
+    The cleaning steps for North Brawley Geothermal Field.
+    The Methods section of the paper can basically be read straight from this list.
+    """
+    steps = [("remove_offsets", {}),
+             ("remove_seasonals", {"seasonals_remove": 1, "seasonals_type": "nldas", "remove_trend": 0})];
+    if remove_coseismic:
+        steps.append(("remove_coseismic", {}));
+    steps.append(("remove_outliers", {"outliers_def": 20}));  # 20mm outlier definition
+    # Here we detrend using pre-2010 velocities,
+    # assuming tectonic strain accumulation won't contribute to geothermal field deformation.
+    steps.append(("fit_slope", {"endtime": "20100401", "missing_fraction": 0.2}));
+    # Remove postseismic transient by Hines model (parameters for removal of EMC postseismic transient)
+    steps.append(("remove_hines", {"starttime1": "20100403", "endtime1": "20100405",
+                                   "starttime2": "20200328", "endtime2": "20200330"}));
+    steps.append(("detrend_by_fitted_slope", {}));
+    return steps;
+
+
+def read_station_ts_NBGF(gps_bbox, gps_reference, remove_coseismic=0, network='pbo', blacklist=(), *,
+                         gps_data_config_file, cache_dir=None, num_workers=1):
     """
     Read a set of GNSS stations. Specific to North Brawley Geothermal Field.
     Good to have around as an example.
-    The Methods section of the paper can basically be read straight from this function.
+    The Methods section of the paper can basically be read straight from get_NBGF_cleaning_steps.
+    gps_data_config_file, cache_dir, and num_workers are keyword-only, so older positional calls still bind correctly.
     """
-    gps_data_config_file = "/Users/kmaterna/Documents/B_Research/GEOPHYS_DATA/GPS_POS_DATA/config.txt"  # sys path
-    starttime1 = dt.datetime.strptime("20100403", "%Y%m%d");
-    endtime1 = dt.datetime.strptime("20100405", "%Y%m%d");
-    starttime2 = dt.datetime.strptime("20200328", "%Y%m%d");
-    endtime2 = dt.datetime.strptime("20200330", "%Y%m%d");  # parameters for removal of EMC postseismic transient
     station_names, _, _ = gpstools.stations_within_radius.get_stations_within_box(gps_data_config_file,
                                                                                   coord_box=gps_bbox, network=network);
+    station_names = [x for x in station_names if x not in blacklist];
     print(station_names);
-    [dataobj_list, offsetobj_list, eqobj_list, _] = \
-        gpstools.gps_input_pipeline.multi_station_inputs(station_names, blacklist, network, "NA",
-                                                         gps_data_config_file);
-    # Next 5 lines: Importing BRAW from UNR
-    [myData, offset_obj, eq_obj] = gpstools.gps_input_pipeline.get_station_data("BRAW", "unr", gps_data_config_file,
-                                                                                refframe="NA")
-    myData = gpstools.gps_ts_functions.impose_time_limits(myData, dt.datetime.strptime("20080505", "%Y%m%d"),
-                                                          dt.datetime.strptime("20200101", "%Y%m%d"));
-    dataobj_list.append(myData);
-    offsetobj_list.append(offset_obj);
-    eqobj_list.append(eq_obj);
-
-    # Now we are doing a bit of adjustments, for seasonal corrections and base station.
-    cleaned_objects = [];
-    for i in range(len(dataobj_list)):
-        one_object = dataobj_list[i];
-        newobj = gpstools.offsets.remove_offsets(one_object, offsetobj_list[i]);  # remove antenna offsets
-
-        if newobj.name == 'BRAW':
-            newobj = gpstools.gps_seasonal_removals.make_detrended_ts(newobj, seasonals_remove=0, seasonals_type="lssq",
-                                                                      data_config_file=gps_data_config_file,
-                                                                      remove_trend=0);
-        else:
-            newobj = gpstools.gps_seasonal_removals.make_detrended_ts(newobj, seasonals_remove=1,
-                                                                      seasonals_type="nldas",
-                                                                      data_config_file=gps_data_config_file,
-                                                                      remove_trend=0);
-
-        if remove_coseismic:
-            print("Removing coseismic offsets");
-            newobj = gpstools.offsets.remove_offsets(newobj, eqobj_list[i]);
-
-        newobj = gpstools.gps_ts_functions.remove_outliers(newobj, 20);  # 20mm outlier definition
-
-        # Here we detrend using pre-2010 velocities,
-        # assuming tectonic strain accumulation won't contribute to geothermal field deformation.
-        endtime = dt.datetime.strptime("2010-04-01", "%Y-%m-%d");
-        [east_slope, north_slope, vert_slope, _, _, _] = gpstools.gps_ts_functions.get_slope(newobj, endtime=endtime,
-                                                                                             missing_fraction=0.2);
-        east_params = [east_slope, 0, 0, 0, 0];
-        north_params = [north_slope, 0, 0, 0, 0];
-        vert_params = [vert_slope, 0, 0, 0, 0];
-        # Remove postseismic transient by Hines model
-        model_obj = gpstools.gps_postseismic_remove.get_station_hines(newobj.name, gps_data_config_file);
-        newobj = gpstools.gps_postseismic_remove.remove_by_model(newobj, model_obj, starttime1, endtime1, starttime2,
-                                                                 endtime2);
-        # Remove coseismic offset if within window
-        newobj = gpstools.gps_ts_functions.detrend_data_by_value(newobj, east_params, north_params, vert_params);
-        cleaned_objects.append(newobj)
+    cleaning_steps = get_NBGF_cleaning_steps(remove_coseismic);
+
+    # Importing BRAW from UNR, with time limits and no seasonal removal
+    braw_steps = [("impose_time_limits", {"starttime": "20080505", "endtime": "20200101"})];
+    for step_name, params in cleaning_steps:
+        if step_name == "remove_seasonals":
+            params = {"seasonals_remove": 0, "seasonals_type": "lssq", "remove_trend": 0};
+        braw_steps.append((step_name, params));
+
+    cleaned_objects = read_and_clean_stations(station_names + ["BRAW"], gps_data_config_file, cleaning_steps,
+                                              network=network, refframe="NA", station_networks={"BRAW": "unr"},
+                                              station_steps={"BRAW": braw_steps}, cache_dir=cache_dir,
+                                              num_workers=num_workers);
 
     # Subtracting the reference GPS station, if desired.
     if gps_reference == "NO_REF":
@@ -7,6 +7,40 @@ June 2020
 import numpy as np
 
 
+def read_model_predictions(model_disps):
+    """
+    Modeled east, north, and up displacements at each point, summed over one or more coseismic models.
+
+    :param model_disps: a filename (lon, lat, e, n, u in m, one header line), an (n x 3) array of e/n/u in m,
+        or a list of these, one for each model
+    :returns: (n x 3) array of e, n, u in m
+    """
+    if isinstance(model_disps, (str, np.ndarray)):
+        model_disps = [model_disps];
+    total = 0;
+    for model in model_disps:
+        if isinstance(model, str):
+            model = np.loadtxt(model, skiprows=1, usecols=(2, 3, 4), ndmin=2);
+        total = total + np.asarray(model, dtype=float);
+    return total;
+
+
+def get_los_model_corrections(pred_enu, lkv_E, lkv_N, lkv_U, ref_idx=-1):
+    """
+    What is the modeled delta-e, delta-n, and delta-u of each point relative to the reference point?
+    Then, how does that project into the local LOS?  All points at once.
+
+    :param pred_enu: (n x 3) array of modeled displacements
+    :param lkv_E: array of n look vector components, ground to satellite
+    :param lkv_N: array of n look vector components
+    :param lkv_U: array of n look vector components
+    :param ref_idx: int, row of the reference point
+    :returns: array of n LOS corrections, same units as pred_enu
+    """
+    lkv = np.column_stack((lkv_E, lkv_N, lkv_U));
+    return np.sum((pred_enu - pred_enu[ref_idx]) * lkv, axis=1);
+
+
 def remove_model_los(los_file, model_disps_file, adjusted_file):
     """
     Pseudocode:
@@ -16,49 +50,61 @@ def remove_model_los(los_file, model_disps_file, adjusted_file):
     Then we write everything except the reference line
     Into a file with "_updated" in its name
     Assumes the reference pixel is the last row of the data file.
+    model_disps_file can be a list of files, to remove several coseismic models in one pass.
     """
-    [_, _, u_pred, v_pred, w_pred] = np.loadtxt(model_disps_file, unpack=True, skiprows=1);
-    [lon_meas, lat_meas, disp, sig, unit_e, unit_n, unit_u] = np.loadtxt(los_file, unpack=True, skiprows=1);
-    corrected_los = [];
-    los_reference_pixel = [u_pred[-1], v_pred[-1], w_pred[-1]];  # last model is reference
-    for i in range(len(lon_meas)):
-        model_prediction = [u_pred[i], v_pred[i], w_pred[i]];
-        model_deltas = np.subtract(model_prediction, los_reference_pixel);
-
-        los_unitv = [unit_e[i], unit_n[i], unit_u[i]];
-        los_view = np.dot(model_deltas, los_unitv);
-
-        corrected_los.append(disp[i] - los_view);
-
-    ofile = open(adjusted_file, 'w');
-    ofile.write("# Header: lon, lat, disp(m), sig(m), unitE, unitN, unitU from ground to satellite\n");
-    for i in range(len(lon_meas)):
-        ofile.write("%f %f %f %f %f %f %f \n" % (
-            lon_meas[i], lat_meas[i], corrected_los[i], sig[i], unit_e[i], unit_n[i], unit_u[i]));
-    ofile.close();
+    pred_enu = read_model_predictions(model_disps_file);
+    data = np.loadtxt(los_file, skiprows=1, ndmin=2);  # lon, lat, disp, sig, unit_e, unit_n, unit_u
+    data[:, 2] = data[:, 2] - get_los_model_corrections(pred_enu, data[:, 4], data[:, 5], data[:, 6], ref_idx=-1);
+    np.savetxt(adjusted_file, data, fmt='%f',
+               header="Header: lon, lat, disp(m), sig(m), unitE, unitN, unitU from ground to satellite", comments='# ');
     return;
 
 
+def remove_model_los_object(InSAR_obj, model_disps, ref_idx=-1):
+    """
+    Remove one or more coseismic models from an in-memory InSAR_1D_Object (LOS in mm; models in m).
+
+    :param InSAR_obj: InSAR_1D_Object
+    :param model_disps: anything accepted by read_model_predictions, matching the pixels of InSAR_obj
+    :param ref_idx: int, index of the reference pixel. Default is the last pixel.
+    :returns: InSAR_1D_Object
+    """
+    pred_enu = read_model_predictions(model_disps) * 1000;  # m to mm
+    corrections = get_los_model_corrections(pred_enu, InSAR_obj.lkv_E, InSAR_obj.lkv_N, InSAR_obj.lkv_U, ref_idx);
+    return InSAR_obj._replace(LOS=np.subtract(InSAR_obj.LOS, corrections));
+
+
 def remove_model_gps(gps_file, model_disps_file):
     """
     Take the prediction at each station,
     subtract the reference prediction
     and then adjust by that amount.
     Assumes the reference pixel is the first row of the data file.
+    model_disps_file can be a list of files, to remove several coseismic models in one pass.
     """
-    [_, _, u_pred, v_pred, w_pred] = np.loadtxt(model_disps_file, unpack=True, skiprows=1);
-    [lon_meas, lat_meas, u_meas, v_meas, w_meas, sige_meas, sign_meas, sigu_meas] = np.loadtxt(gps_file, unpack=True,
-                                                                                               skiprows=1);
-    disp_reference_pixel = [u_pred[0], v_pred[0], w_pred[0]];
+    pred_enu = read_model_predictions(model_disps_file);
+    data = np.loadtxt(gps_file, skiprows=1, ndmin=2);  # lon, lat, dE, dN, dU, Se, Sn, Su
+    data[:, 2:5] = data[:, 2:5] - (pred_enu - pred_enu[0]);
     namestem = gps_file.split(".txt")[0];
-    ofile = open(namestem + "_cos_corrected.txt", 'w');
-    ofile.write("# Header: lon, lat, dE, dN, dU, Se, Sn, Su (m)\n");
-    for i in range(len(lon_meas)):
-        disp_at_station = [u_meas[i], v_meas[i], w_meas[i]];
-        model_for_station = [u_pred[i], v_pred[i], w_pred[i]];
-        model_delta = np.subtract(model_for_station, disp_reference_pixel);
-        new_data = np.subtract(disp_at_station, model_delta);
-        ofile.write("%f %f %f %f %f %f %f %f\n" % (
-            lon_meas[i], lat_meas[i], new_data[0], new_data[1], new_data[2], sige_meas[i], sign_meas[i], sigu_meas[i]));
-    ofile.close();
+    np.savetxt(namestem + "_cos_corrected.txt", data, fmt='%f', header="Header: lon, lat, dE, dN, dU, Se, Sn, Su (m)",
+               comments='# ');
     return;
+
+
+def remove_model_disp_points(disp_points, model_disps, ref_idx=0):
+    """
+    Remove one or more coseismic models from an in-memory list of GNSS Displacement_points (m).
+
+    :param disp_points: list of Displacement_points
+    :param model_disps: anything accepted by read_model_predictions, matching the list of disp_points
+    :param ref_idx: int, index of the reference station. Default is the first station.
+    :returns: list of Displacement_points
+    """
+    pred_enu = read_model_predictions(model_disps);
+    model_delta = pred_enu - pred_enu[ref_idx];
+    corrected_points = [];
+    for i, item in enumerate(disp_points):
+        corrected_points.append(item._replace(dE_obs=item.dE_obs - model_delta[i][0],
+                                              dN_obs=item.dN_obs - model_delta[i][1],
+                                              dU_obs=item.dU_obs - model_delta[i][2]));
+    return corrected_points;
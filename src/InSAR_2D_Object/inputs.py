@@ -4,8 +4,8 @@ Input functions for 2D InSAR-format data
 
 import numpy as np
 from Tectonic_Utils.read_write import netcdf_read_write
-from Tectonic_Utils.geodesy import insar_vector_functions
 from .class_model import InSAR_2D_Object
+from . import utilities
 
 
 def inputs_grd(los_grdfile):
@@ -21,29 +21,64 @@ def inputs_grd(los_grdfile):
     return InSAR_Obj;
 
 
-def inputs_from_synthetic_enu_grids(e_grdfile, n_grdfile, u_grdfile, flight_angle, constant_incidence_angle=None):
+def inputs_from_synthetic_enu_grids(e_grdfile, n_grdfile, u_grdfile, flight_angle, constant_incidence_angle=None,
+                                    near_incidence_angle=None, far_incidence_angle=None, look_direction='right'):
     """
     Read synthetic models with three deformation components.
     If constant_incidence_angle is provided, it uses one simple incidence angle and flight angle for the field.
-    Future: Options for non-constant incidence angle have not yet been written. Range depends on track/orbit.
+    Otherwise, incidence varies linearly across the grid from near_incidence_angle to far_incidence_angle.
 
     :param e_grdfile: string, filename
     :param n_grdfile: string, filename
     :param u_grdfile: string, filename
     :param flight_angle: float, flight angle, degrees cw from n
     :param constant_incidence_angle: float, incidence angle, degrees from vertical
+    :param near_incidence_angle: float, incidence angle at near range, degrees from vertical
+    :param far_incidence_angle: float, incidence angle at far range, degrees from vertical
+    :param look_direction: string, 'right' or 'left'
     """
     [lon, lat, e] = netcdf_read_write.read_any_grd(e_grdfile);
     [_, _, n] = netcdf_read_write.read_any_grd(n_grdfile);
     [_, _, u] = netcdf_read_write.read_any_grd(u_grdfile);
-    look_vector = insar_vector_functions.flight_incidence_angles2look_vector(flight_angle, constant_incidence_angle);
+    if constant_incidence_angle is not None:
+        [lkv_E, lkv_N, lkv_U] = utilities.get_look_vector_grids_flight_incidence(lon, lat, flight_angle,
+                                                                                 constant_incidence_angle,
+                                                                                 look_direction=look_direction);
+    elif near_incidence_angle is not None and far_incidence_angle is not None:
+        [lkv_E, lkv_N, lkv_U] = utilities.get_look_vector_grids_flight_incidence(lon, lat, flight_angle,
+                                                                                 near_incidence_angle,
+                                                                                 far_incidence_angle,
+                                                                                 look_direction=look_direction);
+    else:
+        raise ValueError("Error! Provide either constant_incidence_angle or near and far incidence angles.");
+    los = utilities.project_enu_into_los(e, n, u, lkv_E, lkv_N, lkv_U);
+    los = np.multiply(los, 1000);  # convert from m to mm
+    InSAR_Obj = InSAR_2D_Object(lon=lon, lat=lat, LOS=los, LOS_unc=np.zeros(np.shape(los), dtype=np.float32),
+                                lkv_E=lkv_E, lkv_N=lkv_N, lkv_U=lkv_U, starttime=None, endtime=None);
+    print("Done with reading object");
+    return InSAR_Obj;
+
+
+def inputs_from_synthetic_enu_grids_los_rdr(e_grdfile, n_grdfile, u_grdfile, azimuth_grdfile, incidence_grdfile):
+    """
+    Read synthetic models with three deformation components, projected with per-pixel look vectors
+    from azimuth and incidence rasters on the same grid (such as bands of an ISCE los.rdr.geo file).
 
-    lkv_E = np.multiply(np.ones(np.shape(e)), look_vector[0]);  # constant incidence angle for now
-    lkv_N = np.multiply(np.ones(np.shape(e)), look_vector[1]);  # constant incidence angle for now
-    lkv_U = np.multiply(np.ones(np.shape(e)), look_vector[2]);  # constant incidence angle for now
-    los = insar_vector_functions.def3D_into_LOS(e, n, u, flight_angle, constant_incidence_angle);
+    :param e_grdfile: string, filename
+    :param n_grdfile: string, filename
+    :param u_grdfile: string, filename
+    :param azimuth_grdfile: string, filename of azimuth raster in degrees
+    :param incidence_grdfile: string, filename of incidence raster in degrees
+    """
+    [lon, lat, e] = netcdf_read_write.read_any_grd(e_grdfile);
+    [_, _, n] = netcdf_read_write.read_any_grd(n_grdfile);
+    [_, _, u] = netcdf_read_write.read_any_grd(u_grdfile);
+    [_, _, azimuth] = netcdf_read_write.read_any_grd(azimuth_grdfile);
+    [_, _, incidence] = netcdf_read_write.read_any_grd(incidence_grdfile);
+    [lkv_E, lkv_N, lkv_U] = utilities.get_look_vector_grids_azimuth_incidence(azimuth, incidence);
+    los = utilities.project_enu_into_los(e, n, u, lkv_E, lkv_N, lkv_U);
     los = np.multiply(los, 1000);  # convert from m to mm
-    InSAR_Obj = InSAR_2D_Object(lon=lon, lat=lat, LOS=los, LOS_unc=np.zeros(np.shape(los)),
+    InSAR_Obj = InSAR_2D_Object(lon=lon, lat=lat, LOS=los, LOS_unc=np.zeros(np.shape(los), dtype=np.float32),
                                 lkv_E=lkv_E, lkv_N=lkv_N, lkv_U=lkv_U, starttime=None, endtime=None);
     print("Done with reading object");
     return InSAR_Obj;
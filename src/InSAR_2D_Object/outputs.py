@@ -13,13 +13,29 @@ def write_InSAR2D(InSAR_Obj, filename):
     return;
 
 
-def write_insar2D_invertible_format(_InSAR_obj, _unc_min, filename):
+def write_insar2D_invertible_format(InSAR_obj, unc_min, filename):
     """
     Write InSAR 2D displacements into insar text file that can be inverted.
     Write one header line and multiple data lines, with different look vectors for each pixel.
-    InSAR_2D_obj is in mm, and written out is in meters
+    InSAR_2D_obj is in mm, and written out is in meters. NaN pixels are skipped.
     """
-    print("Writing InSAR displacements into file %s - function not yet written!" % filename);
+    print("Writing InSAR displacements into file %s " % filename);
+    if InSAR_obj.lkv_E is None:
+        raise ValueError("Error! Cannot write invertible format without look vectors.");
+    shape = np.shape(InSAR_obj.LOS);
+    good = ~np.isnan(InSAR_obj.LOS);
+    rows, cols = np.nonzero(good);
+    if InSAR_obj.LOS_unc is not None:
+        std = np.maximum(np.asarray(InSAR_obj.LOS_unc, dtype=np.float64)[good] * 0.001, unc_min);  # in m
+    else:   # sometimes there's an error code in LOS_unc field
+        std = np.full(len(rows), unc_min);
+    data = np.column_stack((np.asarray(InSAR_obj.lon)[cols], np.asarray(InSAR_obj.lat)[rows],
+                            0.001 * np.asarray(InSAR_obj.LOS, dtype=np.float64)[good], std,
+                            np.broadcast_to(InSAR_obj.lkv_E, shape)[good],
+                            np.broadcast_to(InSAR_obj.lkv_N, shape)[good],
+                            np.broadcast_to(InSAR_obj.lkv_U, shape)[good]));  # writing in m
+    np.savetxt(filename, data, fmt='%f', header="InSAR Displacements: Lon, Lat, disp(m), sigma, unitE, unitN, unitU ",
+               comments='# ');
     return;
 
 
@@ -6,12 +6,121 @@ LOS is in mm
 """
 
 import numpy as np
+from Tectonic_Utils.geodesy import insar_vector_functions
 from .class_model import InSAR_2D_Object
 
 
-def impose_InSAR_bounding_box(_InSAR_obj, _bbox=(-180, 180, -90, 90)):
-    """Impose a bounding box on some InSAR data. Not written yet. """
-    return [];
+def impose_InSAR_bounding_box(InSAR_obj, bbox=(-180, 180, -90, 90), decimation=1):
+    """
+    Impose a bounding box on some InSAR data.
+    Returns views into the original arrays rather than copies, so cropping is cheap in memory.
+
+    :param InSAR_obj: 2D InSAR object
+    :param bbox: [W, E, S, N] in degrees
+    :param decimation: int, keep every n-th row and column of the cropped grid
+    :returns: 2D InSAR object
+    """
+    col_slice = get_axis_slice(InSAR_obj.lon, bbox[0], bbox[1], decimation);
+    row_slice = get_axis_slice(InSAR_obj.lat, bbox[2], bbox[3], decimation);
+
+    def crop(grid):
+        return None if grid is None else grid[row_slice, col_slice];
+
+    new_InSAR_obj = InSAR_2D_Object(lon=InSAR_obj.lon[col_slice], lat=InSAR_obj.lat[row_slice],
+                                    LOS=crop(InSAR_obj.LOS), LOS_unc=crop(InSAR_obj.LOS_unc),
+                                    lkv_E=crop(InSAR_obj.lkv_E), lkv_N=crop(InSAR_obj.lkv_N),
+                                    lkv_U=crop(InSAR_obj.lkv_U), starttime=InSAR_obj.starttime,
+                                    endtime=InSAR_obj.endtime);
+    return new_InSAR_obj;
+
+
+def get_axis_slice(axis, minval, maxval, step=1):
+    """
+    Slice of a sorted 1D coordinate axis (ascending or descending) that falls within [minval, maxval].
+
+    :param axis: 1D array of coordinates
+    :param minval: float
+    :param maxval: float
+    :param step: int, stride of the slice
+    :returns: slice object
+    """
+    axis = np.asarray(axis);
+    if len(axis) > 1 and axis[0] > axis[-1]:  # descending axis
+        reversed_axis = axis[::-1];
+        i0 = len(axis) - np.searchsorted(reversed_axis, maxval, side='right');
+        i1 = len(axis) - np.searchsorted(reversed_axis, minval, side='left');
+    else:
+        i0 = np.searchsorted(axis, minval, side='left');
+        i1 = np.searchsorted(axis, maxval, side='right');
+    return slice(int(i0), int(i1), int(step));
+
+
+def get_look_vector_grids_flight_incidence(lon, lat, flight_angle, near_incidence, far_incidence=None,
+                                           look_direction='right', dtype=np.float32):
+    """
+    Per-pixel look vectors (ground to satellite) on a 2D grid from a flight angle and an incidence angle model.
+    Incidence varies linearly across the grid in the look direction, from near_incidence at near range
+    to far_incidence at far range. If far_incidence is None, the incidence angle is constant.
+
+    :param lon: 1D array of longitudes
+    :param lat: 1D array of latitudes
+    :param flight_angle: float, flight angle, degrees cw from n
+    :param near_incidence: float, incidence angle at near range, degrees from vertical
+    :param far_incidence: float, incidence angle at far range, degrees from vertical
+    :param look_direction: string, 'right' or 'left'
+    :param dtype: data type of the returned grids
+    :returns: lkv_E, lkv_N, lkv_U, each a 2D array with shape (len(lat), len(lon))
+    """
+    lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64);
+    if look_direction == 'right':
+        look_azimuth = np.deg2rad(flight_angle + 90);  # degrees cw from north
+    elif look_direction == 'left':
+        look_azimuth = np.deg2rad(flight_angle - 90);
+    else:
+        raise ValueError("Error! look_direction must be 'right' or 'left', not %s" % look_direction);
+    if far_incidence is None:
+        incidence = np.full((len(lat), len(lon)), np.deg2rad(near_incidence));
+    else:
+        # Local flat-earth km coordinates, projected onto the look direction with broadcasting
+        x = (lon - np.mean(lon)) * 111.32 * np.cos(np.deg2rad(np.mean(lat)));
+        y = (lat - np.mean(lat)) * 111.32;
+        range_dist = x[np.newaxis, :] * np.sin(look_azimuth) + y[:, np.newaxis] * np.cos(look_azimuth);
+        span = np.max(range_dist) - np.min(range_dist);
+        fraction = (range_dist - np.min(range_dist)) / span if span > 0 else np.zeros(np.shape(range_dist));
+        incidence = np.deg2rad(near_incidence + fraction * (far_incidence - near_incidence));
+    # Horizontal part of the ground-to-satellite vector points opposite to the look azimuth
+    lkv_E = (-np.sin(incidence) * np.sin(look_azimuth)).astype(dtype);
+    lkv_N = (-np.sin(incidence) * np.cos(look_azimuth)).astype(dtype);
+    lkv_U = np.cos(incidence).astype(dtype);
+    return lkv_E, lkv_N, lkv_U;
+
+
+def get_look_vector_grids_azimuth_incidence(azimuth, incidence, dtype=np.float32):
+    """
+    Per-pixel look vectors (ground to satellite) from ISCE-style azimuth and incidence rasters (los.rdr.geo).
+
+    :param azimuth: 2D array, degrees
+    :param incidence: 2D array, degrees
+    :param dtype: data type of the returned grids
+    :returns: lkv_E, lkv_N, lkv_U, each a 2D array with the shape of the rasters
+    """
+    [lkv_E, lkv_N, lkv_U] = insar_vector_functions.calc_lkv_from_rdr_azimuth_incidence(np.asarray(azimuth),
+                                                                                       np.asarray(incidence));
+    return np.asarray(lkv_E, dtype=dtype), np.asarray(lkv_N, dtype=dtype), np.asarray(lkv_U, dtype=dtype);
+
+
+def project_enu_into_los(e, n, u, lkv_E, lkv_N, lkv_U, dtype=np.float32):
+    """
+    Project three components of deformation into the LOS with broadcasting.
+    Look vectors can be scalars or grids of the same shape as the deformation.
+    Positive LOS is toward the satellite.
+
+    :returns: LOS array, same units as e, n, u
+    """
+    los = np.asarray(e, dtype=dtype) * np.asarray(lkv_E, dtype=dtype);
+    los += np.asarray(n, dtype=dtype) * np.asarray(lkv_N, dtype=dtype);
+    los += np.asarray(u, dtype=dtype) * np.asarray(lkv_U, dtype=dtype);
+    return los;
 
 
 def flip_los_sign(InSAR_obj):
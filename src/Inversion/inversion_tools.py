@@ -6,6 +6,7 @@ import Tectonic_Utilities.Tectonic_Utils.seismo.moment_calculations as moment_ca
 import Elastic_stresses_py.PyCoulomb.coulomb_collections as cc
 import Elastic_stresses_py.PyCoulomb.disp_points_object as dpo
 import Elastic_stresses_py.PyCoulomb.fault_slip_object as library
+from . import moment_tools
 
 """
 GF_element is everything you would need to make a column of the Green's matrix and plot the impulse response function. 
@@ -414,45 +415,48 @@ def write_model_params(v, residual, outfile, GF_elements=None):
     return;
 
 
-def write_custom_metrics(ofile, values, GF_elements):
-    # Accounting of moment rate on the CSZ and other faults
+def write_model_uncertainties(v, mc_result, outfile, GF_elements=None):
+    """
+    :param v: vector of best-fit model parameters, floats
+    :param mc_result: monte_carlo.MonteCarloResult
+    :param outfile: string
+    :param GF_elements: optional, list of GF_element objects
+    """
+    print("Writing %s" % outfile);
+    ofile = open(outfile, 'w');
+    ofile.write("# name best_fit mean std " + " ".join(["p%s" % x for x in mc_result.percentile_levels]) + "\n");
+    for i, item in enumerate(v):
+        name = GF_elements[i].fault_name if GF_elements else str(i);
+        ofile.write("%s %f %f %f " % (name, item, mc_result.mean[i], mc_result.std[i]));
+        ofile.write(" ".join(["%f" % x for x in mc_result.percentiles[:, i]]) + "\n");
+    ofile.write("# %d realizations\n" % len(mc_result.models));
+    ofile.close();
+    return;
+
+
+def write_custom_metrics(ofile, values, GF_elements, regions=None, years=300):
+    # Accounting of moment rate on the CSZ and other regions, then the total moment rate of each fault
     # ofile : file handle
     # values : model vector
     # GF_elements: list of green's functions elements associated with vector of model values
-    # Specific to Humboldt project
-
-    csz_fault_dicts = [];
-    for value, gf_element in zip(values, GF_elements):
-        if gf_element.fault_name == 'CSZ_dist':
-            if gf_element.fault_dict_list[0]["lat"] > 43:  # considering southern section only
-                continue;
-            new_patches = library.fault_slip_object.change_fault_slip(gf_element.fault_dict_list, value/100);
-            csz_fault_dicts.append(new_patches[0]);
-    csz_mo = library.fault_slip_object.get_total_moment(csz_fault_dicts);
-    ofile.write("\nCSZ Over 300 years: equivalent to Mw");
-    ofile.write("%f \n" % moment_calcs.mw_from_moment(csz_mo*300));
-    ofile.write("%f N-m\n" % csz_mo);
-
-    new_patches = [];
-    for value, gf_element in zip(values, GF_elements):
-        if gf_element.fault_name == 'LSFRev':
-            new_patches = library.fault_slip_object.change_fault_slip(gf_element.fault_dict_list, value / 100);
-    lsf_mo = library.fault_slip_object.get_total_moment(new_patches);
-    ofile.write("\nLSFRev Over 300 years: equivalent to Mw");
-    ofile.write("%f \n" % moment_calcs.mw_from_moment(lsf_mo*300));
-    ofile.write("%f N-m\n" % lsf_mo);
-
-    for value, gf_element in zip(values, GF_elements):
-        if gf_element.fault_name == 'MadRiverRev':
-            new_patches = library.fault_slip_object.change_fault_slip(gf_element.fault_dict_list, value / 100);
-    lsf_mo = library.fault_slip_object.get_total_moment(new_patches);
-    ofile.write("\nMadRiverRev Over 300 years: equivalent to Mw");
-    ofile.write("%f \n" % moment_calcs.mw_from_moment(lsf_mo*300));
-    ofile.write("%f N-m\n" % lsf_mo);
+    # regions: list of region dictionaries (see moment_tools). Default is the Humboldt project accounting.
+    #     The default's CSZ, LSFRev, and MadRiverRev numbers differ from older metrics files, because the old
+    #     hardcoded sums dropped patches; see moment_tools.HUMBOLDT_REGIONS for what changed.
+    # years: moment rates are also reported as the moment accumulated over this many years
+    regions = moment_tools.HUMBOLDT_REGIONS if regions is None else regions;
+    moments = moment_tools.get_gf_element_region_moments(values, GF_elements, regions);
+    for region, mo in zip(regions, moments):
+        ofile.write("\n%s Over %d years: equivalent to Mw" % (region["name"], years));
+        ofile.write("%f \n" % moment_calcs.mw_from_moment(mo*years));
+        ofile.write("%f N-m\n" % mo);
+    fault_moments = moment_tools.get_gf_element_fault_moments(values, GF_elements);
+    ofile.write("\nMoment by fault:\n");
+    for fault_name in sorted(fault_moments.keys()):
+        ofile.write("%s: %f N-m\n" % (fault_name, fault_moments[fault_name]));
     return;
 
 
-def write_summary_params(v, residual, outfile, GF_elements, ignore_faults=(), message=''):
+def write_summary_params(v, residual, outfile, GF_elements, ignore_faults=(), message='', regions=None, years=300):
     """
     Write a human-readable results file, with the potential to ignore faults with distributed models for clarity.
     The "residual" field is a bit specific to the experiment
@@ -463,6 +467,8 @@ def write_summary_params(v, residual, outfile, GF_elements, ignore_faults=(), me
     :param GF_elements: list of GF_element objects
     :param ignore_faults: list of strings
     :param message: optional message from inverse routine about solution quality
+    :param regions: optional list of region dictionaries for moment accounting (see moment_tools)
+    :param years: int, span of years for reporting accumulated moment
     """
     print("Writing %s" % outfile);
     ofile = open(outfile, 'w');
@@ -487,7 +493,7 @@ def write_summary_params(v, residual, outfile, GF_elements, ignore_faults=(), me
     report_string = "RMS normalized [h, v, t]: %f %f %f \n" % (residual[3], residual[4], residual[5]);
     ofile.write(report_string);
     ofile.write("Message: "+message+"\n");
-    write_custom_metrics(ofile, v, GF_elements);  # for humboldt project
+    write_custom_metrics(ofile, v, GF_elements, regions, years);  # for humboldt project
     ofile.close();
     return;
 
@@ -0,0 +1,194 @@
+"""
+Choosing the regularization strength automatically.
+The L-curve corner is found in log(misfit) / log(model norm) space by maximum curvature or by the triangle method,
+and an adaptive search refines the regularization parameter only near the corner, bisecting in log(lambda).
+GCV and ABIC are alternatives that are minimized directly from G, d, and the regularization matrix.
+"""
+
+import collections
+import numpy as np
+
+# params, misfits, model_norms: one entry per inversion, sorted by param.  corner: index of the chosen inversion.
+LCurveSearch = collections.namedtuple('LCurveSearch', ['params', 'misfits', 'model_norms', 'corner']);
+
+GOLDEN_RATIO = (np.sqrt(5) - 1) / 2;
+
+
+def log_curve_coordinates(params, misfits, model_norms):
+    """Sort by regularization parameter, then return log10(lambda), log10(misfit), log10(model norm)"""
+    order = np.argsort(params);
+    t = np.log10(np.asarray(params, dtype=float)[order]);
+    x = np.log10(np.asarray(misfits, dtype=float)[order]);
+    y = np.log10(np.asarray(model_norms, dtype=float)[order]);
+    return order, t, x, y;
+
+
+def l_curve_curvature(params, misfits, model_norms, min_speed_fraction=0.05):
+    """
+    Signed curvature of the parametric L-curve (log misfit, log model norm) as a function of log(lambda),
+    with finite differences on the possibly-uneven lambda grid. Positive at the corner.
+    On the flat ends of the curve the speed is nearly zero and finite-difference curvature blows up,
+    so points moving slower than min_speed_fraction of the fastest point get -inf and are never chosen.
+    The two end points (one-sided differences) are never chosen either.
+    Returned in the sorted-by-param order.
+    """
+    _, t, x, y = log_curve_coordinates(params, misfits, model_norms);
+    dx, dy = np.gradient(x, t), np.gradient(y, t);
+    ddx, ddy = np.gradient(dx, t), np.gradient(dy, t);
+    speed = np.sqrt(dx * dx + dy * dy);
+    with np.errstate(invalid='ignore', divide='ignore'):
+        curvature = (dx * ddy - dy * ddx) / np.power(speed, 3);
+    curvature[speed <= min_speed_fraction * np.max(speed)] = -np.inf;
+    curvature[[0, -1]] = -np.inf;
+    return np.nan_to_num(curvature, nan=-np.inf);
+
+
+def max_curvature_corner(params, misfits, model_norms):
+    """Index (into the original arrays) of the L-curve point of maximum curvature"""
+    if len(params) < 3:
+        raise ValueError("Error! Need at least 3 inversions to find an L-curve corner.");
+    order = np.argsort(params);
+    return int(order[np.argmax(l_curve_curvature(params, misfits, model_norms))]);
+
+
+def triangle_corner(params, misfits, model_norms):
+    """
+    Index (into the original arrays) of the L-curve corner by the triangle method (Castellanos et al., 2002):
+    the point making the largest triangle with the two ends of the curve, on the side toward the origin.
+    """
+    if len(params) < 3:
+        raise ValueError("Error! Need at least 3 inversions to find an L-curve corner.");
+    order, _, x, y = log_curve_coordinates(params, misfits, model_norms);
+    # Twice the signed area of triangle (first point, point k, last point). Misfit rises and norm falls along
+    # a real L-curve, so the area is negative when k is toward the origin: the corner is the argmin, not argmax
+    area = (x[-1] - x[0]) * (y - y[0]) - (y[-1] - y[0]) * (x - x[0]);
+    return int(order[np.argmin(area)]);
+
+
+def find_corner(params, misfits, model_norms, method='triangle'):
+    """Index of the L-curve corner. method is 'triangle' (default, robust on coarse grids) or 'curvature'."""
+    if method == 'curvature':
+        return max_curvature_corner(params, misfits, model_norms);
+    elif method == 'triangle':
+        return triangle_corner(params, misfits, model_norms);
+    else:
+        raise ValueError("Error! Corner method " + method + " not recognized. Should be curvature or triangle.");
+
+
+def adaptive_corner_search(run_inversion, lambda_min, lambda_max, n_initial=5, n_refine=4, method='triangle'):
+    """
+    Find the L-curve corner with only a handful of inversions.
+    Start with a coarse log-spaced grid, then repeatedly bisect (in log lambda) the intervals on either side
+    of the current corner, so new inversions land only near the corner.
+
+    :param run_inversion: function of lambda that runs one inversion and returns (misfit, model norm)
+    :param lambda_min: float, smallest regularization parameter
+    :param lambda_max: float, largest regularization parameter
+    :param n_initial: int, number of inversions in the coarse grid (at least 3)
+    :param n_refine: int, number of refinement rounds, each adding up to two inversions
+    :param method: 'triangle' or 'curvature'
+    :returns: LCurveSearch
+    """
+    if lambda_min <= 0 or lambda_max <= lambda_min:
+        raise ValueError("Error! Adaptive search needs 0 < lambda_min < lambda_max.");
+    results = {};
+
+    def evaluate(lam):
+        if lam not in results:
+            print("L-curve search: running inversion at lambda = %f" % lam);
+            results[lam] = run_inversion(lam);
+        return;
+
+    for lam in np.logspace(np.log10(lambda_min), np.log10(lambda_max), max(n_initial, 3)):
+        evaluate(float(lam));
+    for _ in range(n_refine):
+        lambdas = sorted(results.keys());
+        corner = find_corner(lambdas, [results[x][0] for x in lambdas], [results[x][1] for x in lambdas], method);
+        for neighbor in (corner - 1, corner + 1):
+            if 0 <= neighbor < len(lambdas):
+                evaluate(float(np.sqrt(lambdas[corner] * lambdas[neighbor])));  # midpoint in log(lambda)
+
+    lambdas = sorted(results.keys());
+    misfits = [results[x][0] for x in lambdas];
+    model_norms = [results[x][1] for x in lambdas];
+    corner = find_corner(lambdas, misfits, model_norms, method);
+    print("L-curve corner at lambda = %f after %d inversions" % (lambdas[corner], len(lambdas)));
+    return LCurveSearch(params=lambdas, misfits=misfits, model_norms=model_norms, corner=corner);
+
+
+# -------- GCV AND ABIC ----------- #
+def regularized_solution(G, d, L, lam):
+    """Unconstrained Tikhonov solution m = (G^T G + lam^2 L^T L)^-1 G^T d, and the matrix being inverted"""
+    A = G.T.dot(G) + lam * lam * L.T.dot(L);
+    return np.linalg.solve(A, G.T.dot(d)), A;
+
+
+def gcv_value(G, d, L, lam):
+    """
+    Generalized cross-validation function (Aster et al., Section 4.7):
+    GCV = n ||G m - d||^2 / trace(I - G A^-1 G^T)^2.  Bounds on the model are ignored.
+    """
+    m, A = regularized_solution(G, d, L, lam);
+    n = len(d);
+    influence_trace = np.trace(np.linalg.solve(A, G.T.dot(G)));  # trace(G A^-1 G^T) = trace(A^-1 G^T G)
+    return n * np.sum(np.square(G.dot(m) - d)) / np.square(n - influence_trace);
+
+
+def abic_value(G, d, L, lam):
+    """
+    Akaike's Bayesian Information Criterion for the smoothing strength (Yabuki and Matsu'ura, 1992;
+    Fukahata and Wright, 2008), dropping terms that do not depend on lambda:
+    ABIC = (n + p - m) log(s) - p log(lam^2) + log det(G^T G + lam^2 L^T L),
+    with s = ||G m - d||^2 + lam^2 ||L m||^2, p = rank(L^T L), m = number of model parameters.
+    """
+    model, A = regularized_solution(G, d, L, lam);
+    n, m_params = np.shape(G);
+    p = np.linalg.matrix_rank(L.T.dot(L));
+    s = np.sum(np.square(G.dot(model) - d)) + lam * lam * np.sum(np.square(L.dot(model)));
+    _, logdet = np.linalg.slogdet(A);
+    return (n + p - m_params) * np.log(s) - p * np.log(lam * lam) + logdet;
+
+
+def golden_section_search(function, lambda_min, lambda_max, tolerance=0.01, max_iter=50):
+    """
+    Minimize a function of lambda by golden-section search in log10(lambda).
+
+    :param tolerance: float, width of the final bracket in log10(lambda)
+    :returns: lambda at the minimum, value at the minimum
+    """
+    a, b = np.log10(lambda_min), np.log10(lambda_max);
+    c, d = b - GOLDEN_RATIO * (b - a), a + GOLDEN_RATIO * (b - a);
+    fc, fd = function(10 ** c), function(10 ** d);
+    for _ in range(max_iter):
+        if b - a < tolerance:
+            break;
+        if fc < fd:
+            b, d, fd = d, c, fc;
+            c = b - GOLDEN_RATIO * (b - a);
+            fc = function(10 ** c);
+        else:
+            a, c, fc = c, d, fd;
+            d = a + GOLDEN_RATIO * (b - a);
+            fd = function(10 ** d);
+    best = c if fc < fd else d;
+    return 10 ** best, min(fc, fd);
+
+
+def select_lambda(G, d, L, lambda_min, lambda_max, method='gcv', tolerance=0.01):
+    """
+    Regularization strength that minimizes GCV or ABIC.
+
+    :param G: 2D array, weighted design matrix (without regularization rows)
+    :param d: 1D array, weighted data vector
+    :param L: 2D array, regularization matrix (like smoothing), with the same number of columns as G
+    :param method: 'gcv' or 'abic'
+    :returns: best lambda, criterion value at best lambda
+    """
+    criteria = {"gcv": gcv_value, "abic": abic_value};
+    if method not in criteria:
+        raise ValueError("Error! Method " + method + " not recognized. Should be gcv or abic.");
+    G, d, L = np.asarray(G, dtype=float), np.asarray(d, dtype=float), np.asarray(L, dtype=float);
+    best_lam, best_value = golden_section_search(lambda lam: criteria[method](G, d, L, lam), lambda_min, lambda_max,
+                                                 tolerance);
+    print("Best lambda by %s: %f" % (method, best_lam));
+    return best_lam, best_value;
@@ -1,6 +1,7 @@
 
 import numpy as np
 from matplotlib import pyplot as plt
+from . import l_curve_corner
 
 
 def plot_1d_curve(param_values, misfit, axis_name, outfile, corner_point=None):
@@ -70,7 +71,7 @@ def plot_1d_curve(param_values, misfit, axis_name, outfile, corner_point=None):
     return;
 
 
-def plot_2d_curve(alphas, penalties, misfits, param1_name, param2_name, outfile):
+def plot_2d_curve(alphas, penalties, misfits, param1_name, param2_name, outfile, chosen_point=None):
     """
     Make 2D surface plot for L-curve
 
@@ -80,6 +81,7 @@ def plot_2d_curve(alphas, penalties, misfits, param1_name, param2_name, outfile)
     :param param1_name: string
     :param param2_name: string
     :param outfile: string
+    :param chosen_point: optional [alpha, penalty] to annotate, like the chosen model of a project
     """
     fig = plt.figure(figsize=(4, 4), dpi=200);
     ax = fig.add_subplot(111, projection='3d')
@@ -90,19 +92,16 @@ def plot_2d_curve(alphas, penalties, misfits, param1_name, param2_name, outfile)
     ax.set_xlabel(param1_name);
     ax.set_ylabel(param2_name);
     ax.set_zlabel('Misfit (mm)')
-    ax = chosen_axis_annotations(ax);
+    if chosen_point is not None:
+        ax = chosen_axis_annotations(ax, chosen_point[0], chosen_point[1]);
     ax.set_title("Misfit vs Regularization Parameters");
     plt.show();  # good for playing.
     plt.savefig(outfile);
     return;
 
 
-def chosen_axis_annotations(ax):
-    # Manual annotations for certain projects
-    # Example: Heber base inversion: alpha 2, penalty 0.5.
-    # WARNING: This is mixing code and data.
-    chosen_alpha = 2;        # HEBER
-    chosen_penalty = 0.5;    # HEBER
+def chosen_axis_annotations(ax, chosen_alpha, chosen_penalty):
+    # Annotations of the chosen alpha and penalty. Example: Heber base inversion used alpha 2, penalty 0.5.
     alpha_range = ax.get_xlim();
     penalty_range = ax.get_ylim();
     [bottom, _] = ax.get_zlim();
@@ -112,15 +111,38 @@ def chosen_axis_annotations(ax):
     return ax;
 
 
-def plot_l_curve_coordinator(params, misfits, outfile):
-    """ Coordiantor function for driving l-curve plots """
+def plot_l_curve_coordinator(params, misfits, outfile, model_norms=None, chosen_point=None,
+                             corner_method='triangle'):
+    """
+    Coordiantor function for driving l-curve plots.
+    For a 1D search with model norms (like from a run index), the corner is found automatically.
+
+    :param params: list of [alpha, penalty]
+    :param misfits: list of misfits
+    :param outfile: string
+    :param model_norms: optional list of model norms
+    :param chosen_point: optional [alpha, penalty] to annotate on a 2D plot
+    :param corner_method: 'triangle' (default), 'curvature', or None for no automatic corner
+    """
     all_alphas = [x[0] for x in params];
     all_penalties = [x[1] for x in params];
     if len(set(all_alphas)) == 1:
-        plot_1d_curve(all_penalties, misfits, 'Smoothing Penalty', outfile.split('.')[0] + "_smoothing.png");
+        corner_point = get_auto_corner(all_penalties, misfits, model_norms, corner_method);
+        plot_1d_curve(all_penalties, misfits, 'Smoothing Penalty', outfile.split('.')[0] + "_smoothing.png",
+                      corner_point);
     elif len(set(all_penalties)) == 1:
-        plot_1d_curve(all_alphas, misfits, 'Slip Penalty, alpha', outfile.split('.')[0] + "_slip.png");
+        corner_point = get_auto_corner(all_alphas, misfits, model_norms, corner_method);
+        plot_1d_curve(all_alphas, misfits, 'Slip Penalty, alpha', outfile.split('.')[0] + "_slip.png", corner_point);
     else:
         plot_2d_curve(all_alphas, all_penalties, misfits, '1/alpha (slip)', '1/smoothing (smoothing)',
-                      outfile.split('.')[0] + "_2d.png");
+                      outfile.split('.')[0] + "_2d.png", chosen_point);
     return;
+
+
+def get_auto_corner(param_values, misfits, model_norms, method='triangle'):
+    """Parameter value at the L-curve corner, or None if there aren't enough model norms to find one"""
+    if method is None or model_norms is None or len(param_values) < 3 or any(x is None for x in model_norms):
+        return None;
+    corner = l_curve_corner.find_corner(param_values, misfits, model_norms, method);
+    print("Automatic L-curve corner (%s): %f" % (method, param_values[corner]));
+    return param_values[corner];
@@ -0,0 +1,146 @@
+"""
+Smoothing matrices built from the topology of a fault mesh, for triangular or rectangular patches.
+Neighbors come from shared edges or vertices (triangles) or from grid indices (rectangles),
+rather than from a distance threshold. All matrices are scipy.sparse, with cost and memory linear in patch count.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+def get_vertex_indices(tri_vertices, decimals=3):
+    """
+    Number the unique vertices of a triangular mesh.
+
+    :param tri_vertices: array (n_triangles, 3, 3) of vertex coordinates, like from triangle_gf.get_triangle_vertices
+    :param decimals: int, coordinates are rounded to this many decimals to decide that two vertices are the same
+    :returns: int array (n_triangles, 3) of vertex indices
+    """
+    points = np.round(np.reshape(tri_vertices, (-1, 3)), decimals);
+    _, vertex_indices = np.unique(points, axis=0, return_inverse=True);
+    return np.reshape(vertex_indices, (-1, 3));
+
+
+def triangle_adjacency(vertex_indices, shared='edge'):
+    """
+    Neighbors in a triangular mesh, from the sparse triangle-vertex incidence matrix V.
+    (V @ V.T)[i, j] counts the vertices that triangles i and j share.
+
+    :param vertex_indices: int array (n_triangles, 3)
+    :param shared: 'edge' (two shared vertices) or 'vertex' (at least one shared vertex)
+    :returns: sparse boolean adjacency matrix (n_triangles x n_triangles), without the diagonal
+    """
+    n_triangles = len(vertex_indices);
+    rows = np.repeat(np.arange(n_triangles), 3);
+    V = sparse.csr_matrix((np.ones(3 * n_triangles), (rows, np.ravel(vertex_indices))),
+                          shape=(n_triangles, int(np.max(vertex_indices)) + 1));
+    shared_counts = (V @ V.T).tocoo();
+    if shared == 'edge':
+        min_shared = 2;
+    elif shared == 'vertex':
+        min_shared = 1;
+    else:
+        raise ValueError("Error! shared must be 'edge' or 'vertex', not %s" % shared);
+    keep = (shared_counts.data >= min_shared) & (shared_counts.row != shared_counts.col);
+    return sparse.csr_matrix((np.ones(np.sum(keep), dtype=bool), (shared_counts.row[keep], shared_counts.col[keep])),
+                             shape=(n_triangles, n_triangles));
+
+
+def grid_adjacency(Nlength, Nwidth, diagonals=False):
+    """
+    Neighbors in a rectangular mesh of Nlength x Nwidth patches, numbered like slippy discretize:
+    patch k is at along-strike index k // Nwidth and down-dip index k % Nwidth.
+
+    :returns: sparse boolean adjacency matrix (Nlength*Nwidth x Nlength*Nwidth), without the diagonal
+    """
+    index = np.arange(Nlength * Nwidth).reshape((Nlength, Nwidth));
+    pairs = [(index[:-1, :], index[1:, :]), (index[:, :-1], index[:, 1:])];
+    if diagonals:
+        pairs += [(index[:-1, :-1], index[1:, 1:]), (index[:-1, 1:], index[1:, :-1])];
+    rows = np.concatenate([a.ravel() for a, _ in pairs] + [b.ravel() for _, b in pairs]);
+    cols = np.concatenate([b.ravel() for _, b in pairs] + [a.ravel() for a, _ in pairs]);
+    return sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(index.size, index.size));
+
+
+def get_neighbor_distances(adjacency, centroids=None):
+    """
+    Centroid distances of all neighboring pairs, as a sparse matrix with the same pattern as adjacency.
+    Without centroids, every neighbor is at distance 1 (index-based smoothing).
+    """
+    adjacency = sparse.coo_matrix(adjacency);
+    if centroids is None:
+        distances = np.ones(len(adjacency.row));
+    else:
+        centroids = np.asarray(centroids, dtype=float);
+        distances = np.linalg.norm(centroids[adjacency.row] - centroids[adjacency.col], axis=1);
+    return sparse.csr_matrix((distances, (adjacency.row, adjacency.col)), shape=adjacency.shape);
+
+
+def first_order_difference(adjacency, centroids=None):
+    """
+    First-order (gradient) smoothing: one row per neighboring pair (i < j), (m_i - m_j) / distance_ij.
+
+    :param adjacency: sparse boolean adjacency matrix
+    :param centroids: optional array (n_patches, 3) of patch centroids
+    :returns: sparse matrix (n_pairs x n_patches)
+    """
+    distances = sparse.triu(get_neighbor_distances(adjacency, centroids), k=1).tocoo();
+    n_pairs = len(distances.row);
+    weights = 1.0 / distances.data;
+    pair_index = np.arange(n_pairs);
+    return sparse.csr_matrix((np.concatenate((weights, -weights)),
+                              (np.concatenate((pair_index, pair_index)), np.concatenate((distances.row,
+                                                                                        distances.col)))),
+                             shape=(n_pairs, adjacency.shape[0]));
+
+
+def second_order_laplacian(adjacency, centroids=None):
+    """
+    Scale-aware second-order smoothing (a discrete Laplacian for irregular meshes):
+    (L m)_i = 2 / (sum_j d_ij) * sum_j (m_j - m_i) / d_ij, over the neighbors j of patch i.
+    On a regular grid with unit spacing this is proportional to the usual [1, -4, 1] stencil.
+
+    :param adjacency: sparse boolean adjacency matrix
+    :param centroids: optional array (n_patches, 3) of patch centroids
+    :returns: sparse matrix (n_patches x n_patches)
+    """
+    distances = get_neighbor_distances(adjacency, centroids);
+    inverse_distances = distances.copy();
+    inverse_distances.data = 1.0 / inverse_distances.data;
+    distance_sums = np.asarray(distances.sum(axis=1)).ravel();
+    with np.errstate(divide='ignore'):
+        scale = np.where(distance_sums > 0, 2.0 / distance_sums, 0);  # isolated patches get an empty row
+    off_diagonal = sparse.diags(scale) @ inverse_distances;
+    diagonal = np.asarray(off_diagonal.sum(axis=1)).ravel();
+    return (off_diagonal - sparse.diags(diagonal)).tocsr();
+
+
+def expand_for_slip_basis(L, Ds):
+    """Apply the same smoothing to each of Ds slip components, with parameters ordered patch by patch."""
+    return sparse.kron(L, sparse.identity(Ds), format='csr');
+
+
+def append_smoothing_rows(G, obs, sigmas, L, strength):
+    """
+    Append smoothing rows under G, like inversion_tools.build_smoothing.
+    Append the matching number of zeros to the obs and sigma vectors.
+
+    :param G: already existing G matrix
+    :param obs: already existing obs vector
+    :param sigmas: already existing sigma vector
+    :param L: sparse smoothing matrix with the same number of columns as G (pad with zeros for other parameters)
+    :param strength: lambda parameter in smoothing equation
+    """
+    print("G and obs before smoothing:", np.shape(G), np.shape(obs));
+    if strength == 0:
+        print("No change, smoothing set to 0");
+        return G, obs, sigmas;
+    zero_vector = np.zeros((L.shape[0],));
+    if sparse.issparse(G):
+        G_smoothing = sparse.vstack((G, L * strength), format='csr');
+    else:
+        G_smoothing = np.vstack((G, (L * strength).toarray()));
+    smoothed_obs = np.concatenate((obs, zero_vector));
+    smoothed_sigmas = np.concatenate((sigmas, zero_vector));
+    print("G and obs after smoothing:", np.shape(G_smoothing), np.shape(smoothed_obs));
+    return G_smoothing, smoothed_obs, smoothed_sigmas;
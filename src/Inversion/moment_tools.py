@@ -0,0 +1,114 @@
+"""
+Vectorized seismic moment accounting for slip distributions.
+Moments of all patches are computed at once from arrays, then summed by fault or by region.
+Regions are given as config, like {"name": "CSZ", "fault_names": ["CSZ_dist"], "bbox": [-180, 180, -90, 43]}.
+"""
+
+import numpy as np
+
+# The accounting in the Humboldt project: southern CSZ (south of 43N), and two reverse faults.
+# These sums differ from the hardcoded loops they replace (before the regions config), which had bugs:
+#   CSZ: the old loop kept or dropped each GF element by the latitude of its first patch, then counted only that
+#        first patch. Now every patch of every CSZ_dist element at or south of 43N is counted.
+#   LSFRev: the old loop overwrote its patch list on each element, so only the last LSFRev element was counted.
+#        Now all LSFRev elements are summed, which is larger whenever there is more than one.
+#   MadRiverRev: the old loop reused the LSFRev patch list when no MadRiverRev element was present, and otherwise
+#        counted only the last element. Now it sums the MadRiverRev elements, and is zero if there are none.
+# Metrics files written before this change are not comparable for these lines.
+HUMBOLDT_REGIONS = [{"name": "CSZ", "fault_names": ["CSZ_dist"], "bbox": [-180, 180, -90, 43]},
+                    {"name": "LSFRev", "fault_names": ["LSFRev"]},
+                    {"name": "MadRiverRev", "fault_names": ["MadRiverRev"]}];
+
+
+def patch_moments(length, width, slip_components, mu=30e9):
+    """
+    Seismic moment of each patch, M0 = mu * area * |slip|.
+
+    :param length: array of patch lengths, m
+    :param width: array of patch widths, m
+    :param slip_components: array of slip (m), or a list/tuple of arrays (like strike-slip and dip-slip)
+    :param mu: shear modulus in Pa, a float or one value per patch
+    :returns: array of moments, N-m
+    """
+    if isinstance(slip_components, (list, tuple)):
+        slip = np.sqrt(np.sum(np.square(np.asarray(slip_components, dtype=float)), axis=0));
+    else:
+        slip = np.abs(np.asarray(slip_components, dtype=float));
+    return np.asarray(mu, dtype=float) * np.asarray(length, dtype=float) * np.asarray(width, dtype=float) * slip;
+
+
+def grouped_moments(moments, group_names):
+    """
+    Total moment of each group of patches (like each fault), with np.bincount.
+
+    :param moments: array of patch moments
+    :param group_names: list of group names, one per patch
+    :returns: dictionary of {group name: total moment}
+    """
+    names, group_index = np.unique(np.asarray(group_names, dtype=str), return_inverse=True);
+    totals = np.bincount(group_index, weights=moments, minlength=len(names));
+    return {str(name): float(total) for name, total in zip(names, totals)};
+
+
+def get_region_mask(region, lon, lat, fault_names):
+    """
+    Which patches belong to a region. A region may restrict fault names, a bounding box [W, E, S, N], or both.
+    Bounding boxes include their edges.
+    """
+    mask = np.ones(np.shape(lon), dtype=bool);
+    if "fault_names" in region:
+        mask &= np.isin(np.asarray(fault_names, dtype=str), region["fault_names"]);
+    if "bbox" in region:
+        W, E, S, N = region["bbox"];
+        mask &= (lon >= W) & (lon <= E) & (lat >= S) & (lat <= N);
+    return mask;
+
+
+def region_moments(moments, lon, lat, fault_names, regions):
+    """
+    Total moment in each region. Regions may overlap.
+
+    :param moments: array of patch moments
+    :param lon: array of patch longitudes
+    :param lat: array of patch latitudes
+    :param fault_names: list of fault names, one per patch
+    :param regions: list of region dictionaries
+    :returns: array of moments, one per region, N-m
+    """
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float);
+    masks = np.array([get_region_mask(region, lon, lat, fault_names) for region in regions], dtype=float);
+    return masks.dot(moments);
+
+
+def gf_elements_to_patch_arrays(values, GF_elements, slip_multiplier=0.01):
+    """
+    Flatten the fault patches of GF_elements and their modeled slip into arrays, for moment accounting.
+
+    :param values: model vector, one value for each GF_element
+    :param GF_elements: list of GF_element objects
+    :param slip_multiplier: converts model values into m of slip, default cm to m
+    :returns: lon, lat, length (m), width (m), slip (m), fault names; one element per fault patch
+    """
+    lon, lat, length, width, slip, names = [], [], [], [], [], [];
+    for value, gf_element in zip(values, GF_elements):
+        for patch in gf_element.fault_dict_list:
+            lon.append(patch["lon"]);
+            lat.append(patch["lat"]);
+            length.append(patch["length"] * 1000);  # km to m
+            width.append(patch["width"] * 1000);  # km to m
+            slip.append(value * slip_multiplier);
+            names.append(gf_element.fault_name);
+    return np.array(lon), np.array(lat), np.array(length), np.array(width), np.array(slip), names;
+
+
+def get_gf_element_region_moments(values, GF_elements, regions, mu=30e9, slip_multiplier=0.01):
+    """Moment of each region from a model vector and its GF_elements. Returns array of moments, N-m."""
+    lon, lat, length, width, slip, names = gf_elements_to_patch_arrays(values, GF_elements, slip_multiplier);
+    moments = patch_moments(length, width, slip, mu);
+    return region_moments(moments, lon, lat, names, regions);
+
+
+def get_gf_element_fault_moments(values, GF_elements, mu=30e9, slip_multiplier=0.01):
+    """Moment of each fault from a model vector and its GF_elements. Returns dictionary of {fault name: N-m}."""
+    _, _, length, width, slip, names = gf_elements_to_patch_arrays(values, GF_elements, slip_multiplier);
+    return grouped_moments(patch_moments(length, width, slip, mu), names);
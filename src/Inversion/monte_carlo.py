@@ -0,0 +1,110 @@
+"""
+Monte Carlo uncertainty for bounded (and non-negative) linear inversions.
+All noise realizations are drawn at once, every realization is re-solved exactly with the same bounds and
+the same solvers as the drivers (NNLS or BVLS on G itself), and the realizations can run in parallel across processes.
+The spread of the resulting models gives percentiles and a covariance for each model parameter.
+"""
+
+import collections
+import concurrent.futures
+import numpy as np
+import scipy.optimize
+
+# models: array (n_realizations x n_params).  mean, std: one per parameter.
+# percentiles: array (len(percentile_levels) x n_params).  covariance: (n_params x n_params).
+MonteCarloResult = collections.namedtuple('MonteCarloResult', ['models', 'mean', 'std', 'percentile_levels',
+                                                               'percentiles', 'covariance']);
+
+
+def get_noise_matrix(noise_sigmas, n_realizations, seed=None):
+    """
+    All noise realizations at once.
+
+    :param noise_sigmas: 1D array, standard deviation of the noise on each row of d (zero for regularization rows)
+    :param n_realizations: int
+    :param seed: optional int, for repeatable draws
+    :returns: array (n_realizations x len(noise_sigmas))
+    """
+    rng = np.random.default_rng(seed);
+    return rng.standard_normal((n_realizations, len(noise_sigmas))) * np.asarray(noise_sigmas)[np.newaxis, :];
+
+
+def solve_bounded(G, d, lb, ub):
+    """
+    Bounded least squares, min ||G m - d|| with lb <= m <= ub, solved on G itself (not the normal equations).
+    Non-negative problems use NNLS, like reg_nnls; other bounds use BVLS, like the drivers.
+
+    :param G: 2D array
+    :param d: 1D array
+    :param lb: 1D array of lower bounds, one per parameter
+    :param ub: 1D array of upper bounds, one per parameter
+    :returns: model vector
+    """
+    if np.all(lb == 0) and np.all(np.isposinf(ub)):
+        return scipy.optimize.nnls(G, d)[0];
+    response = scipy.optimize.lsq_linear(G, d, bounds=(lb, ub), max_iter=1500, method='bvls');
+    if not response.success:
+        print("Warning! Bounded re-inversion did not converge: " + response.message);
+    return response.x;
+
+
+def solve_realization_chunk(args):
+    """One process-pool job: solve a chunk of problems, given their data vectors"""
+    G, D_chunk, lb, ub = args;
+    return np.array([solve_bounded(G, d, lb, ub) for d in D_chunk]);
+
+
+def solve_many_bounded(G, D, bounds=(0, np.inf), num_workers=1, chunk_size=25):
+    """
+    Solve many bounded least-squares problems that share one G, each with its own data vector.
+    Every problem is solved exactly from scratch, so the answers do not depend on a starting model.
+
+    :param G: 2D array
+    :param D: array (n_problems x n_rows), one data vector per row
+    :param bounds: (lb, ub), scalars or arrays
+    :param num_workers: int, number of processes. With 1, problems are solved in this process.
+    :param chunk_size: int, problems per process-pool job
+    :returns: array (n_problems x n_params) of models
+    """
+    G = np.asarray(G, dtype=float);
+    D = np.asarray(D, dtype=float);
+    lb, ub = get_bounds(bounds, np.shape(G)[1]);
+    jobs = [(G, D[i:i + chunk_size], lb, ub) for i in range(0, len(D), chunk_size)];
+    if num_workers > 1 and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            chunks = list(executor.map(solve_realization_chunk, jobs));
+    else:
+        chunks = [solve_realization_chunk(job) for job in jobs];
+    return np.concatenate(chunks, axis=0);
+
+
+def get_bounds(bounds, n_params):
+    """Lower and upper bound arrays, one entry per parameter, from (lb, ub) scalars or from (lb_array, ub_array)"""
+    lb = np.array(np.broadcast_to(np.asarray(bounds[0], dtype=float), (n_params,)));
+    ub = np.array(np.broadcast_to(np.asarray(bounds[1], dtype=float), (n_params,)));
+    return lb, ub;
+
+
+def monte_carlo_uncertainty(G, d, noise_sigmas, bounds=(0, np.inf), n_realizations=100, num_workers=1, chunk_size=25,
+                            seed=None, percentile_levels=(2.5, 16, 50, 84, 97.5)):
+    """
+    Re-solve a bounded inversion for many noisy versions of the data.
+
+    :param G: 2D array, weighted G including regularization rows
+    :param d: 1D array, weighted data vector including regularization rows (zeros)
+    :param noise_sigmas: 1D array, noise on each row of d in the same weighted units (zero for regularization rows)
+    :param bounds: (lb, ub), scalars or arrays. Default is non-negative, like NNLS.
+    :param n_realizations: int
+    :param num_workers: int, number of processes. With 1, realizations are solved in this process.
+    :param chunk_size: int, realizations per process-pool job
+    :param seed: optional int
+    :param percentile_levels: tuple of percentiles to report
+    :returns: MonteCarloResult
+    """
+    noisy_d = np.asarray(d, dtype=float)[np.newaxis, :] + get_noise_matrix(noise_sigmas, n_realizations, seed);
+    print("Monte Carlo uncertainty: %d realizations, %d parameters" % (n_realizations, np.shape(G)[1]));
+    models = solve_many_bounded(G, noisy_d, bounds, num_workers, chunk_size);
+    return MonteCarloResult(models=models, mean=np.mean(models, axis=0), std=np.std(models, axis=0, ddof=1),
+                            percentile_levels=list(percentile_levels),
+                            percentiles=np.percentile(models, percentile_levels, axis=0),
+                            covariance=np.cov(models, rowvar=False));
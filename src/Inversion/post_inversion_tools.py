@@ -3,8 +3,9 @@ A set of functions for dealing with multiple inversion runs together,
 such as L-curve analysis
 """
 
-import glob, json
+import glob, json, os
 from . import l_curve_plots
+from . import run_index
 
 
 def read_param_from_list_of_config_files(filelist, paramname):
@@ -70,6 +71,8 @@ def glob_and_drive_1d_lcurve(target_dir='.', name_of_printed_config="configs_use
                              outname="smoothing_curve.png", xlabel="Smoothing", corner_point=None):
     """
     Get every smoothing parameter in a directory where smoothing experiment has been run multiple times.
+    If the directory has a run index, parameters and misfits come from one query of the index.
+    Otherwise, each results file is paired with the config file in its own directory.
 
     :param target_dir: directory name
     :param name_of_printed_config: file name
@@ -78,11 +81,23 @@ def glob_and_drive_1d_lcurve(target_dir='.', name_of_printed_config="configs_use
     :param misfitname: string, found within results_file
     :param outname: string
     :param xlabel: string
-    :param corner_point: float, optional x-location where an annotation will be drawn
+    :param corner_point: float, optional x-location where an annotation will be drawn.
+        'curvature' or 'triangle' finds the corner automatically from the run index.
     """
-    config_files = glob.glob(target_dir+"/**/"+name_of_printed_config);
-    results_files = glob.glob(target_dir + "/**/" + name_of_results_file);
-    smoothings = read_param_from_list_of_config_files(config_files, paramname);
-    misfits = read_misfits_from_list_of_files(results_files, misfitname);
+    if run_index.has_run_index(target_dir):
+        params, misfits, model_norms = run_index.get_curve_points(target_dir, [paramname], misfitname);
+        smoothings = [x[0] for x in params];
+        if corner_point in ('curvature', 'triangle'):
+            corner_point = l_curve_plots.get_auto_corner(smoothings, misfits, model_norms, corner_point);
+    else:
+        results_files = sorted(glob.glob(target_dir + "/**/" + name_of_results_file));
+        results_files = [x for x in results_files if os.path.isfile(os.path.join(os.path.dirname(x),
+                                                                                 name_of_printed_config))];
+        config_files = [os.path.join(os.path.dirname(x), name_of_printed_config) for x in results_files];
+        smoothings = read_param_from_list_of_config_files(config_files, paramname);
+        misfits = [read_misfits_from_list_of_files([x], misfitname)[0] for x in results_files];
+        if corner_point in ('curvature', 'triangle'):
+            print("Automatic corner needs model norms from a run index. Not drawing a corner.");
+            corner_point = None;
     l_curve_plots.plot_1d_curve(smoothings, misfits, xlabel, outname, corner_point);
     return;
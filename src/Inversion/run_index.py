@@ -0,0 +1,98 @@
+"""
+A run index for parameter sweeps, like L-curve analysis.
+Each inversion adds one row (parameters, misfits, model norm, runtime, solver status) to a SQLite file
+in the sweep's root directory. Harvesting a sweep is then one query, instead of globbing and parsing text files.
+"""
+
+import os
+import json
+import sqlite3
+import datetime
+import collections
+
+RUN_INDEX_NAME = "run_index.sqlite";
+
+# params and misfits are dictionaries; the rest are scalars. One row per run directory.
+RunRecord = collections.namedtuple('RunRecord', ['run_dir', 'params', 'misfits', 'model_norm', 'runtime', 'status',
+                                                 'timestamp']);
+
+
+def get_index_filename(sweep_dir):
+    return os.path.join(sweep_dir, RUN_INDEX_NAME);
+
+
+def open_run_index(sweep_dir):
+    """Open (and if necessary create) the run index of a sweep directory. Returns a sqlite3 connection."""
+    os.makedirs(sweep_dir, exist_ok=True);
+    connection = sqlite3.connect(get_index_filename(sweep_dir), timeout=60);  # runs may finish at the same time
+    connection.execute("CREATE TABLE IF NOT EXISTS runs (run_dir TEXT PRIMARY KEY, params TEXT, misfits TEXT, "
+                       "model_norm REAL, runtime REAL, status TEXT, timestamp TEXT)");
+    return connection;
+
+
+def append_run(sweep_dir, run_dir, params, misfits, model_norm=None, runtime=None, status=''):
+    """
+    Record one run in the index. Re-running into the same run_dir replaces its row.
+
+    :param sweep_dir: string, root directory of the sweep, where the index lives
+    :param run_dir: string, output directory of this run
+    :param params: dictionary of parameter values, like {"alpha": 2, "penalty": 0.5}
+    :param misfits: dictionary of misfit values, like {"rms": 0.002, "normalized_misfit": 1.3}
+    :param model_norm: float, the norm that the swept parameter regularizes, like the slip norm or ||L m||
+    :param runtime: float, seconds
+    :param status: string, solver status message
+    """
+    connection = open_run_index(sweep_dir);
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (os.path.normpath(run_dir), json.dumps(params, sort_keys=True, default=float),
+                            json.dumps(misfits, sort_keys=True, default=float),
+                            None if model_norm is None else float(model_norm),
+                            None if runtime is None else float(runtime), str(status),
+                            datetime.datetime.now().isoformat()));
+    connection.close();
+    print("Recording run %s in %s" % (run_dir, get_index_filename(sweep_dir)));
+    return;
+
+
+def read_runs(sweep_dir, status=None):
+    """
+    All runs in the index of a sweep directory, in one query, ordered by run directory.
+
+    :param sweep_dir: string
+    :param status: optional string; if given, only runs with this solver status
+    :returns: list of RunRecord
+    """
+    connection = open_run_index(sweep_dir);
+    query = "SELECT run_dir, params, misfits, model_norm, runtime, status, timestamp FROM runs";
+    if status is None:
+        rows = connection.execute(query + " ORDER BY run_dir").fetchall();
+    else:
+        rows = connection.execute(query + " WHERE status = ? ORDER BY run_dir", (status,)).fetchall();
+    connection.close();
+    return [RunRecord(run_dir=row[0], params=json.loads(row[1]), misfits=json.loads(row[2]), model_norm=row[3],
+                      runtime=row[4], status=row[5], timestamp=row[6]) for row in rows];
+
+
+def get_curve_points(sweep_dir, param_names, misfit_name):
+    """
+    Parameters and one misfit from every run in a sweep, for L-curve plots.
+    Runs missing any of the requested values are skipped.
+
+    :param sweep_dir: string
+    :param param_names: list of parameter names
+    :param misfit_name: string
+    :returns: list of [param values] for each run, list of misfits, list of model norms
+    """
+    params_array, misfit_array, norm_array = [], [], [];
+    for run in read_runs(sweep_dir):
+        if misfit_name not in run.misfits or not all(name in run.params for name in param_names):
+            continue;
+        params_array.append([run.params[name] for name in param_names]);
+        misfit_array.append(run.misfits[misfit_name]);
+        norm_array.append(run.model_norm);
+    return params_array, misfit_array, norm_array;
+
+
+def has_run_index(sweep_dir):
+    return os.path.isfile(get_index_filename(sweep_dir));
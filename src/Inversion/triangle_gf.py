@@ -0,0 +1,137 @@
+"""
+Green's functions for a whole triangular fault mesh at once,
+computed with cutde (triangular dislocations in a halfspace).
+The result is one array over all stations and triangles, ready to be assembled into G,
+rather than one GF_element of disp_points for each triangle.
+"""
+
+import collections
+import concurrent.futures
+import numpy as np
+import cutde.halfspace
+import Elastic_stresses_py.PyCoulomb.fault_slip_triangle as fst
+from . import inversion_tools
+
+# gf: array (n_stations, 3, n_triangles, 3), displacement [E, N, U] at each station per unit slip of each triangle.
+#     Slip components are [right-lateral strike-slip, dip-slip, tensile]. Units: m of displacement per m of slip.
+# lon, lat: arrays of station coordinates.  ref_lon, ref_lat: origin of the local Cartesian frame.
+# fault_triangles: the triangles, in the same order as axis 2 of gf.
+TriangleGF = collections.namedtuple('TriangleGF', ['gf', 'lon', 'lat', 'ref_lon', 'ref_lat', 'fault_triangles']);
+
+# Which of [E, N, U] are observed at each type of point, same logic as inversion_tools.get_displacement_directions
+COMPONENT_MASKS = {"continuous": (True, True, True),
+                   "survey": (True, True, False),
+                   "leveling": (False, False, True),
+                   "tide_gage": (False, False, True)};
+
+
+def lonlat_to_local_xy(lon, lat, ref_lon, ref_lat):
+    """Flat-earth local coordinates (m) of points relative to a reference point. Fine for a local mesh."""
+    x = (np.asarray(lon, dtype=float) - ref_lon) * 111.32e3 * np.cos(np.deg2rad(ref_lat));
+    y = (np.asarray(lat, dtype=float) - ref_lat) * 111.32e3;
+    return x, y;
+
+
+def get_triangle_vertices(fault_triangles, ref_lon, ref_lat):
+    """
+    Vertices of all triangles in one local frame.
+    Each triangle's vertices are [x, y, z] in m relative to that triangle's own lon/lat.
+
+    :returns: array (n_triangles, 3, 3) of vertices in m, relative to ref_lon, ref_lat
+    """
+    vertices = np.array([[tri["vertex1"], tri["vertex2"], tri["vertex3"]] for tri in fault_triangles], dtype=float);
+    x_shift, y_shift = lonlat_to_local_xy([tri["lon"] for tri in fault_triangles],
+                                          [tri["lat"] for tri in fault_triangles], ref_lon, ref_lat);
+    vertices[:, :, 0] += x_shift[:, np.newaxis];
+    vertices[:, :, 1] += y_shift[:, np.newaxis];
+    return vertices;
+
+
+def compute_chunk_disp_matrix(args):
+    """One process-pool job: the displacement matrix of all stations for one chunk of triangles"""
+    obs_pts, tri_vertices, poisson_ratio = args;
+    return cutde.halfspace.disp_matrix(obs_pts=obs_pts, tris=tri_vertices, nu=poisson_ratio);
+
+
+def compute_triangle_gfs(fault_triangles, lons, lats, poisson_ratio=0.25, chunk_size=500, num_workers=1):
+    """
+    Compute the Green's function tensor of a whole triangular mesh at a whole array of stations.
+
+    :param fault_triangles: list of triangle fault dictionaries
+    :param lons: array of station longitudes
+    :param lats: array of station latitudes
+    :param poisson_ratio: float
+    :param chunk_size: int, number of triangles in each job
+    :param num_workers: int, number of processes. With 1, chunks are computed in this process.
+    :returns: TriangleGF
+    """
+    ref_lon, ref_lat = fault_triangles[0]["lon"], fault_triangles[0]["lat"];
+    x, y = lonlat_to_local_xy(lons, lats, ref_lon, ref_lat);
+    obs_pts = np.column_stack((x, y, np.zeros(np.shape(x))));  # stations at the surface
+    tri_vertices = get_triangle_vertices(fault_triangles, ref_lon, ref_lat);
+    jobs = [(obs_pts, tri_vertices[i:i + chunk_size], poisson_ratio) for i in range(0, len(tri_vertices), chunk_size)];
+    print("Computing triangle GFs: %d stations, %d triangles, %d chunks" % (len(obs_pts), len(tri_vertices),
+                                                                              len(jobs)));
+    if num_workers > 1 and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            chunks = list(executor.map(compute_chunk_disp_matrix, jobs));
+    else:
+        chunks = [compute_chunk_disp_matrix(job) for job in jobs];
+    gf = np.concatenate(chunks, axis=2);  # (n_stations, 3, n_triangles, 3)
+    gf[:, :, :, 0] = -gf[:, :, :, 0];  # cutde strike-slip is positive left-lateral; we use right-lateral
+    return TriangleGF(gf=gf, lon=np.asarray(lons, dtype=float), lat=np.asarray(lats, dtype=float), ref_lon=ref_lon,
+                      ref_lat=ref_lat, fault_triangles=fault_triangles);
+
+
+def get_component_mask(obs_disp_points):
+    """Boolean array (n_stations, 3) of which [E, N, U] components enter the observation vector"""
+    return np.array([COMPONENT_MASKS.get(item.meas_type, (True, True, True)) for item in obs_disp_points]);
+
+
+def build_G_from_triangle_gfs(triangle_gf, obs_disp_points, slip_components=(0,)):
+    """
+    Assemble G from the Green's function tensor. Rows follow inversion_tools.build_obs_vector:
+    station by station, with the components observed at each station.
+    Columns go triangle by triangle, with each requested slip component.
+
+    :param triangle_gf: TriangleGF computed at the locations of obs_disp_points
+    :param obs_disp_points: list of disp_points, same order as the stations of triangle_gf
+    :param slip_components: which slip components become model parameters. 0 = right-lateral, 1 = dip, 2 = tensile.
+    :returns: 2D array G
+    """
+    n_stations, _, n_triangles, _ = np.shape(triangle_gf.gf);
+    if len(obs_disp_points) != n_stations:
+        raise ValueError("Error! %d observations but GFs for %d stations." % (len(obs_disp_points), n_stations));
+    G = triangle_gf.gf[:, :, :, list(slip_components)].reshape(n_stations * 3, n_triangles * len(slip_components));
+    return G[get_component_mask(obs_disp_points).ravel()];
+
+
+def check_against_triangle_okada(triangle_gf, obs_disp_points, G, n_check=3, poisson_ratio=0.25, rtol=0.01):
+    """
+    Compare a few columns of the batched G against the original per-triangle path
+    (triangle_okada.compute_disp_points_from_triangles, then inversion_tools.buildG_column).
+    This catches mistakes in the vertex frame, the depth sign, the projection, or the right-lateral sign.
+    Assumes G was built with slip_components=(0,) from triangles carrying unit right-lateral slip.
+
+    :param triangle_gf: TriangleGF
+    :param obs_disp_points: list of disp_points, same order as the stations of triangle_gf
+    :param G: 2D array from build_G_from_triangle_gfs, before weighting by sigmas
+    :param n_check: int, number of triangles to check, spread across the mesh
+    :param poisson_ratio: float
+    :param rtol: float, largest allowed difference relative to the largest displacement of the column
+    :returns: largest relative difference found
+    """
+    n_triangles = len(triangle_gf.fault_triangles);
+    worst = 0;
+    for i in np.unique(np.linspace(0, n_triangles - 1, min(n_check, n_triangles)).astype(int)):
+        model_disp_pts = fst.triangle_okada.compute_disp_points_from_triangles([triangle_gf.fault_triangles[i]],
+                                                                               obs_disp_points,
+                                                                               poisson_ratio=poisson_ratio);
+        old_column = inversion_tools.buildG_column(model_disp_pts, obs_disp_points)[:, 0];
+        difference = np.max(np.abs(G[:, i] - old_column)) / max(np.max(np.abs(old_column)), 1e-12);
+        worst = max(worst, difference);
+        if difference > rtol:
+            raise ValueError("Error! Batched GF of triangle %d differs from triangle_okada by %.3g (relative)."
+                             % (i, difference));
+    print("Batched triangle GFs match triangle_okada within %.3g (relative)" % worst);
+    return worst;
@@ -3,21 +3,62 @@ Several functions (research code) for io of leveling data, including CEC Salton
 Some input functions also exist in specific project directories instead of being consolidated here
 """
 
-import collections, pandas
+import collections, pandas, os
 import datetime as dt
 import numpy as np
+from .. import cache_utilities
 
 LevStation = collections.namedtuple("LevStation", ["name", "lat", "lon", "dtarray", "leveling", "reflon", "reflat"]);
 # LevStation: list-of-objects format, one object for each station. Units of meters.
+LevNetwork = collections.namedtuple("LevNetwork", ["names", "lat", "lon", "dtarray", "leveling", "reflon", "reflat"]);
+# LevNetwork: columnar format for a whole network sharing one dtarray. Units of meters.
+# names: list of strings.  lat, lon: 1D arrays (n_stations).  dtarray: list of datetimes (n_dates).
+# leveling: 2D float array (n_stations x n_dates), nan where there's no data.  reflon, reflat: floats.
 
 
-def inputs_brawley_leveling(data_filename, errors_filename):
+def lev_list_to_network(LevList):
+    """Convert a list of LevStation objects (all with the same dtarray) into one LevNetwork"""
+    return LevNetwork(names=[x.name for x in LevList], lat=np.array([x.lat for x in LevList], dtype=float),
+                      lon=np.array([x.lon for x in LevList], dtype=float), dtarray=list(LevList[0].dtarray),
+                      leveling=np.array([x.leveling for x in LevList], dtype=float),
+                      reflon=LevList[0].reflon, reflat=LevList[0].reflat);
+
+
+def network_to_lev_list(network):
+    """Convert a LevNetwork back into a list of LevStation objects"""
+    LevStationList = [];
+    for i, name in enumerate(network.names):
+        new_object = LevStation(name=name, lat=network.lat[i], lon=network.lon[i], dtarray=network.dtarray,
+                                leveling=network.leveling[i].tolist(), reflon=network.reflon, reflat=network.reflat);
+        LevStationList.append(new_object);
+    return LevStationList;
+
+
+def inputs_brawley_leveling(data_filename, errors_filename, cache_dir=None):
     """
     Read leveling from CEC Salton Trough North Brawley leveling data
     Yes this is research code, but I'll keep this inside in case the leveing data type changes.
     """
+    return network_to_lev_list(inputs_brawley_leveling_network(data_filename, errors_filename, cache_dir));
+
+
+def inputs_brawley_leveling_network(data_filename, errors_filename, cache_dir=None):
+    """
+    Read CEC Salton Trough North Brawley leveling data into a LevNetwork.
+    If cache_dir is given, the parsed network is cached there, keyed by the contents of the spreadsheet and error file,
+    so repeated reads skip the Excel parsing.
+    """
+    if cache_dir is not None:
+        key = cache_utilities.combined_hash({"reader": "brawley"}, [data_filename, errors_filename]);
+        cache_name = "leveling_" + os.path.basename(data_filename);
+        found, network = cache_utilities.read_cached_object(cache_dir, cache_name, key);
+        if found:
+            print("Reading cached leveling for %s" % data_filename);
+            return network;
+
     print("Reading in %s" % data_filename);
-    df = pandas.read_excel(data_filename, engine='openpyxl');
+    sheets = pandas.read_excel(data_filename, engine='openpyxl', sheet_name=[0, 2]);  # one pass through the file
+    df, lonlat_sheet = sheets[0], sheets[2];
     column_names = df.columns[1:-1].tolist();
 
     # Fix typos in metadata and data
@@ -30,20 +71,23 @@ def inputs_brawley_leveling(data_filename, errors_filename):
     names = df['BENCHMARK'].values.tolist();
 
     # Reading lat/lon information
-    lonlat_sheet = pandas.read_excel(data_filename, engine='openpyxl', sheet_name=2);
     ll_names = lonlat_sheet['Benchmark'].values.tolist();
-    longitudes = [float(x) for x in lonlat_sheet['Longitude'].values.tolist()];
-    latitudes = [float(x) for x in lonlat_sheet['Latitude'].values.tolist()];
+    longitudes = lonlat_sheet['Longitude'].to_numpy(dtype=float).tolist();
+    latitudes = lonlat_sheet['Latitude'].to_numpy(dtype=float).tolist();
     names, lons, lats = match_lon_lat(names, latitudes, longitudes, ll_names);
 
-    LevStationList = [];
-    for x in range(0, 83):
-        single_leveling_array = df.loc[x][1:-1].tolist();
-        single_leveling_array = clean_single_ts(single_leveling_array);
-        new_object = LevStation(name=names[x], lon=lons[x], lat=lats[x], dtarray=dtarray,
-                                leveling=single_leveling_array, reflon=lons[0], reflat=lats[0]);
-        LevStationList.append(new_object);
-    return LevStationList;
+    leveling = clean_leveling_frame(df.iloc[0:83, 1:-1], ["-", "DESTROYED", "DAMAGED", "NOT", "FOUND"]);
+    network = LevNetwork(names=names[0:83], lat=np.array(lats[0:83]), lon=np.array(lons[0:83]), dtarray=dtarray,
+                         leveling=leveling, reflon=lons[0], reflat=lats[0]);
+    if cache_dir is not None:
+        cache_utilities.write_cached_object(cache_dir, cache_name, key, network);
+    return network;
+
+
+def clean_leveling_frame(df, sentinels):
+    """Replace sentinel strings (like DESTROYED) with nan across a whole block of a spreadsheet.
+    Returns a 2D float array."""
+    return df.replace(sentinels, np.nan).to_numpy(dtype=float);
 
 
 def read_cec_leveling_errors(error_filename, data_filename):
@@ -70,17 +114,20 @@ def read_cec_leveling_errors(error_filename, data_filename):
 
 
 def implement_changes_dataframe(df, corrtype, rownum, colnum, new_values):
-    """Implement Data changes to array of data"""
+    """Implement Data changes to array of data, all at once"""
     print("Implementing changes to data:");
-    for i in range(len(rownum)):
-        if corrtype[i] == 'Metadata':
-            continue;
-        col_names = df.columns[0:-1].tolist();
-        print("Finding error in column %s" % col_names[colnum[i]-1])  # get the right column
-        old_value = df.iloc[rownum[i]-2, colnum[i]-1];
-        df.iloc[rownum[i]-2, colnum[i]-1] = new_values[i];  # assignment
-        print("   Carefully replacing data %s with %s" % (old_value, new_values[i]) );
-    return df;
+    data_changes = [i for i in range(len(rownum)) if corrtype[i] != 'Metadata'];
+    if len(data_changes) == 0:
+        return df;
+    rows = np.array([rownum[i] - 2 for i in data_changes]);
+    cols = np.array([colnum[i] - 1 for i in data_changes]);  # one-indexed column numbers, skipping the name column
+    values = df.to_numpy(dtype=object, copy=True);
+    col_names = df.columns.tolist();
+    for row, col, i in zip(rows, cols, data_changes):
+        print("Finding error in column %s" % col_names[col]);
+        print("   Carefully replacing data %s with %s" % (values[row, col], new_values[i]));
+    values[rows, cols] = [new_values[i] for i in data_changes];  # assignment
+    return pandas.DataFrame(values, index=df.index, columns=df.columns);
 
 
 def implement_changes_colnames(column_names, corrtype, rownum, colnum, new_values):
@@ -123,92 +170,88 @@ def match_lon_lat(names, lats, lons, ll_names):
 
 
 def clean_single_ts(array):
-    newarray = [];
-    for i in range(len(array)):
-        if str(array[i]) == "-" or str(array[i]) == "DESTROYED" or str(array[i]) == "DAMAGED" or str(
-                array[i]) == "NOT" or str(array[i]) == "FOUND":
-            newarray.append(np.nan);
-        else:
-            newarray.append(float(array[i]));
-    return newarray;
+    return clean_leveling_frame(pandas.DataFrame([array]), ["-", "DESTROYED", "DAMAGED", "NOT", "FOUND"])[0].tolist();
 
 
 # LEVELING COMPUTE FUNCITON (REFERENCE TO DATUM)
 def compute_rel_to_datum_nov_2009(data):
     """Skips the 2008 measurement. Returns an object that is 83x10"""
-    RefLevStations = [];
-    for station in data:
-
-        # Automatically find the first day that matters.  Either after 2008 or has data.
-        idx = 0;
-        for j in range(len(station.dtarray)):
-            if ~np.isnan(station.leveling[j]) and station.dtarray[j] > dt.datetime.strptime("2009-01-01", "%Y-%m-%d"):
-                idx = j;  # this is the first date after 2009 that has data
-                break;
-
-        # Accounting for a change in Datum height in 2014
-        idx_early = 6;  # the placement of 2014 before adjustment on the spreadsheet
-        idx_late = 7;  # the placement of 2014 after adjustment on the spreadsheet
-        step = station.leveling[idx_early] - station.leveling[idx_late];
-
-        referenced_dates, referenced_data = [], [];
-        for j in range(1, len(station.dtarray)):  # skipping 2008 anyway.
-            if j == 6:
-                continue;  # passing over the 2014 measurement before re-referencing.
-            if station.dtarray[j] > dt.datetime.strptime("2014-01-01", "%Y-%m-%d"):
-                referenced_dates.append(station.dtarray[j]);
-                referenced_data.append(station.leveling[j] - station.leveling[idx] + step);
-            else:
-                referenced_dates.append(station.dtarray[j]);
-                referenced_data.append(station.leveling[j] - station.leveling[idx]);
-
-        referenced_object = LevStation(name=station.name, lon=station.lon, lat=station.lat, dtarray=referenced_dates,
-                                       leveling=referenced_data, reflon=station.reflon, reflat=station.reflat);
-        RefLevStations.append(referenced_object);
-    return RefLevStations;
+    network = compute_rel_to_datum_nov_2009_network(lev_list_to_network(data));
+    return network_to_lev_list(network);
+
+
+def compute_rel_to_datum_nov_2009_network(network):
+    """
+    Skips the 2008 measurement and the 2014 measurement before the datum adjustment. Returns a LevNetwork.
+    Each station is referenced to its first date after 2009 that has data,
+    and dates after 2014 are shifted by the step in datum height.
+    """
+    dtarray = network.dtarray;
+
+    # Automatically find the first day that matters.  Either after 2008 or has data.
+    after_2009 = np.array([x > dt.datetime.strptime("2009-01-01", "%Y-%m-%d") for x in dtarray]);
+    valid = ~np.isnan(network.leveling) & after_2009[np.newaxis, :];
+    idx = np.where(np.any(valid, axis=1), np.argmax(valid, axis=1), 0);
+    reference_values = network.leveling[np.arange(len(network.names)), idx];
+
+    # Accounting for a change in Datum height in 2014
+    idx_early = 6;  # the placement of 2014 before adjustment on the spreadsheet
+    idx_late = 7;  # the placement of 2014 after adjustment on the spreadsheet
+    step = network.leveling[:, idx_early] - network.leveling[:, idx_late];
+
+    # skipping 2008 anyway, and passing over the 2014 measurement before re-referencing.
+    kept_columns = [j for j in range(1, len(dtarray)) if j != idx_early];
+    referenced_dates = [dtarray[j] for j in kept_columns];
+    after_2014 = np.array([x > dt.datetime.strptime("2014-01-01", "%Y-%m-%d") for x in referenced_dates]);
+    referenced_data = network.leveling[:, kept_columns] - reference_values[:, np.newaxis];
+    referenced_data = referenced_data + np.where(after_2014[np.newaxis, :], step[:, np.newaxis], 0);
+    return network._replace(dtarray=referenced_dates, leveling=referenced_data);
 
 
 # HEBER DATA SPREADSHEET
-def inputs_leveling_heber(infile):
+def inputs_leveling_heber(infile, cache_dir=None):
     """
     CEC HEBER LEVELING SPREADSHEET INTO LIST OF LEVELING OBJECTS.
     """
-    station_list = [];
+    station_list = network_to_lev_list(inputs_leveling_heber_network(infile, cache_dir));
+    print("Returning %d leveling stations " % len(station_list));
+    return station_list;
+
+
+def inputs_leveling_heber_network(infile, cache_dir=None):
+    """
+    CEC HEBER LEVELING SPREADSHEET INTO A LevNetwork, optionally cached by the contents of the spreadsheet.
+    """
+    if cache_dir is not None:
+        key = cache_utilities.combined_hash({"reader": "heber"}, [infile]);
+        cache_name = "leveling_" + os.path.basename(infile);
+        found, network = cache_utilities.read_cached_object(cache_dir, cache_name, key);
+        if found:
+            print("Reading cached leveling for %s" % infile);
+            return network;
+
     print("Reading in %s" % infile);
+    sheets = pandas.read_excel(infile, sheet_name=[0, 1]);  # one pass through the file
 
     # Get locations of benchmarks and reference benchmark, with the reference in the first line.
-    df = pandas.read_excel(infile, sheet_name=1);
-    locnames, all_lons, all_lats = [], [], [];
-    names = df['BENCHMARKS HEBER'].values.tolist();
-    lats_temp = df['Lat'].values.tolist();
-    lons_temp = df['Lon'].values.tolist();
-    for i in range(len(lats_temp)):
-        if lats_temp[i] != "":
-            latstring = str(lats_temp[i]).replace('..', '.');
-            lonstring = str(lons_temp[i]).replace('..', '.');
-            locnames.append(names[i]);
-            all_lats.append(float(latstring));
-            all_lons.append(float(lonstring));
-    reflat = all_lats[0];
-    reflon = all_lons[0];
+    df = sheets[1];
+    has_location = (df['Lat'] != "").to_numpy();
+    locnames = df['BENCHMARKS HEBER'][has_location].tolist();
+    all_lats = df['Lat'][has_location].astype(str).str.replace('..', '.', regex=False).astype(float).to_numpy();
+    all_lons = df['Lon'][has_location].astype(str).str.replace('..', '.', regex=False).astype(float).to_numpy();
 
     # # Get leveling data from the spreadsheet
-    df = pandas.read_excel(infile, sheet_name=0);
+    df = sheets[0];
     dtstrings = df.iloc[31:56, 0].tolist();
     dtarray = [dt.datetime.strptime(x, "%b %Y") for x in dtstrings];
 
-    # Extract each station's leveling data
-    for colnum in range(5, 163):  # for each station's leveling data
-        station_name = df.iloc[30][colnum];  # the string station name
-        levarray = [];
-        for i in range(31, 56):
-            if df.iloc[i][colnum] in ["DESTROYED", "", "NOT FOUND", "?", "UNACCESSABLE ", "LOST"]:
-                levarray.append(np.nan);
-            else:
-                levarray.append(float(df.iloc[i][colnum]));
-        station_lon_idx = locnames.index(station_name);
-        new_station = LevStation(name=station_name, lat=all_lats[station_lon_idx], lon=all_lons[station_lon_idx],
-                                 dtarray=dtarray, leveling=levarray, reflon=reflon, reflat=reflat);
-        station_list.append(new_station);
-    print("Returning %d leveling stations " % len(station_list));
-    return station_list;
+    # Extract all stations' leveling data, one column per station
+    station_names = df.iloc[30, 5:163].tolist();  # the string station names
+    leveling = clean_leveling_frame(df.iloc[31:56, 5:163],
+                                    ["DESTROYED", "", "NOT FOUND", "?", "UNACCESSABLE ", "LOST"]).T;
+    station_idx = [locnames.index(x) for x in station_names];
+    network = LevNetwork(names=station_names, lat=all_lats[station_idx], lon=all_lons[station_idx], dtarray=dtarray,
+                         leveling=leveling, reflon=all_lons[0], reflat=all_lats[0]);
+    if cache_dir is not None:
+        cache_utilities.write_cached_object(cache_dir, cache_name, key, network);
+    return network;
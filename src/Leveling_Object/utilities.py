@@ -1,6 +1,4 @@
-
 import numpy as np
-from scipy import stats
 from . import leveling_inputs
 
 
@@ -12,16 +10,19 @@ def get_onetime_displacements(LevList, start_index, end_index):
     Sign convention of (end - start) displacements.
     Should eventually re-write this for datetimes instead of indices.
     """
-    dtarray, new_station_list = [], [];
-    dtarray.append(LevList[0].dtarray[start_index]);
-    dtarray.append(LevList[0].dtarray[end_index]);  # assuming they all have the same list of dates
-    for station in LevList:
-        referenced_data = [0, station.leveling[end_index] - station.leveling[start_index]];
-        subsampled_station = leveling_inputs.LevStation(name=station.name, lon=station.lon, lat=station.lat,
-                                                        dtarray=dtarray, leveling=referenced_data,
-                                                        reflon=station.reflon, reflat=station.reflat);
-        new_station_list.append(subsampled_station);
-    return new_station_list;
+    network = get_onetime_displacements_network(leveling_inputs.lev_list_to_network(LevList), start_index, end_index);
+    return leveling_inputs.network_to_lev_list(network);
+
+
+def get_onetime_displacements_network(network, start_index, end_index):
+    """
+    LevNetwork version of get_onetime_displacements. All stations are differenced at once.
+    :returns: LevNetwork with two dates and leveling of shape (n_stations x 2)
+    """
+    dtarray = [network.dtarray[start_index], network.dtarray[end_index]];
+    disps = network.leveling[:, end_index] - network.leveling[:, start_index];
+    referenced_data = np.column_stack((np.zeros(np.shape(disps)), disps));
+    return network._replace(dtarray=dtarray, leveling=referenced_data);
 
 
 def find_trend(LevList, start_time, end_time):
@@ -32,34 +33,51 @@ def find_trend(LevList, start_time, end_time):
     start_time : datetime object
     end_time: datetime object
     """
-    slope_solutions = [];
-    for item in LevList:
-        dtarray_limited, lev_obs_limited = [], [];
-        for i in range(len(item.dtarray)):
-            if start_time < item.dtarray[i] < end_time and ~np.isnan(item.leveling[i]):
-                dtarray_limited.append(item.dtarray[i]);
-                lev_obs_limited.append(item.leveling[i]);
-        if len(dtarray_limited) > 1:
-            date_int_array = [x.toordinal() for x in dtarray_limited];
-            slope_0, intercept, _, _, _ = stats.linregress(date_int_array, lev_obs_limited);   # slope in mm per day
-            slope_per_year = slope_0 * 365.24;
-            slope_solutions.append(slope_per_year);
-        else:
-            slope_solutions.append(np.nan);
-    return slope_solutions;
+    return find_trend_network(leveling_inputs.lev_list_to_network(LevList), start_time, end_time).tolist();
+
+
+def find_trend_network(network, start_time, end_time):
+    """
+    Slopes of all leveling time series between start_time and end_time, in one masked least-squares solve.
+    Stations with fewer than two observations in the time range get nan.
+
+    :param network: LevNetwork
+    :param start_time: datetime object
+    :param end_time: datetime object
+    :returns: 1D array of slopes, meters/yr
+    """
+    date_int_array = np.array([x.toordinal() for x in network.dtarray], dtype=float);
+    in_range = np.array([start_time < x < end_time for x in network.dtarray]);
+    mask = in_range[np.newaxis, :] & ~np.isnan(network.leveling);
+    weights = mask.astype(float);
+    data = np.where(mask, network.leveling, 0);
+
+    # Closed-form linear regression on each row, using only the masked observations
+    n = np.sum(weights, axis=1);
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_mean = np.sum(weights * date_int_array, axis=1) / n;
+        y_mean = np.sum(data, axis=1) / n;
+        dt_days = (date_int_array[np.newaxis, :] - t_mean[:, np.newaxis]) * weights;
+        slope_0 = np.sum(dt_days * (data - y_mean[:, np.newaxis] * weights), axis=1) / np.sum(dt_days ** 2, axis=1);
+    slope_per_year = slope_0 * 365.24;  # slope was in m per day
+    slope_per_year[n < 2] = np.nan;
+    return slope_per_year;
 
 
 def detrend_leveling_object(LevList, slopes):
     """
     Remove a set of slopes (in m/yr) from leveling displacement objects
     """
-    detrended_lev_list = [];
-    for i, station in enumerate(LevList):
-        date_int_array = [x.toordinal() for x in station.dtarray];
-        detrended_data = np.subtract(station.leveling, [station.leveling[0] + slopes[i] * (1/365.24) *
-                                                        (x-date_int_array[0]) for x in date_int_array]);
-        detrended_station = leveling_inputs.LevStation(name=station.name, lon=station.lon, lat=station.lat,
-                                                       dtarray=station.dtarray, leveling=detrended_data,
-                                                       reflon=station.reflon, reflat=station.reflat);
-        detrended_lev_list.append(detrended_station);
-    return detrended_lev_list;
+    network = detrend_network(leveling_inputs.lev_list_to_network(LevList), slopes);
+    return leveling_inputs.network_to_lev_list(network);
+
+
+def detrend_network(network, slopes):
+    """
+    Remove a set of slopes (in m/yr) from all stations of a LevNetwork at once.
+    Each station's trend line passes through its first observation.
+    """
+    date_int_array = np.array([x.toordinal() for x in network.dtarray], dtype=float);
+    elapsed_years = (date_int_array - date_int_array[0]) / 365.24;
+    trend = network.leveling[:, 0:1] + np.asarray(slopes, dtype=float)[:, np.newaxis] * elapsed_years[np.newaxis, :];
+    return network._replace(leveling=network.leveling - trend);
@@ -4,9 +4,20 @@ The result will be a series of rectangular mesh elements.
 The format will be the internal format used in PyCoulomb, a dictionary with geometry and slip for each patch.
 """
 
+import collections
 import numpy as np
 import matplotlib.pyplot as plt
-from Tectonic_Utils.geodesy import haversine, fault_vector_functions
+from Tectonic_Utils.geodesy import fault_vector_functions
+
+EARTH_RADIUS_KM = 6371.0;  # same radius as Tectonic_Utils haversine
+# Arrays for many fault trace segments, one element per segment. Strike in degrees cw from north, length in km.
+# trace_index: which input fault trace each segment came from
+FaultSegments = collections.namedtuple('FaultSegments', ['lon0', 'lat0', 'strike', 'length', 'lon1', 'lat1',
+                                                         'trace_index']);
+# Arrays for a rectangular mesh, one element per patch. lon/lat is the updip corner where the patch begins.
+# depth is the top depth (km), width the downdip width (km), and row counts patches down-dip from 0 at the top.
+RectangularMesh = collections.namedtuple('RectangularMesh', ['lon', 'lat', 'strike', 'dip', 'length', 'width',
+                                                             'depth', 'row', 'trace_index']);
 
 
 def read_surface_fault_trace(infile):
@@ -24,45 +35,112 @@ def read_surface_fault_trace(infile):
         raise Exception("Error! Lat[0] = Lat[-1]. Don't know how to order this fault trace south-to-north. ");
 
 
+def haversine_distances(lon1, lat1, lon2, lat2):
+    """Great-circle distances (km) between arrays of points, all at once"""
+    lon1, lat1, lon2, lat2 = np.deg2rad(lon1), np.deg2rad(lat1), np.deg2rad(lon2), np.deg2rad(lat2);
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2;
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a));
+
+
+def initial_compass_bearings(lon1, lat1, lon2, lat2):
+    """Initial bearings (degrees cw from north, 0 to 360) from arrays of start points to arrays of end points"""
+    lon1, lat1, lon2, lat2 = np.deg2rad(lon1), np.deg2rad(lat1), np.deg2rad(lon2), np.deg2rad(lat2);
+    x = np.sin(lon2 - lon1) * np.cos(lat2);
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1);
+    return np.mod(np.rad2deg(np.arctan2(x, y)) + 360, 360);
+
+
+def destination_points(lon, lat, azimuth, distance_km):
+    """Points reached by traveling distance_km from (lon, lat) along an initial azimuth (degrees). Vectorized."""
+    lon, lat, azimuth = np.deg2rad(lon), np.deg2rad(lat), np.deg2rad(azimuth);
+    angle = np.asarray(distance_km) / EARTH_RADIUS_KM;
+    lat2 = np.arcsin(np.sin(lat) * np.cos(angle) + np.cos(lat) * np.sin(angle) * np.cos(azimuth));
+    lon2 = lon + np.arctan2(np.sin(azimuth) * np.sin(angle) * np.cos(lat),
+                            np.cos(angle) - np.sin(lat) * np.sin(lat2));
+    return np.rad2deg(lon2), np.rad2deg(lat2);
+
+
 def split_fault_trace(fault_trace, typical_spacing_km):
     """
     Algorithm: Walk up the fault in chunks.  If the chunk is smaller than typical_spacing_km, it becomes one segment.
     Otherwise we split the segment into something similar to typical_spacing_km.
     Returns: (starting lon, starting_lat, strike, length, ending_lon, ending_lat) for each fault trace segment
     """
-    all_fault_segments = [];
-    for i in range(1, len(fault_trace[0])):
-        start_point = (fault_trace[1][i-1], fault_trace[0][i-1]);
-        end_point = (fault_trace[1][i], fault_trace[0][i]);
-        segment_distance = haversine.distance(start_point, end_point);
-        strike = haversine.calculate_initial_compass_bearing(start_point, end_point);
-
-        if segment_distance < typical_spacing_km:    # for the really small segments
-            one_fault_segment = (fault_trace[0][i-1], fault_trace[1][i-1], strike, segment_distance,
-                                 fault_trace[0][i], fault_trace[1][i]);
-            all_fault_segments.append(one_fault_segment);
-
-        else:   # the segments greater than 2x the characteristic spacing
-            num_subsegments = int(np.ceil(segment_distance / typical_spacing_km));  # making segments < typical_spacing
-            counter = [x for x in range(0, num_subsegments+1)];
-
-            lon_difference = fault_trace[0][i] - fault_trace[0][i-1];
-            lon_step = lon_difference / num_subsegments;
-            lon_subarray = [fault_trace[0][i-1] + lon_step*x for x in counter];
-            # for x subsegments, we have x+1 elements in lon_subarray
-
-            lat_difference = fault_trace[1][i] - fault_trace[1][i-1];
-            lat_step = lat_difference / num_subsegments;
-            lat_subarray = [fault_trace[1][i-1] + lat_step*x for x in counter];
-
-            for j in range(1, len(lon_subarray)):
-                one_fault_segment = (lon_subarray[j-1], lat_subarray[j-1], strike, segment_distance/num_subsegments,
-                                     lon_subarray[j], lat_subarray[j]);
-                all_fault_segments.append(one_fault_segment);
+    segments = split_fault_traces([fault_trace], typical_spacing_km);
+    all_fault_segments = list(zip(segments.lon0, segments.lat0, segments.strike, segments.length, segments.lon1,
+                                  segments.lat1));
     print("Meshed fault trace of %d segments into %d segments " % (len(fault_trace[0]), len(all_fault_segments)));
     return all_fault_segments;
 
 
+def split_fault_traces(fault_traces, typical_spacing_km):
+    """
+    Split many fault traces at once. Distances and strikes of all trace segments are computed together,
+    and each segment is divided into ceil(length / typical_spacing_km) equal subsegments (at least one).
+
+    :param fault_traces: list of fault traces, each [lon array, lat array]
+    :param typical_spacing_km: float
+    :returns: FaultSegments
+    """
+    lon = np.concatenate([np.asarray(x[0], dtype=float) for x in fault_traces]);
+    lat = np.concatenate([np.asarray(x[1], dtype=float) for x in fault_traces]);
+    vertex_trace = np.repeat(np.arange(len(fault_traces)), [len(x[0]) for x in fault_traces]);
+    starts = np.flatnonzero(vertex_trace[:-1] == vertex_trace[1:]);  # segments that don't cross between traces
+    ends = starts + 1;
+
+    segment_distance = haversine_distances(lon[starts], lat[starts], lon[ends], lat[ends]);
+    strike = initial_compass_bearings(lon[starts], lat[starts], lon[ends], lat[ends]);
+    num_subsegments = np.maximum(np.ceil(segment_distance / typical_spacing_km), 1).astype(int);
+
+    # Which segment each subsegment came from, and its position j along that segment
+    parent = np.repeat(np.arange(len(starts)), num_subsegments);
+    j = np.arange(len(parent)) - np.repeat(np.cumsum(num_subsegments) - num_subsegments, num_subsegments);
+    lon_step = (lon[ends] - lon[starts])[parent] / num_subsegments[parent];
+    lat_step = (lat[ends] - lat[starts])[parent] / num_subsegments[parent];
+    lon_start, lat_start = lon[starts][parent], lat[starts][parent];
+    return FaultSegments(lon0=lon_start + lon_step * j, lat0=lat_start + lat_step * j, strike=strike[parent],
+                         length=(segment_distance / num_subsegments)[parent], lon1=lon_start + lon_step * (j + 1),
+                         lat1=lat_start + lat_step * (j + 1), trace_index=vertex_trace[starts][parent]);
+
+
+def mesh_fault_segments_downdip(segments, dip, dip_direction, top_depth, bottom_depth, Nwidth=1):
+    """
+    Build a full rectangular mesh from fault trace segments: Nwidth rows of patches down-dip beneath each segment.
+    Each deeper row starts from the row above it, moved horizontally in the dip direction.
+
+    :param segments: FaultSegments
+    :param dip: float, degrees
+    :param dip_direction: string. If 'south', strikes are flipped by 180 degrees.
+    :param top_depth: float, km
+    :param bottom_depth: float, km
+    :param Nwidth: int, number of patches down-dip
+    :returns: RectangularMesh, ordered by row and then by segment
+    """
+    strike = segments.strike - 180 if dip_direction == 'south' else segments.strike;
+    downdip_width = fault_vector_functions.get_downdip_width(top_depth, bottom_depth, dip);
+    patch_width = downdip_width / Nwidth;
+    n_segments = len(strike);
+    row = np.repeat(np.arange(Nwidth), n_segments);
+    horizontal_offset = row * patch_width * np.cos(np.deg2rad(dip));
+    lon, lat = destination_points(np.tile(segments.lon0, Nwidth), np.tile(segments.lat0, Nwidth),
+                                  np.tile(strike, Nwidth) + 90, horizontal_offset);  # right-hand rule dip direction
+    return RectangularMesh(lon=lon, lat=lat, strike=np.tile(strike, Nwidth), dip=np.full(len(row), float(dip)),
+                           length=np.tile(segments.length, Nwidth), width=np.full(len(row), patch_width),
+                           depth=top_depth + row * (bottom_depth - top_depth) / Nwidth, row=row,
+                           trace_index=np.tile(segments.trace_index, Nwidth));
+
+
+def convert_mesh_to_fault_dictionary(mesh, slip_cm, rake):
+    """Convert a RectangularMesh into the internal fault_dictionary format from Elastic_stresses_py"""
+    fault_dict_list = [];
+    for i in range(len(mesh.lon)):
+        new_fault = {"strike": mesh.strike[i], "dip": mesh.dip[i], "length": mesh.length[i], "rake": rake,
+                     "slip": slip_cm / 100, "tensile": 0, "depth": mesh.depth[i], "width": mesh.width[i],
+                     "lon": mesh.lon[i], "lat": mesh.lat[i]};
+        fault_dict_list.append(new_fault);
+    return fault_dict_list;
+
+
 def convert_2d_segments_to_fault_dictionary(fault_segments, dip, dip_direction, top_depth, bottom_depth, slip_cm, rake):
     """
     fault_segment includes: (starting lon, starting_lat, strike, length, ending_lon, ending_lat)
@@ -1,15 +1,38 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import json
+import collections
 import slippy.xyz2geo as plotting_library
 import slippy.basis
 import slippy.patch
 import slippy.tikhonov
 import slippy.gbuild
 import scipy.optimize
-import scipy.linalg
+import scipy.sparse
 import slippy.io
 from . import resolution_tests
+from . import metrics
+from ..Inversion import mesh_smoothing
+
+# The in-memory result of an inversion, handed to metrics without writing and re-reading files.
+# model: the full model vector (all epochs, then leveling offsets).
+# obs_pos, obs_disp, pred_disp, obs_sigma, obs_type: one row per observation; obs_type holds metrics.OBS_TYPE_CODES.
+# cardinal_slip: list of (Ns_total x 3) arrays of slip, one per epoch.  leveling_offsets: list.
+# patches_pos_geo, patches_strike, patches_dip, patches_length, patches_width, fault_names: one per fault patch.
+# slip_norm: ||m|| over fault-slip parameters only (all epochs, no leveling offsets).
+# smoothing_norm: ||L m|| over all epochs, with the smoothing matrix L before it is scaled by each fault's penalty.
+InversionResult = collections.namedtuple('InversionResult', ['model', 'obs_pos', 'obs_disp', 'pred_disp', 'obs_sigma',
+                                                             'obs_type', 'cardinal_slip', 'leveling_offsets',
+                                                             'patches_pos_geo', 'patches_strike', 'patches_dip',
+                                                             'patches_length', 'patches_width', 'fault_names',
+                                                             'slip_norm', 'smoothing_norm']);
+
+# The weighted linear system before regularization and inversion, for choosing regularization by GCV or ABIC.
+# G: weighted design matrix with leveling-offset columns.  d: weighted data vector.
+# smoothing, penalized_smoothing: dense smoothing matrices for all epochs, before and after scaling by fault penalty,
+# with zero columns for leveling offsets.  n_fault_params: number of fault-slip columns (all epochs), which come first.
+InversionSystem = collections.namedtuple('InversionSystem', ['G', 'd', 'smoothing', 'penalized_smoothing',
+                                                             'n_fault_params']);
 
 
 def reg_nnls(Gext, dext):
@@ -18,21 +41,22 @@ def reg_nnls(Gext, dext):
 
 def G_with_smoothing(G, L, alpha, d, num_params, n_epochs):
     """
-    L: Add smoothing regularization
+    L: Add smoothing regularization (scipy.sparse); it becomes dense only one epoch's row block at a time
     Alpha: Add minimum-norm regularization (Aster and Thurber, Equation 4.5) (0th order tikhonov regularization)
     d: Expand the data vector to match the new size of G
     """
     Gext = G.copy();
     dext = d.copy();
+    num_rows = np.shape(L)[0];
     for i in range(n_epochs):
-        new_l_rowblock = np.zeros((len(L), num_params*n_epochs));
-        new_l_rowblock[:, i*num_params:(i+1)*num_params] = L;
+        new_l_rowblock = np.zeros((num_rows, num_params*n_epochs));
+        new_l_rowblock[:, i*num_params:(i+1)*num_params] = L.toarray();
         Gext = np.vstack((Gext, new_l_rowblock));
-        zero_vector = np.zeros((len(L),));
+        zero_vector = np.zeros((num_rows,));
         dext = np.concatenate((dext, zero_vector))
         if alpha > 0:  # Minimum norm solution. Aster and Thurber, Equation 4.5.
-            new_alpha_rowblock = np.zeros((len(L), num_params*n_epochs));
-            alphaI = alpha * np.identity(len(L));
+            new_alpha_rowblock = np.zeros((num_rows, num_params*n_epochs));
+            alphaI = alpha * np.identity(num_rows);
             alphaI[-1, -1] = 0;  # for leveling, we don't want the offset term to be constrained with smoothing.
             new_alpha_rowblock[:, i * num_params:(i + 1) * num_params] = alphaI;
             Gext = np.vstack((Gext, new_alpha_rowblock));
@@ -41,6 +65,12 @@ def G_with_smoothing(G, L, alpha, d, num_params, n_epochs):
     return Gext, dext;
 
 
+def expand_for_epochs(L, n_epochs, num_leveling_params):
+    """Dense block-diagonal copy of one epoch's regularization matrix for every epoch, plus leveling columns"""
+    L_all = scipy.sparse.block_diag([L] * n_epochs, format='csr').toarray();
+    return np.hstack((L_all, np.zeros((np.shape(L_all)[0], num_leveling_params))));
+
+
 def normalized_vector(vector):
     norm = np.sqrt(np.square(vector[0]) + np.square(vector[1]) + np.square(vector[2]));
     return np.divide(vector, norm);
@@ -211,10 +241,67 @@ def parse_disp_outputs(pred_disp_f, num_obs):
     return disp_segments;
 
 
-def beginning_calc(config):
+def write_inversion_outputs(result, span_output_files, input_file_list, output_file_list, data_type_list,
+                            nums_obs_list, pos_obs_list, pos_basis_list, obs_disp_f_list_pure, obs_sigma_f_list):
+    """Write the slip of each epoch and the predicted displacements (and GPS residuals) of each data file"""
+    # OUTPUT EACH SLIP INTERVAL
+    for i, slip_output_file in enumerate(span_output_files):
+        slippy.io.write_slip_data(result.patches_pos_geo,
+                                  result.patches_strike, result.patches_dip,
+                                  result.patches_length, result.patches_width,
+                                  result.cardinal_slip[i], result.fault_names, slip_output_file)
+        print("Writing file %s " % slip_output_file);
+
+    disp_models = parse_disp_outputs(result.pred_disp, nums_obs_list);
+
+    # OUTPUT EACH PREDICTED DISPLACEMENT FIELD
+    for filenum, filename in enumerate(input_file_list):
+
+        if data_type_list[filenum] == 'gps':  # write GPS
+            Ngps = int(nums_obs_list[filenum] / 3);
+            pred_disp_gps = disp_models[filenum];
+            pred_disp_gps = pred_disp_gps.reshape((Ngps, 3))
+            slippy.io.write_gps_data(pos_obs_list[filenum][::3],
+                                     pred_disp_gps, 0.0 * pred_disp_gps,
+                                     output_file_list[filenum]);
+            print("Writing file %s " % output_file_list[filenum]);
+            # Writing residuals
+            obs_disp_gps = obs_disp_f_list_pure[filenum].reshape((Ngps, 3));
+            slippy.io.write_gps_data(pos_obs_list[filenum][::3],
+                                     np.subtract(obs_disp_gps, pred_disp_gps),
+                                     obs_sigma_f_list[filenum].reshape((Ngps, 3)),
+                                     output_file_list[filenum]+'_residual');
+
+        elif data_type_list[filenum] == 'insar':
+            pred_disp_insar = disp_models[filenum];
+            slippy.io.write_insar_data(pos_obs_list[filenum],
+                                       pred_disp_insar, 0.0 * pred_disp_insar,
+                                       pos_basis_list[filenum],
+                                       output_file_list[filenum])
+            print("Writing file %s " % output_file_list[filenum]);
+
+        elif data_type_list[filenum] == 'leveling':
+            pred_disp_leveling = disp_models[filenum];
+            slippy.io.write_insar_data(pos_obs_list[filenum],
+                                       pred_disp_leveling, 0.0 * pred_disp_leveling,
+                                       pos_basis_list[filenum],
+                                       output_file_list[filenum])
+            print("Writing file %s " % output_file_list[filenum]);
+    return;
+
 
-    with open(config['output_dir']+'/config.json', 'w') as fp:
-        json.dump(config, fp, indent="  ");   # save copy of config file in outdir, for record-keeping
+def beginning_calc(config, write_outputs=True, system_only=False):
+    """
+    Build G, invert, and write slip and predicted displacement files.
+
+    :param config: dictionary of inversion parameters
+    :param write_outputs: bool. If False, skip the slip, prediction, and G-image files (resolution tests still write).
+    :param system_only: bool. If True, return the InversionSystem right after building G, without inverting.
+    :returns: InversionResult, or InversionSystem if system_only
+    """
+    if write_outputs:
+        with open(config['output_dir']+'/config.json', 'w') as fp:
+            json.dump(config, fp, indent="  ");   # save copy of config file in outdir, for record-keeping
 
     fault_list = input_faults(config);
     alpha = config['alpha']  # a parameter to produce Minimum norm solution (optional)
@@ -241,6 +328,7 @@ def beginning_calc(config):
     slip_basis_f = np.zeros((0, 3))   # basis functions repeated for each slip patch
     fault_names_array = [];  # a list of fault names (integers) for each fault patch
     L_array = [];   # may hold several smoothing matrices, if using 2+ faults
+    L_unscaled_array = [];   # the same smoothing matrices before multiplying by penalty, for the L-curve seminorm
 
     # # Fault processing
     for fault in fault_list:
@@ -266,17 +354,25 @@ def beginning_calc(config):
         fault_names_array = np.concatenate((fault_names_array, names_for_patch), axis=0);
 
         ### build regularization matrix for this fault (for smoothing penalty)
-        L = np.zeros((0, Ns * Ds))
-        indices = np.arange(Ns * Ds).reshape((Ns, Ds))
-        for i in range(Ds):  # for each dimension of the basis
-            connectivity = indices[:, i].reshape((fault["Nlength"], fault["Nwidth"]))
-            Li = slippy.tikhonov.tikhonov_matrix(connectivity, 2, column_no=Ns * Ds)
-            L = np.vstack((Li, L))
-
+        if config.get("smoothing_type", "tikhonov") == "mesh_laplacian":  # scale-aware, from grid neighbors
+            adjacency = mesh_smoothing.grid_adjacency(fault["Nlength"], fault["Nwidth"]);
+            centroids = np.array([i.patch_to_user([0.5, 0.5, 0.0]) for i in single_fault_patches]) / 1000;  # km
+            L = mesh_smoothing.second_order_laplacian(adjacency, centroids);
+            L = mesh_smoothing.expand_for_slip_basis(L, Ds);  # stays sparse until stacked into G_ext
+        else:
+            L = np.zeros((0, Ns * Ds))
+            indices = np.arange(Ns * Ds).reshape((Ns, Ds))
+            for i in range(Ds):  # for each dimension of the basis
+                connectivity = indices[:, i].reshape((fault["Nlength"], fault["Nwidth"]))
+                Li = slippy.tikhonov.tikhonov_matrix(connectivity, 2, column_no=Ns * Ds)
+                L = np.vstack((Li, L))
+
+        L_unscaled_array.append(L.copy());
         L *= fault["penalty"]   # multiplying by smoothing strength for this fault
         L_array.append(L)   # collecting full smoothing matrix for each fault
 
-    L = scipy.linalg.block_diag(*L_array)  # For 2+ faults: Make block diagonal matrix for tikhonov regularization
+    L = scipy.sparse.block_diag(L_array, format='csr')  # For 2+ faults: Make block diagonal matrix for regularization
+    L_unscaled = scipy.sparse.block_diag(L_unscaled_array, format='csr');
     Ns_total = len(patches);  # number of total patches (regardless of basis vectors)
 
     # PARSE HOW MANY EPOCHS WE ARE USING
@@ -372,7 +468,6 @@ def beginning_calc(config):
 
     # Smoothing and slip penalty for each epoch.  (L DEPENDS ON FAULT GEOMETRY ONLY)
     G_ext, d_ext = G_with_smoothing(G_nosmooth, L, alpha, d_total, n_model_params, n_epochs);
-    G_noa, d_noa = G_with_smoothing(G_nosmooth, L, 0, d_total, n_model_params, n_epochs);  # for resolution tests
     print("Shape of G, L:", np.shape(G_nosmooth), " ", np.shape(L))
     print("Shape of Gext (G,L,alpha):", np.shape(G_ext));
 
@@ -401,6 +496,11 @@ def beginning_calc(config):
             count = count + (row_span_list[datanum][1] - row_span_list[datanum][0]);
             G_nosmooth = np.hstack((G_nosmooth, newcol_nosmooth));
     print("After adding lines for leveling offsets, shape(G): ", np.shape(G_ext), "\n------");
+    if system_only:
+        return InversionSystem(G=G_nosmooth, d=d_total,
+                               smoothing=expand_for_epochs(L_unscaled, n_epochs, num_leveling_params),
+                               penalized_smoothing=expand_for_epochs(L, n_epochs, num_leveling_params),
+                               n_fault_params=n_cols_bigG);
 
     # INVERT BIG-G: estimate slip and compute predicted displacement
     #####################################################################
@@ -414,7 +514,6 @@ def beginning_calc(config):
 
     total_cardinal_slip, leveling_offsets = parse_slip_outputs(slip_f, Ns_total, Ds, n_epochs, total_fault_slip_basis,
                                                                num_leveling_params);
-    disp_models = parse_disp_outputs(pred_disp_f, nums_obs_list);
 
     # Defensive programming (Reporting errors)
     files_with_lev_offsets = [input_file_list[i] for i in range(len(input_file_list)) if signs_list[i] != 0];
@@ -433,51 +532,21 @@ def beginning_calc(config):
     patches_length = [i.length for i in patches]
     patches_width = [i.width for i in patches]
 
-    # OUTPUT EACH SLIP INTERVAL
-    for i in range(n_epochs):
-        slip_output_file = span_output_files[i];
-
-        # ### write output
-        # #####################################################################
-        slippy.io.write_slip_data(patches_pos_geo,
-                                  patches_strike, patches_dip,
-                                  patches_length, patches_width,
-                                  total_cardinal_slip[i], fault_names_array, slip_output_file)
-        print("Writing file %s " % slip_output_file);
-
-    # OUTPUT EACH PREDICTED DISPLACEMENT FIELD
-    for filenum, filename in enumerate(input_file_list):
-
-        if data_type_list[filenum] == 'gps':  # write GPS
-            Ngps = int(nums_obs_list[filenum] / 3);
-            pred_disp_gps = disp_models[filenum];
-            pred_disp_gps = pred_disp_gps.reshape((Ngps, 3))
-            slippy.io.write_gps_data(pos_obs_list[filenum][::3],
-                                     pred_disp_gps, 0.0 * pred_disp_gps,
-                                     output_file_list[filenum]);
-            print("Writing file %s " % output_file_list[filenum]);
-            # Writing residuals
-            obs_disp_gps = obs_disp_f_list_pure[filenum].reshape((Ngps, 3));
-            slippy.io.write_gps_data(pos_obs_list[filenum][::3],
-                                     np.subtract(obs_disp_gps, pred_disp_gps),
-                                     obs_sigma_f_list[filenum].reshape((Ngps, 3)),
-                                     output_file_list[filenum]+'_residual');
-
-        elif data_type_list[filenum] == 'insar':
-            pred_disp_insar = disp_models[filenum];
-            slippy.io.write_insar_data(pos_obs_list[filenum],
-                                       pred_disp_insar, 0.0 * pred_disp_insar,
-                                       pos_basis_list[filenum],
-                                       output_file_list[filenum])
-            print("Writing file %s " % output_file_list[filenum]);
-
-        elif data_type_list[filenum] == 'leveling':
-            pred_disp_leveling = disp_models[filenum];
-            slippy.io.write_insar_data(pos_obs_list[filenum],
-                                       pred_disp_leveling, 0.0 * pred_disp_leveling,
-                                       pos_basis_list[filenum],
-                                       output_file_list[filenum])
-            print("Writing file %s " % output_file_list[filenum]);
+    fault_slip = slip_f[0:n_cols_bigG].reshape((n_epochs, n_model_params));  # one row per epoch, no lev offsets
+    smoothing_norm = np.sqrt(np.sum(np.square(L_unscaled.dot(fault_slip.T))));
+
+    obs_type = np.concatenate([np.full(nums_obs_list[i], metrics.OBS_TYPE_CODES[data_type_list[i]])
+                               for i in range(len(nums_obs_list))]).astype(int);
+    result = InversionResult(model=slip_f, obs_pos=np.concatenate(pos_obs_list),
+                             obs_disp=np.concatenate(obs_disp_f_list_pure), pred_disp=pred_disp_f,
+                             obs_sigma=sig_total, obs_type=obs_type, cardinal_slip=total_cardinal_slip,
+                             leveling_offsets=list(leveling_offsets), patches_pos_geo=patches_pos_geo,
+                             patches_strike=patches_strike, patches_dip=patches_dip, patches_length=patches_length,
+                             patches_width=patches_width, fault_names=fault_names_array,
+                             slip_norm=np.linalg.norm(fault_slip), smoothing_norm=smoothing_norm);
+    if write_outputs:
+        write_inversion_outputs(result, span_output_files, input_file_list, output_file_list, data_type_list,
+                                nums_obs_list, pos_obs_list, pos_basis_list, obs_disp_f_list_pure, obs_sigma_f_list);
 
     # Running a resolution test if desired. Only works for a single time interval.
     def res_output_phase(cardinal_res, res_output_file):
@@ -487,47 +556,56 @@ def beginning_calc(config):
         print("Writing file %s " % res_output_file);
         return;
 
-    if "R" in config["resolution_test"].split(',') and n_epochs == 1:
-        # Resolution Matrix form of analysis
-        res_output_file = config["output_dir"] + 'diag_resolution.txt';
-        r_diag, m_sig = resolution_tests.analyze_model_resolution_matrix(G_ext, len(G_nosmooth), config["output_dir"]);
-        total_cardinal_res = resolution_tests.parse_empirical_res_outputs(m_sig, Ns_total, Ds, num_leveling_params);
-        res_output_phase(total_cardinal_res, res_output_file);
+    if "R" in config["resolution_test"].split(','):
+        # Resolution Matrix form of analysis, from one SVD of G_ext. Works for any number of epochs.
+        r_diag, m_sig = resolution_tests.analyze_model_resolution_matrix(G_ext, len(G_nosmooth), config["output_dir"],
+                                                                         method=config.get("resolution_method", "svd"),
+                                                                         k=config.get("resolution_k"));
+        for i, epoch_sig in enumerate(resolution_tests.split_epoch_outputs(m_sig, n_epochs, num_leveling_params)):
+            suffix = '' if n_epochs == 1 else '_' + total_spans[i];
+            total_cardinal_res = resolution_tests.parse_empirical_res_outputs(epoch_sig, Ns_total, Ds, 0);
+            res_output_phase(total_cardinal_res, config["output_dir"] + 'diag_resolution' + suffix + '.txt');
+    if "bootstrap" in config["resolution_test"].split(','):
+        # Monte Carlo form of analysis: standard deviation of slip over many noisy, bounded re-inversions
+        mc_result = resolution_tests.bootstrapped_model_resolution(G_ext, G_nosmooth, d_ext, sig_total, weight_total,
+                                                                   n_realizations=config.get("n_realizations", 100),
+                                                                   num_workers=config.get("num_workers", 1));
+        for i, epoch_std in enumerate(resolution_tests.split_epoch_outputs(mc_result.std, n_epochs,
+                                                                           num_leveling_params)):
+            suffix = '' if n_epochs == 1 else '_' + total_spans[i];
+            total_cardinal_res = resolution_tests.parse_empirical_res_outputs(epoch_std, Ns_total, Ds, 0);
+            res_output_phase(total_cardinal_res, config["output_dir"] + 'bootstrap_std' + suffix + '.txt');
     if 'avg_response' in config["resolution_test"].split(',') and n_epochs == 1:
         # Average geodetic response form of analysis
         res_output_file = config["output_dir"] + 'empirical_resolution.txt';
         model_res = resolution_tests.empirical_slip_resolution(G_ext, total_fault_slip_basis);
         total_cardinal_res = resolution_tests.parse_empirical_res_outputs(model_res, Ns_total, Ds, num_leveling_params);
         res_output_phase(total_cardinal_res, res_output_file);
-    if "checkerboard" in config["resolution_test"].split(',') and n_epochs == 1:
-        # checkerboard test for one fault segment
-        use_slip_penalty = 1;   # do we impose a zeroth-order minimum-norm penalty?
-        res_output_file = config["output_dir"] + 'checkerboard_resolution.txt';
-        res_input_file = config["output_dir"] + 'checkerboard_input.txt';
-        checkerboard_model = resolution_tests.checkerboard_vector(patches_f, Ds, num_leveling_params,
-                                                                  fault_list[0]["Nwidth"], fault_names_array,
-                                                                  checker_width=4, fault_num=0);
-        inp_cardinal_res = resolution_tests.parse_checkerboard_res_outputs(checkerboard_model, Ns_total, Ds,
-                                                                           total_fault_slip_basis, num_leveling_params);
-        res_output_phase(inp_cardinal_res, res_input_file);
-
-        pred_disp_checkerboard = G_nosmooth.dot(checkerboard_model) * sig_total;  # forward prediction
-        pred_disp_checkerboard = pred_disp_checkerboard + resolution_tests.get_random_error_vector(sig_total);
-
-        if use_slip_penalty:  # reviewer asked what happens if we impose regularization
-            zero_vector = np.zeros((len(d_ext) - len(pred_disp_checkerboard),));  # add zeros to pred_d for smoothing
-            pred_d_ext = np.concatenate((pred_disp_checkerboard/sig_total, zero_vector));
-            recovered_checkerboard = reg_nnls(G_ext, pred_d_ext);  # the inverse model.
-        else:
-            zero_vector = np.zeros((len(d_noa) - len(pred_disp_checkerboard),));  # add zeros to pred_d for smoothing
-            pred_d_ext = np.concatenate((pred_disp_checkerboard/sig_total, zero_vector));
-            recovered_checkerboard = reg_nnls(G_noa, pred_d_ext);  # the inverse model.
-            num_leveling_params = 0;
-        total_cardinal_res = resolution_tests.parse_checkerboard_res_outputs(recovered_checkerboard, Ns_total, Ds,
-                                                                             total_fault_slip_basis,
-                                                                             num_leveling_params);
-        res_output_phase(total_cardinal_res, res_output_file);
+    if "checkerboard" in config["resolution_test"].split(','):
+        # Batched synthetic tests: checkerboards, corner checkers, and spikes, on any fault and epoch, all at once.
+        # Default is the original single test: 4-patch checkerboard on the first fault.
+        test_specs = config.get("resolution_suite", [{"type": "checkerboard", "checker_width": 4, "fault_num": 0,
+                                                      "name": "checkerboard"}]);
+        models, groups = resolution_tests.build_synthetic_models(test_specs, Ns_total, Ds, n_epochs,
+                                                                 num_leveling_params, fault_names_array,
+                                                                 [fault["Nwidth"] for fault in fault_list]);
+        recovered = resolution_tests.run_resolution_suite(G_ext, G_nosmooth, models,
+                                                          num_workers=config.get("num_workers", 1));
+        for test in resolution_tests.summarize_resolution_suite(test_specs, models, recovered, groups):
+            input_epochs = resolution_tests.split_epoch_outputs(test.input_model, n_epochs, num_leveling_params);
+            recovered_epochs = resolution_tests.split_epoch_outputs(test.recovered_model, n_epochs,
+                                                                    num_leveling_params);
+            for i in range(n_epochs):
+                suffix = '' if n_epochs == 1 else '_' + total_spans[i];
+                inp_cardinal_res = resolution_tests.parse_checkerboard_res_outputs(input_epochs[i], Ns_total, Ds,
+                                                                                   total_fault_slip_basis, 0);
+                res_output_phase(inp_cardinal_res, config["output_dir"] + test.name + '_input' + suffix + '.txt');
+                total_cardinal_res = resolution_tests.parse_checkerboard_res_outputs(recovered_epochs[i], Ns_total, Ds,
+                                                                                     total_fault_slip_basis, 0);
+                res_output_phase(total_cardinal_res, config["output_dir"] + test.name + '_resolution' + suffix +
+                                 '.txt');
 
     # MISC OUTPUTS: Graph of big G (with all smoothing parameters inside)
-    graph_big_G(config, G_ext);
-    return;
+    if write_outputs:
+        graph_big_G(config, G_ext);
+    return result;
@@ -3,22 +3,32 @@
 import json, glob, os
 from src.Inversion.l_curve_plots import plot_l_curve_coordinator
 from src.Inversion.post_inversion_tools import read_misfits_from_list_of_files
+from src.Inversion import run_index
 
 
 def collect_curve_points(config):
-    """ Harvest the parameter values and misfit values from a bunch of l-curve directories """
+    """
+    Harvest the parameter values and misfit values from a bunch of l-curve directories.
+    Uses the sweep's run index if there is one, otherwise reads each directory's config and summary files.
+    Returns params, misfits, and model norms (None when read from files).
+    """
     exp_dir = config["output_dir_lcurve"];
-    other_dirs = glob.glob(exp_dir+"/*");
+    if run_index.has_run_index(exp_dir):
+        print("Reading run index in ", exp_dir);
+        params_array, misfit_array, norm_array = run_index.get_curve_points(exp_dir, ["alpha", "penalty"],
+                                                                            "normalized_misfit");
+        return [params_array, misfit_array, norm_array];
+    other_dirs = sorted(glob.glob(exp_dir+"/*"));
     params_array, misfit_array = [], [];
     for i in other_dirs:
         if os.path.isdir(i):
             print("Reading ", i);
             params = read_params_from_dir(i);
-            resultsfile = i + "/summary_stats.txt";
+            resultsfile = i + "/summary_stats_simple.txt";
             misfit = read_misfits_from_list_of_files([resultsfile], 'Average normalized misfit')[0]
             params_array.append(params);
             misfit_array.append(misfit);
-    return [params_array, misfit_array];
+    return [params_array, misfit_array, [None] * len(misfit_array)];
 
 
 def read_params_from_dir(dirname):
@@ -33,6 +43,10 @@ def read_params_from_dir(dirname):
 
 
 def main_driver(config):
-    [params, misfits] = collect_curve_points(config);
-    plot_l_curve_coordinator(params, misfits, config["output_dir_lcurve"] + "/l_curve.png");
+    [params, misfits, model_norms] = collect_curve_points(config);
+    corner_method = config.get("corner_method", "triangle");
+    if corner_method in ("gcv", "abic"):
+        corner_method = None;  # the value was chosen by the criterion, not by an L-curve corner
+    plot_l_curve_coordinator(params, misfits, config["output_dir_lcurve"] + "/l_curve.png", model_norms,
+                             chosen_point=config.get("chosen_point"), corner_method=corner_method);
     return;
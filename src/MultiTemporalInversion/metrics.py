@@ -6,19 +6,41 @@ Writes into a summary text file, and prints to screen.
 Useful for L-curve analysis.
 """
 
+import collections
 import numpy as np
 from Tectonic_Utils.seismo import moment_calculations
 import slippy.io
+from ..Inversion import moment_tools
+
+
+# Observation types are stored as integer categories, for grouped reductions with np.bincount
+OBS_TYPE_NAMES = ["gps", "insar", "leveling"];
+OBS_TYPE_CODES = {name: code for code, name in enumerate(OBS_TYPE_NAMES)};
+
+# Region masks are bounding boxes [W, E, S, N]. Brawley ignores the western part of the domain.
+BRAWLEY_REGION = [-115.7, 180, -90, 90];
+
+# One entry per category in names: each of OBS_TYPE_NAMES, then "all".
+# rms and l1 in the units of the data; chi2 and normalized_l1 in sigma; weighted_rms uses 1/sigma^2 weights.
+MisfitRecord = collections.namedtuple('MisfitRecord', ['names', 'npts', 'rms', 'chi2', 'l1', 'normalized_l1',
+                                                       'weighted_rms']);
+
+# misfit: MisfitRecord.  moments: [total moment in N-m, Mw] of the first epoch.
+InversionMetrics = collections.namedtuple('InversionMetrics', ['misfit', 'moments']);
 
 
 # -------- READ FUNCTIONS ----------- #
 def read_obs_vs_predicted_object(config):
-    """Read data and model prediction files. There may be many files. """
+    """
+    Read data and model prediction files. There may be many files.
+    Returns obs_pos, obs_disp, pred_disp, obs_sigma, and obs_type, one row per observation.
+    obs_type is an integer array of OBS_TYPE_CODES.
+    """
     obs_pos_column = np.zeros((0, 3));  # no predicted pos because it's the same as obs
     obs_disp_column = np.zeros((0,));
     pred_disp_column = np.zeros((0,));
     obs_sigma_column = np.zeros((0,));  # no predicted sigma since it's 0 for a model
-    obs_type_column = [];
+    obs_type_column = np.zeros((0,), dtype=int);
     for data_category in config["data_files"].keys():
         obs_file = config["data_files"][data_category]["data_file"];  # infile expected of all data files
         pred_file = config["output_dir"]+config["data_files"][data_category]["outfile"];  # predicted outfile
@@ -30,141 +52,185 @@ def read_obs_vs_predicted_object(config):
             obs_disp_fi = disp.reshape((len(pos_geodetic) * 3,))   # reshaping 3-component data into 1d vector
             pred_disp_fi = pred_disp.reshape((len(pos_geodetic) * 3,))
             sigma_fi = sigma.reshape((len(pos_geodetic) * 3,))
-            obs_pos_column = np.concatenate((obs_pos_column, pos_geodetic));
-            obs_disp_column = np.concatenate((obs_disp_column, obs_disp_fi));
-            pred_disp_column = np.concatenate((pred_disp_column, pred_disp_fi));
-            obs_sigma_column = np.concatenate((obs_sigma_column, sigma_fi));
-            obs_type_column += ["gps"] * len(pos_geodetic);
+            pos_geodetic = np.repeat(pos_geodetic, 3, axis=0);  # one position for each of the three components
         else:
-            pos_geodetic, disp, sigma, _ = slippy.io.read_insar_data(obs_file);   # ignored elements are basis vectors
-            _, pred_disp, _, _ = slippy.io.read_insar_data(pred_file);
-            obs_pos_column = np.concatenate((obs_pos_column, pos_geodetic));
-            obs_disp_column = np.concatenate((obs_disp_column, disp));
-            pred_disp_column = np.concatenate((pred_disp_column, pred_disp));
-            obs_sigma_column = np.concatenate((obs_sigma_column, sigma));
-            if data_type == 'insar':
-                obs_type_column += ["insar"] * len(pos_geodetic);
-            else:
-                obs_type_column += ["leveling"] * len(pos_geodetic);
+            pos_geodetic, obs_disp_fi, sigma_fi, _ = slippy.io.read_insar_data(obs_file);  # ignored: basis vectors
+            _, pred_disp_fi, _, _ = slippy.io.read_insar_data(pred_file);
+            data_type = 'insar' if data_type == 'insar' else 'leveling';
+        obs_pos_column = np.concatenate((obs_pos_column, pos_geodetic));
+        obs_disp_column = np.concatenate((obs_disp_column, obs_disp_fi));
+        pred_disp_column = np.concatenate((pred_disp_column, pred_disp_fi));
+        obs_sigma_column = np.concatenate((obs_sigma_column, sigma_fi));
+        obs_type_column = np.concatenate((obs_type_column, np.full(len(obs_disp_fi), OBS_TYPE_CODES[data_type])));
     return [obs_pos_column, obs_disp_column, pred_disp_column, obs_sigma_column, obs_type_column];
 
 
+def get_obs_type_codes(obs_type):
+    """Integer category array from obs_type, which may already be integers or may be a list of strings"""
+    obs_type = np.asarray(obs_type);
+    if obs_type.dtype.kind in 'iu':
+        return obs_type;
+    return np.array([OBS_TYPE_CODES[x] for x in obs_type], dtype=int);
+
+
+def get_region_mask(obs_pos, bbox):
+    """Boolean array of which observations are inside a bounding box [W, E, S, N]. Edges excluded."""
+    W, E, S, N = bbox;
+    return (obs_pos[:, 0] > W) & (obs_pos[:, 0] < E) & (obs_pos[:, 1] > S) & (obs_pos[:, 1] < N);
+
+
 # -------- DRIVERS ----------- #
 def simple_misfit_driver(config, outfile):
     """Compute simple misfit - one column for each data."""
-    [obs_pos, obs_disp, pred_disp, obs_sigma, obs_type] = read_obs_vs_predicted_object(config);
-    metrics = compute_simple_misfit(obs_pos, obs_disp, pred_disp, obs_sigma, obs_type);
-    write_simple_misfit(metrics, outfile);
+    [_, obs_disp, pred_disp, obs_sigma, obs_type] = read_obs_vs_predicted_object(config);
+    record = compute_misfit_record(obs_disp, pred_disp, obs_sigma, obs_type);
+    write_simple_misfit(record, outfile);
     return;
 
 def compound_misfit_driver(config, outfile):
     """Compute three metrics for gps, insar, and leveling respectively"""
     print("Calculating metrics for inversion results.");
-    [obs_pos, obs_disp, pred_disp, obs_sigma, obs_type] = read_obs_vs_predicted_object(config);
-    metrics = compute_compound_misfit(obs_pos, obs_disp, pred_disp, obs_sigma, obs_type);
-    write_compound_misfit(metrics, outfile);  # matching write function
+    [_, obs_disp, pred_disp, obs_sigma, obs_type] = read_obs_vs_predicted_object(config);
+    record = compute_misfit_record(obs_disp, pred_disp, obs_sigma, obs_type);
+    write_compound_misfit(record, outfile);  # matching write function
     return;
 
-def brawley_misfit_driver(config, outfile):
+def brawley_misfit_driver(config, outfile, region=BRAWLEY_REGION):
     """Compute three metrics for gps, insar, and leveling respectively"""
     print("Calculating metrics for Brawley inversion results.");
     [obs_pos, obs_disp, pred_disp, obs_sigma, obs_type] = read_obs_vs_predicted_object(config);
-    metrics = compute_brawley_misfit(obs_pos, obs_disp, pred_disp, obs_sigma, obs_type);
-    write_simple_misfit(metrics, outfile);  # matching write function
+    record = compute_brawley_misfit(obs_pos, obs_disp, pred_disp, obs_sigma, obs_type, region);
+    write_simple_misfit(record, outfile);  # matching write function
     return;
 
 
+# -------- MISFIT FUNCTIONS ----------- #
+def compute_misfit_record(obs_disp, pred_disp, obs_sigma, obs_type, mask=None):
+    """
+    All misfit metrics for all observation types, in one grouped pass with np.bincount.
+    NaN residuals (or NaN sigmas, for the normalized metrics) are left out of the averages, like np.nanmean.
+
+    :param obs_disp: 1D array of observations
+    :param pred_disp: 1D array of model predictions
+    :param obs_sigma: 1D array of uncertainties
+    :param obs_type: 1D array of integer OBS_TYPE_CODES, or list of obs type strings
+    :param mask: optional boolean array, which observations to use (like from get_region_mask)
+    :returns: MisfitRecord
+    """
+    codes = get_obs_type_codes(obs_type);
+    obs_disp, pred_disp, obs_sigma = np.asarray(obs_disp), np.asarray(pred_disp), np.asarray(obs_sigma);
+    if mask is not None:
+        codes, obs_disp, pred_disp, obs_sigma = codes[mask], obs_disp[mask], pred_disp[mask], obs_sigma[mask];
+    n_categories = len(OBS_TYPE_NAMES);
+
+    residual = np.abs(obs_disp - pred_disp);
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized = residual / obs_sigma;
+        weights = 1.0 / np.square(obs_sigma);
+    valid = ~np.isnan(residual);
+    valid_normalized = ~np.isnan(normalized);
+
+    def grouped_sum(values, use):
+        """Sum of values within each category, with the total of all categories appended"""
+        sums = np.bincount(codes[use], weights=values[use], minlength=n_categories);
+        return np.append(sums, np.sum(sums));
+
+    npts = np.append(np.bincount(codes, minlength=n_categories), len(codes));
+    n_valid = grouped_sum(np.ones(np.shape(residual)), valid);
+    n_valid_normalized = grouped_sum(np.ones(np.shape(residual)), valid_normalized);
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rms = np.sqrt(grouped_sum(np.square(residual), valid) / n_valid);
+        chi2 = np.sqrt(grouped_sum(np.square(normalized), valid_normalized) / n_valid_normalized);
+        l1 = grouped_sum(residual, valid) / n_valid;
+        normalized_l1 = grouped_sum(normalized, valid_normalized) / n_valid_normalized;
+        weighted_rms = np.sqrt(grouped_sum(weights * np.square(residual), valid_normalized) /
+                               grouped_sum(weights, valid_normalized));
+    return MisfitRecord(names=OBS_TYPE_NAMES + ["all"], npts=npts, rms=rms, chi2=chi2, l1=l1,
+                        normalized_l1=normalized_l1, weighted_rms=weighted_rms);
+
+
+def compute_region_misfits(obs_pos, obs_disp, pred_disp, obs_sigma, obs_type, regions):
+    """
+    Misfit metrics within each of several regions.
+
+    :param regions: dictionary of {region name: bbox [W, E, S, N]}
+    :returns: dictionary of {region name: MisfitRecord}
+    """
+    return {name: compute_misfit_record(obs_disp, pred_disp, obs_sigma, obs_type, get_region_mask(obs_pos, bbox))
+            for name, bbox in regions.items()};
+
+
+def get_category_index(record, data_type):
+    """Position of data_type ('all', 'gps', 'insar', 'leveling') in a MisfitRecord"""
+    if data_type not in record.names:
+        raise ValueError("Error! data_type " + data_type + " not recognized. Should be one of " + str(record.names));
+    return record.names.index(data_type);
+
+
 # -------- SIMPLE MISFIT FUNCTIONS ----------- #
 def compute_simple_misfit(_obs_pos, obs_disp, pred_disp, obs_sigma, obs_type, data_type='all', norm="L2"):
     """
     The simplest misfit calculation, from any or all types of data
     Options for data_type: ['all', 'gps', 'insar', 'leveling'];
     Want in both absolute numbers and relative to the respective uncertainties.
+    Returns [rms, chi2, npts] for L2, or [mean absolute misfit, mean normalized absolute misfit, npts] for L1.
     """
-    if data_type == 'all':
-        idx = [index for index, element in enumerate(obs_type) if element != ''];  # take everything in obs vector
-    else:
-        idx = [index for index, element in enumerate(obs_type) if element == data_type];  # filter on data type
-    npts = len(obs_disp[idx]);
-
+    record = compute_misfit_record(obs_disp, pred_disp, obs_sigma, obs_type);
+    i = get_category_index(record, data_type);
     if norm == "L2":
-        # The L2 norm: RMS and Chi Squared Values
-        sq_misfit = np.square(abs(obs_disp[idx] - pred_disp[idx]));
-        norm_misfit = np.divide(sq_misfit, np.square(obs_sigma[idx]));
-        rms_misfit = np.sqrt(np.nanmean(sq_misfit));
-        chisquared = np.sqrt(np.nanmean(norm_misfit));
+        return [record.rms[i], record.chi2[i], record.npts[i]];
     elif norm == "L1":
-        # The L1 norm
-        abs_misfit = np.abs(obs_disp[idx]-pred_disp[idx]);
-        _norm_misfit = np.divide(abs_misfit, obs_sigma[idx]);  # divide by sigma
-        rms_misfit = np.zeros(np.shape(obs_disp[idx]));  # not really used in L1 case
-        chisquared = np.zeros(np.shape(obs_disp[idx]));  # not really used in L1 case
+        return [record.l1[i], record.normalized_l1[i], record.npts[i]];
     else:
         raise ValueError("Norm " + norm + "not recognized. Should be L1 or L2.");
 
-    return [rms_misfit, chisquared, npts];
-
 
-def write_simple_misfit(metrics, outfile):
+def write_simple_misfit(record, outfile):
+    """Write the metrics of all data combined"""
+    i = get_category_index(record, 'all');
     ofile = open(outfile, 'w');  # cleaning the file from last times
     print("Writing %s " % outfile);
-    print("Average total misfit: %f mm" % (1000 * metrics[0]));
-    print("Average normalized misfit: %f sigma \n" % (metrics[1]));
-    ofile.write("Average misfit: %f mm\n" % (1000 * metrics[0]));
-    ofile.write("Average normalized misfit: %f sigma \n" % (metrics[1]));
-    ofile.write("Total npts: %d \n" % metrics[2]);
+    print("Average total misfit: %f mm" % (1000 * record.rms[i]));
+    print("Average normalized misfit: %f sigma \n" % (record.chi2[i]));
+    ofile.write("Average misfit: %f mm\n" % (1000 * record.rms[i]));
+    ofile.write("Average normalized misfit: %f sigma \n" % (record.chi2[i]));
+    ofile.write("Total npts: %d \n" % record.npts[i]);
+    ofile.write("Average absolute misfit: %f mm\n" % (1000 * record.l1[i]));
+    ofile.write("Average normalized absolute misfit: %f sigma \n" % (record.normalized_l1[i]));
+    ofile.write("Weighted RMS misfit: %f mm\n" % (1000 * record.weighted_rms[i]));
     ofile.close();
     return;
 
 
 # -------- COMPOUND MISFIT FUNCTIONS ----------- #
 def compute_compound_misfit(_obs_pos, obs_disp, pred_disp, obs_sigma, obs_type):
-    [gps_misfit, gps_x2, gps_npts] = compute_simple_misfit(_obs_pos, obs_disp, pred_disp, obs_sigma, obs_type,
-                                                           data_type='gps');
-    [ins_misfit, ins_x2, ins_npts] = compute_simple_misfit(_obs_pos, obs_disp, pred_disp, obs_sigma, obs_type,
-                                                           data_type='insar');
-    [lev_misfit, lev_x2, lev_npts] = compute_simple_misfit(_obs_pos, obs_disp, pred_disp, obs_sigma, obs_type,
-                                                           data_type='leveling');
-    return [gps_misfit, gps_x2, gps_npts, ins_misfit, ins_x2, ins_npts, lev_misfit, lev_x2, lev_npts];
+    """Metrics for gps, insar, and leveling respectively. Returns MisfitRecord."""
+    return compute_misfit_record(obs_disp, pred_disp, obs_sigma, obs_type);
 
 
-def write_compound_misfit(metrics, outfile):
+def write_compound_misfit(record, outfile):
+    """Write the metrics of each data type that has observations"""
+    labels = {"gps": "GPS", "insar": "InSAR", "leveling": "Leveling"};
     ofile = open(outfile, 'w');  # cleaning the file from last times
     print("Writing %s " % outfile);
-
-    if metrics[0]:
-        print("Average GPS misfit: %f mm" % (1000*metrics[0]) );
-        print("Average normalized GPS misfit: %f sigma \n" % (metrics[1]) );
-        ofile.write("Average GPS misfit: %f mm\n" % (1000*metrics[0]) );
-        ofile.write("Average normalized GPS misfit: %f sigma \n" % (metrics[1]) );
-        ofile.write("GPS npts: %d \n\n" % metrics[2]);
-
-    if metrics[3]:
-        print("Average InSAR misfit: %f mm" % (1000*metrics[3]) );
-        print("Average normalized InSAR misfit: %f sigma \n" % (metrics[4]) );
-        ofile.write("Average InSAR misfit: %f mm\n" % (1000*metrics[3]) );
-        ofile.write("Average normalized InSAR misfit: %f sigma \n" % (metrics[4]) );
-        ofile.write("InSAR npts: %d \n\n" % metrics[5]);
-
-    if metrics[6]:
-        print("Average Leveling misfit: %f mm" % (1000*metrics[6]) );
-        print("Average normalized Leveling misfit: %f sigma \n" % (metrics[7]) );
-        ofile.write("Average Leveling misfit: %f mm\n" % (1000*metrics[6]) );
-        ofile.write("Average normalized Leveling misfit: %f sigma \n" % (metrics[7]) );
-        ofile.write("Leveling npts: %d \n\n" % metrics[8]);
-
+    for data_type in OBS_TYPE_NAMES:
+        i = get_category_index(record, data_type);
+        if record.npts[i] == 0:
+            continue;
+        label = labels[data_type];
+        print("Average %s misfit: %f mm" % (label, 1000*record.rms[i]));
+        print("Average normalized %s misfit: %f sigma \n" % (label, record.chi2[i]));
+        ofile.write("Average %s misfit: %f mm\n" % (label, 1000*record.rms[i]));
+        ofile.write("Average normalized %s misfit: %f sigma \n" % (label, record.chi2[i]));
+        ofile.write("%s npts: %d \n\n" % (label, record.npts[i]));
     ofile.close();
     return;
 
 
 # -------- BRAWLEY EXPT MISFIT FUNCTIONS ----------- #
-def compute_brawley_misfit(obs_pos, obs_disp, pred_disp, obs_sigma, obs_type):
-    """ Ignore the western part of the domain, specific to Brawley. """
-    idx = np.where(obs_pos[:, 0] > -115.7);  # -116 is pretty global for Brawley
-    idx = idx[0]
-    obs_type = np.array(obs_type);
-    metrics = compute_simple_misfit(obs_pos[idx], obs_disp[idx], pred_disp[idx], obs_sigma[idx], obs_type[idx]);
-    return metrics;
+def compute_brawley_misfit(obs_pos, obs_disp, pred_disp, obs_sigma, obs_type, region=BRAWLEY_REGION):
+    """ Ignore the western part of the domain, specific to Brawley. region is a bbox [W, E, S, N]. """
+    return compute_misfit_record(obs_disp, pred_disp, obs_sigma, obs_type, get_region_mask(obs_pos, region));
 
 
 # -------- SLIP COMPUTE FUNCTIONS ----------- #
@@ -177,20 +243,28 @@ def slip_metrics_driver(config, outfile):
 def get_slip_moments(slip_filename, mu=30e9):
     """
     From inversion results, what is the moment of the slip distribution?
-    mu is shear modulus, in Pa.
+    mu is shear modulus, in Pa (a float, or one value per patch).
     """
-    moment_total = 0;
-    length, width, leftlat, thrust, _ = np.loadtxt(slip_filename, skiprows=1, unpack=True, usecols=(5, 6, 7, 8, 9));
-    for i in range(len(length)):
-        slip = np.sqrt(leftlat[i]*leftlat[i] + thrust[i]*thrust[i]);
-        area = length[i]*width[i];  # m^2
-        momenti = moment_calculations.moment_from_muad(mu, area, slip);
-        moment_total = moment_total+momenti;
+    length, width, leftlat, thrust, _ = np.loadtxt(slip_filename, skiprows=1, unpack=True, usecols=(5, 6, 7, 8, 9),
+                                                   ndmin=2);
+    moment_total = np.sum(moment_tools.patch_moments(length, width, (leftlat, thrust), mu));  # area in m^2
     mw = moment_calculations.mw_from_moment(moment_total);
     print("Calculating moment from %s" % slip_filename);
     return [moment_total, mw];
 
 
+def get_result_moments(result, mu=30e9, epoch=0):
+    """
+    Moment of one epoch's slip distribution, from an in-memory buildG.InversionResult.
+    Same as get_slip_moments on that epoch's slip output file.
+    """
+    slip = np.asarray(result.cardinal_slip[epoch]);
+    moment_total = np.sum(moment_tools.patch_moments(result.patches_length, result.patches_width,
+                                                     (slip[:, 0], slip[:, 1]), mu));  # area in m^2
+    mw = moment_calculations.mw_from_moment(moment_total);
+    return [moment_total, mw];
+
+
 def write_slip_moments(moments, G, filename):
     # moments
     ofile = open(filename, 'w');  # appending to the file
@@ -202,10 +276,27 @@ def write_slip_moments(moments, G, filename):
     return;
 
 
-# -------- ACCESS FUNCTIONS ----------- # 
-def main_function(config):
-    """Misfit can be defined in many ways. Here we point to them. """
-    compound_misfit_driver(config, config["output_dir"]+"summary_stats_compound.txt");  # Separate each data type
-    simple_misfit_driver(config, config["output_dir"] + "summary_stats_simple.txt");  # Combine data into one stack
-    slip_metrics_driver(config, config["output_dir"] + "summary_moments.txt");   # for the amount of slip.
-    return;
+# -------- ACCESS FUNCTIONS ----------- #
+def main_function(config, result=None, write_files=True):
+    """
+    Misfit can be defined in many ways. Here we point to them.
+    With an InversionResult from buildG.beginning_calc, nothing is read from disk.
+    Otherwise, the observation, prediction, and slip files in config are read once.
+
+    :param config: dictionary of inversion parameters
+    :param result: optional buildG.InversionResult
+    :param write_files: bool, whether to write the summary files into the output directory
+    :returns: InversionMetrics
+    """
+    if result is None:
+        [_, obs_disp, pred_disp, obs_sigma, obs_type] = read_obs_vs_predicted_object(config);
+        moments = get_slip_moments(config["output_dir"]+config['epochs']['EpochA']["slip_output_file"], config["G"]);
+    else:
+        obs_disp, pred_disp, obs_sigma, obs_type = result.obs_disp, result.pred_disp, result.obs_sigma, result.obs_type;
+        moments = get_result_moments(result, config["G"]);
+    record = compute_misfit_record(obs_disp, pred_disp, obs_sigma, obs_type);
+    if write_files:
+        write_compound_misfit(record, config["output_dir"]+"summary_stats_compound.txt");  # Separate each data type
+        write_simple_misfit(record, config["output_dir"] + "summary_stats_simple.txt");  # Combine data into one stack
+        write_slip_moments(moments, config["G"], config["output_dir"] + "summary_moments.txt");  # amount of slip
+    return InversionMetrics(misfit=record, moments=moments);
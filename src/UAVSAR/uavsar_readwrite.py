@@ -2,42 +2,173 @@ import datetime as dt
 import matplotlib
 import numpy as np
 import collections
+import netCDF4
+import h5py
 from .. import multiSAR_utilities
+from . import utilities
 from Tectonic_Utils.read_write import netcdf_read_write
 from matplotlib import pyplot as plt, cm as cm
 
 # Collections
 GrdTSData = collections.namedtuple("GrdTSData", ["dtarray", "lon", "lat", "TS"]);
 
+
+class LazyTSCube:
+    """
+    A 3D time series cube (date, row, col) read on demand from a netCDF4/HDF5 variable.
+    Indexing follows numpy: TS[k] or TS[k, :, :] returns one slice, TS[:, i, j] one pixel time series,
+    TS[k, i0:i1, j0:j1] a window. Only the requested hyperslab is read from disk.
+    The trim to the lon/lat raster size is applied as a window on the variable, so nothing is copied.
+    Recently used slices are kept in a small LRU cache and returned read-only, so callers cannot corrupt later reads.
+    If built with its dataset, close() (or a with-block) closes the file.
+    """
+    def __init__(self, variable, nrows, ncols, cache_size=4, dataset=None):
+        self.variable = variable;
+        self.dataset = dataset;
+        self.shape = (variable.shape[0], nrows, ncols);
+        self.ndim = 3;
+        self.dtype = np.dtype(variable.dtype);
+        self.cache_size = cache_size;
+        self._cache = collections.OrderedDict();
+
+    def __len__(self):
+        return self.shape[0];
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.get_slice(k);
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close();
+        return False;
+
+    def close(self):
+        """Close the underlying file, if this cube owns it, and drop the slice cache."""
+        self._cache.clear();
+        if self.dataset is not None:
+            self.dataset.close();
+            self.dataset = None;
+        return;
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:, :, :], dtype=dtype);
+
+    def get_slice(self, k):
+        """Return one trimmed 2D slice (read-only), from the LRU cache if it was used recently."""
+        k = self._check_time_index(k);
+        if k in self._cache:
+            self._cache.move_to_end(k);
+            return self._cache[k];
+        data = np.array(self.variable[k, 0:self.shape[1], 0:self.shape[2]]);
+        data.flags.writeable = False;  # the cached array is shared by every caller
+        self._cache[k] = data;
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False);
+        return data;
+
+    def get_pixel_ts(self, i, j):
+        """Return the time series of one pixel without reading whole slices."""
+        return self[:, i, j];
+
+    def get_window(self, k, i, j, width_pixels):
+        """Return a square window around pixel (i, j) in slice k, clipped at the edges of the raster."""
+        return self[k, max(i - width_pixels, 0):i + width_pixels, max(j - width_pixels, 0):j + width_pixels];
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,);
+        key = key + (slice(None),) * (3 - len(key));
+        tkey, rkey, ckey = key;
+        if isinstance(tkey, (int, np.integer)):
+            return self.get_slice(tkey)[rkey, ckey];
+        # Several dates: read the bounding window of the requested pixels from disk
+        rwindow, rkey = self._spatial_window(rkey, self.shape[1]);
+        cwindow, ckey = self._spatial_window(ckey, self.shape[2]);
+        if isinstance(tkey, slice):
+            data = np.asarray(self.variable[tkey, rwindow, cwindow]);
+        else:
+            tkey = np.asarray(tkey);
+            if tkey.dtype == bool:
+                tkey = np.nonzero(tkey)[0];
+            unique_t, inverse = np.unique(self._check_time_index(tkey), return_inverse=True);
+            data = np.asarray(self.variable[unique_t, rwindow, cwindow])[inverse];  # readers want sorted indices
+        return data[:, rkey, ckey];
+
+    def _check_time_index(self, k):
+        """Convert a date index (int or integer array) to non-negative form, raising IndexError if out of range."""
+        n = self.shape[0];
+        k_arr = np.asarray(k);
+        if np.any(k_arr >= n) or np.any(k_arr < -n):
+            raise IndexError("date index %s out of range for time series of length %d" % (k, n));
+        k_arr = np.where(k_arr < 0, k_arr + n, k_arr);
+        return int(k_arr) if k_arr.ndim == 0 else k_arr;
+
+    @staticmethod
+    def _spatial_window(key, n):
+        """Split a row or column key into a window read from disk and a key applied afterward in memory."""
+        if isinstance(key, (int, np.integer)):
+            if key >= n or key < -n:
+                raise IndexError("pixel index %d out of range for axis of length %d" % (key, n));
+            idx = int(key) + n if key < 0 else int(key);
+            return slice(idx, idx + 1), 0;
+        if isinstance(key, slice) and (key.step is None or key.step > 0):
+            start, stop, step = key.indices(n);
+            return slice(start, max(start, stop)), slice(None, None, step);
+        return slice(0, n), key;
+
+
+def open_3D_netcdf_lazy(filename, tname='t', zname='z'):
+    """
+    Open a 3D netcdf cube for lazy reading, with netCDF4 or with h5py for HDF5-based files.
+    The caller closes the dataset handle when done, directly or through a LazyTSCube built with it.
+    :returns: dataset handle, tdata array, z variable
+    """
+    try:
+        dataset = netCDF4.Dataset(filename, 'r');
+        dataset.set_auto_mask(False);
+    except OSError:
+        dataset = h5py.File(filename, 'r');
+    try:
+        return dataset, np.asarray(dataset[tname][:]), dataset[zname];
+    except Exception:
+        dataset.close();
+        raise;
+
+
 # INPUT FUNCTIONS FOR NETCDF FORMAT
-def inputs_TS_grd(filename, lonfile, latfile, day0=dt.datetime.strptime("2009-04-24", "%Y-%m-%d")):
+def inputs_TS_grd(filename, lonfile, latfile, day0=dt.datetime.strptime("2009-04-24", "%Y-%m-%d"), cache_size=4):
     """
     Reads a TS file with associated lat/lon files
     The files generally are not orthorectified grids
     GRDnetcdf has tdata (days since day0), x, y, and zdata (3D cube)
     lon and lat files are 2D arrays with corresponding lon and lat for each point
     day0 is the day of the first acquisition in the time series (hard coded for a UAVSAR track default)
+    The 3D cube is not read into memory. The TS field is a LazyTSCube that reads slices on demand.
+    The file stays open until TS.close() is called, or until the end of a "with myGridTS.TS:" block.
     """
     print("Reading TS Grid file  %s" % filename);
-    [tdata, _, _, zdata] = netcdf_read_write.read_3D_netcdf(filename);
+    [dataset, tdata, zvariable] = open_3D_netcdf_lazy(filename);
     print("tdata:", tdata);
     print("   where Day0 of this time series is %s " % dt.datetime.strftime(day0, "%Y-%m-%d"));
     [_, _, lon] = netcdf_read_write.read_any_grd(lonfile);
     [_, _, lat] = netcdf_read_write.read_any_grd(latfile);
     print("lon and lat:", np.shape(lon));
-    print("zdata:", np.shape(zdata));
-    zdata_correct_size = [];
-    if np.shape(zdata[0])[0] == np.shape(lon)[0]+1 and np.shape(zdata[0])[1] == np.shape(lat)[1]+1:
-        for i in range(len(zdata)):
-            zdata_correct_size.append(zdata[i][0:-1, 0:-1]);  # cutting off one pixel on each end for pixel node problem
-    else:
-        zdata_correct_size = zdata;
+    print("zdata:", np.shape(zvariable));
+    nrows, ncols = np.shape(lon);
+    if zvariable.shape[1] == nrows + 1 and zvariable.shape[2] == ncols + 1:
+        print("   cutting off one pixel on each end for pixel node problem");
+    elif zvariable.shape[1] != nrows or zvariable.shape[2] != ncols:
+        dataset.close();
+        raise ValueError("Lon and Data size don't match");
+    zdata_correct_size = LazyTSCube(zvariable, nrows, ncols, cache_size=cache_size, dataset=dataset);
     dtarray = [];
     for i in range(len(tdata)):
         dtarray.append(day0 + dt.timedelta(days=int(tdata[i])));
 
-    assert(np.shape(lon) == np.shape(zdata_correct_size[0])), ValueError("Lon and Data size don't match");
-    assert(np.shape(lat) == np.shape(zdata_correct_size[0])), ValueError("Lat and Data size don't match");
+    assert(np.shape(lat) == np.shape(lon)), ValueError("Lat and Data size don't match");
     assert(np.shape(zdata_correct_size)[0] == len(dtarray)), ValueError("dtarray and zdata size don't match");
     myGridTS = GrdTSData(dtarray=dtarray, lon=lon, lat=lat, TS=zdata_correct_size);
     return myGridTS;
@@ -68,8 +199,8 @@ def plot_grid_TS_redblue(TS_GRD_OBJ, outfile, vmin=-50, vmax=200, aspect=1, incr
         data = data.T;  # for making a nice map with west approximately to the left.
         data = np.fliplr(data);  # for making a nice map with west approximately to the left.
 
-        gps_j_flipped = gps_j;
-        gps_i_flipped = [np.shape(data)[1] - x for x in gps_i];
+        gps_j_flipped = gps_j if gps_j is not None else [];
+        gps_i_flipped = [np.shape(data)[1] - x for x in gps_i] if gps_i is not None else [];
 
         # Plotting now
         rownum, colnum = get_axarr_numbers(num_cols_plots, i);
@@ -103,30 +234,32 @@ def get_axarr_numbers(cols, idx):
     return row_num, col_num;
 
 
-def plot_pixel_ts(TS, dtarray, i, j, name, outdir):
-    pixel_value, pixel_value2 = [], [];
-    width_pixels = 80;
-    for date in range(len(dtarray)):
-        pixel_value.append(np.nanmean(TS[date, i - width_pixels:i + width_pixels, j - width_pixels:j + width_pixels]));
-        pixel_value2.append(TS[date, i, j]);
+def plot_pixel_ts(dtarray, window_ts, pixel_ts, name, outdir):
+    """Plot one station's window-averaged and single-pixel time series, as extracted by get_station_window_means"""
     plt.figure(figsize=(8, 8));
-    plt.plot(dtarray, pixel_value, '.--', markersize=12);
-    plt.plot(dtarray, pixel_value2, '.--', color='red', markersize=12);
+    plt.plot(dtarray, window_ts, '.--', markersize=12);
+    plt.plot(dtarray, pixel_ts, '.--', color='red', markersize=12);
     plt.xlabel("Time");
     plt.ylabel("Displacement (mm)");
     plt.savefig(outdir + "/" + name + "_onepixel.png");
+    plt.close();
     return;
 
 
 def total_ts_visualizing(myUAVSAR, gps_lon, gps_lat, gps_names, selected, outdir):
     """Vizualizations for grid time series format
-    GPS points can be added by index. For future work. """
+    GPS points are located in the raster all at once, and their time series are extracted in one batch. """
+    ipts, jpts, _ = multiSAR_utilities.get_nearest_pixels_in_raster(myUAVSAR.lon, myUAVSAR.lat, gps_lon, gps_lat);
+    inside = ipts >= 0;
     plot_grid_TS_redblue(myUAVSAR, outdir + "/increments.png", vmin=-100, vmax=100, aspect=4,
-                         incremental=True, gps_i=None, gps_j=None, selected=selected);
+                         incremental=True, gps_i=ipts[inside], gps_j=jpts[inside], selected=selected);
     plot_grid_TS_redblue(myUAVSAR, outdir + "/full_TS.png", vmin=-160, vmax=160, aspect=4,
-                         incremental=False, gps_i=None, gps_j=None, selected=selected);
+                         incremental=False, gps_i=ipts[inside], gps_j=jpts[inside], selected=selected);
     # Comparing InSAR TS with GPS
+    window_ts, pixel_ts = utilities.get_station_window_means(myUAVSAR.TS, ipts, jpts, width_pixels=80);
     for i in range(len(gps_lon)):
-        ipt, jpt = multiSAR_utilities.get_nearest_pixel_in_raster(myUAVSAR.lon, myUAVSAR.lat, gps_lon[i], gps_lat[i]);
-        plot_pixel_ts(myUAVSAR.TS, myUAVSAR.dtarray, ipt, jpt, gps_names[i], outdir);
+        if not inside[i]:
+            print("Station %s is outside the UAVSAR domain" % gps_names[i]);
+            continue;
+        plot_pixel_ts(myUAVSAR.dtarray, window_ts[i], pixel_ts[i], gps_names[i], outdir);
     return;
@@ -11,6 +11,7 @@ and writes los.rdr.geo in isce format too.  Useful for Kite downsampling next.
 import numpy as np
 import matplotlib.pyplot as plt
 import subprocess
+import concurrent.futures
 from S1_batches.read_write_insar_utilities import jpl_uav_read_write, isce_read_write, netcdf_plots
 from S1_batches.intf_generating import isce_geocode_tools
 from S1_batches.math_tools import mask_and_interpolate
@@ -24,14 +25,166 @@ def read_jpl_ground_range_data(data_file_slant, corr_file_slant, ann_file):
     return real, imag, corr;
 
 
-def cut_and_write_out_igram(real, imag, corr, cut_rowcol):
-    """Cut imag, real, and corr arrays; write them in lots of formats."""
+def get_ground_range_shape_from_ann(ann_file):
+    """Read the number of rows and cols of the ground range products from a UAVSAR annotation file."""
+    rows, cols = None, None;
+    ifile = open(ann_file, 'r');
+    for line in ifile:
+        if line.startswith("Ground Range Data Latitude Lines") or line.startswith("grd_phs.set_rows"):
+            rows = int(line.split('=')[1].split()[0]);
+        if line.startswith("Ground Range Data Longitude Samples") or line.startswith("grd_phs.set_cols"):
+            cols = int(line.split('=')[1].split()[0]);
+    ifile.close();
+    if rows is None or cols is None:
+        raise ValueError("Error! Could not find ground range dimensions in %s " % ann_file);
+    return rows, cols;
+
+
+def memmap_jpl_ground_range_data(data_file, corr_file, ann_file):
+    """
+    Memory-map the JPL ground range interferogram (complex64) and coherence (float32) without reading them.
+    :returns: igram, corr, as read-only numpy memmaps of shape (rows, cols)
+    """
+    rows, cols = get_ground_range_shape_from_ann(ann_file);
+    print("Memory-mapping %s and %s with %d rows and %d cols" % (data_file, corr_file, rows, cols));
+    igram = np.memmap(data_file, dtype='<c8', mode='r', shape=(rows, cols));
+    corr = np.memmap(corr_file, dtype='<f4', mode='r', shape=(rows, cols));
+    return igram, corr;
+
+
+def multilook_array(data, looks_y, looks_x):
+    """
+    Average non-overlapping blocks of looks_y rows by looks_x cols, like looks.py.
+    Trailing rows and cols that do not fill a whole block are dropped.
+    """
+    ny, nx = np.shape(data)[0] // looks_y, np.shape(data)[1] // looks_x;
+    blocks = data[0:ny * looks_y, 0:nx * looks_x].reshape(ny, looks_y, nx, looks_x);
+    return blocks.mean(axis=(1, 3), dtype=blocks.dtype);
+
+
+def multilook_igram_and_coherence(igram, corr, looks_x, looks_y, coherence_weighted=False):
+    """
+    Multilook a complex interferogram and its coherence in memory, replacing two looks.py calls.
+    With coherence_weighted, each complex look is a coherence-weighted average of its pixels.
+
+    :param igram: 2D complex array
+    :param corr: 2D float array
+    :param looks_x: int
+    :param looks_y: int
+    :param coherence_weighted: bool
+    :returns: multilooked igram (complex64), multilooked corr (float32)
+    """
+    igram = np.asarray(igram, dtype=np.complex64);
+    corr = np.asarray(corr, dtype=np.float32);
+    ml_corr = multilook_array(corr, looks_y, looks_x);
+    if coherence_weighted:
+        weighted_sum = multilook_array(igram * corr, looks_y, looks_x);
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ml_igram = np.where(ml_corr > 0, weighted_sum / ml_corr, 0).astype(np.complex64);
+    else:
+        ml_igram = multilook_array(igram, looks_y, looks_x);
+    return ml_igram, ml_corr;
+
+
+def multilook_one_igram(igram_tuple):
+    """
+    Worker for a pool of interferograms.
+    :param igram_tuple: (data_file, corr_file, ann_file, cut_rowcol, looks_x, looks_y, cor_cutoff, coherence_weighted)
+    :returns: multilooked igram, multilooked corr, masked phase, coherence mask
+    """
+    data_file, corr_file, ann_file, cut_rowcol, looks_x, looks_y, cor_cutoff, coherence_weighted = igram_tuple;
+    igram, corr = memmap_jpl_ground_range_data(data_file, corr_file, ann_file);
+    return tiled_cut_multilook_and_mask(igram, corr, cut_rowcol, looks_x, looks_y, cor_cutoff,
+                                        coherence_weighted=coherence_weighted);
+
+
+def multilook_many_igrams(igram_tuples, num_workers=4):
+    """
+    Multilook and mask several interferograms in parallel processes.
+    :param igram_tuples: list of tuples as in multilook_one_igram
+    :param num_workers: int
+    :returns: list of results from multilook_one_igram, in the same order as igram_tuples
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = list(executor.map(multilook_one_igram, igram_tuples));
+    return results;
+
+
+def tiled_cut_multilook_and_mask(igram, corr, cut_rowcol, looks_x, looks_y, cor_cutoff, tile_rows=1000,
+                                 coherence_weighted=False):
+    """
+    Stream the cut region of a (memory-mapped) interferogram and coherence in blocks of rows.
+    Each tile is multilooked, converted to phase, and masked by coherence before the next tile is read,
+    so peak memory depends on the tile size and not on the frame size.
+
+    :param igram: 2D complex array, such as a memmap of the .int.grd file
+    :param corr: 2D float array, such as a memmap of the .cor.grd file
+    :param cut_rowcol: [row0, row1, col0, col1] of the region to keep
+    :param looks_x: int
+    :param looks_y: int
+    :param cor_cutoff: float, coherence cutoff for the mask
+    :param tile_rows: int, number of full-resolution rows per tile (rounded down to a multiple of looks_y)
+    :param coherence_weighted: bool, use coherence-weighted complex looks
+    :returns: multilooked igram, multilooked corr, masked phase, coherence mask
+    """
+    ny = (cut_rowcol[1] - cut_rowcol[0]) // looks_y;
+    nx = (cut_rowcol[3] - cut_rowcol[2]) // looks_x;
+    col0, col1 = cut_rowcol[2], cut_rowcol[2] + nx * looks_x;
+    tile_rows = max(looks_y, (tile_rows // looks_y) * looks_y);
+    ml_igram = np.zeros((ny, nx), dtype=np.complex64);
+    ml_corr = np.zeros((ny, nx), dtype=np.float32);
+    masked_phase = np.zeros((ny, nx), dtype=np.float32);
+    coherence_mask = np.zeros((ny, nx), dtype=np.float32);
+    print("Multilooking and masking %d x %d pixels in tiles of %d rows" % (ny * looks_y, nx * looks_x, tile_rows));
+    for row0 in range(cut_rowcol[0], cut_rowcol[0] + ny * looks_y, tile_rows):
+        row1 = min(row0 + tile_rows, cut_rowcol[0] + ny * looks_y);
+        out0, out1 = (row0 - cut_rowcol[0]) // looks_y, (row1 - cut_rowcol[0]) // looks_y;
+        igram_tile, corr_tile = multilook_igram_and_coherence(igram[row0:row1, col0:col1], corr[row0:row1, col0:col1],
+                                                              looks_x, looks_y, coherence_weighted);
+        mask_tile = mask_and_interpolate.make_coherence_mask(corr_tile, cor_cutoff);
+        ml_igram[out0:out1, :] = igram_tile;
+        ml_corr[out0:out1, :] = corr_tile;
+        coherence_mask[out0:out1, :] = mask_tile;
+        masked_phase[out0:out1, :] = mask_and_interpolate.apply_coherence_mask(np.angle(igram_tile), mask_tile);
+    return ml_igram, ml_corr, masked_phase, coherence_mask;
+
+
+def write_tiled_products(ml_igram, ml_corr, masked_phase, after_filtering, after_filtering_corr,
+                         write_intermediates=False):
+    """
+    Write the coherence grid needed for unwrapping.
+    Filtered isce files, phase grids, and their plots are only written if write_intermediates is True.
+    """
+    xdata = range(0, np.shape(ml_corr)[1]);
+    ydata = range(0, np.shape(ml_corr)[0]);
+    netcdf_read_write.produce_output_netcdf(xdata, ydata, ml_corr, 'corr', 'corr.grd', dtype=float);
+    if not write_intermediates:
+        return;
+    (ny, nx) = np.shape(ml_corr);
+    isce_read_write.write_isce_data(ml_igram, nx, ny, 'CFLOAT', after_filtering);
+    isce_read_write.write_isce_data(ml_corr, nx, ny, 'FLOAT', after_filtering_corr);
+    netcdf_read_write.produce_output_netcdf(xdata, ydata, np.angle(ml_igram), 'radians', 'phase_filtered.grd');
+    netcdf_read_write.produce_output_netcdf(xdata, ydata, masked_phase, 'radians', 'phase_masked.grd', dtype=float);
+    netcdf_plots.produce_output_plot('phase_filtered.grd', 'Phase', 'phase_filtered.png', 'phase', aspect=1.0,
+                                     invert_yaxis=False);
+    netcdf_plots.produce_output_plot('phase_masked.grd', 'Phase', 'phase_masked.png', 'phase', aspect=1.0,
+                                     invert_yaxis=False);
+    netcdf_plots.produce_output_plot('corr.grd', 'Coherence', 'corr.png', 'corr', aspect=1.0, cmap='binary_r',
+                                     invert_yaxis=False);
+    return;
+
+
+def cut_and_write_out_igram(real, imag, corr, cut_rowcol, write_files=True):
+    """Cut imag, real, and corr arrays; write them in lots of formats if write_files.
+    Returns the cut complex interferogram and coherence for in-memory filtering."""
     real = real[cut_rowcol[0]:cut_rowcol[1], cut_rowcol[2]:cut_rowcol[3]];
     imag = imag[cut_rowcol[0]:cut_rowcol[1], cut_rowcol[2]:cut_rowcol[3]];
     corr = corr[cut_rowcol[0]:cut_rowcol[1], cut_rowcol[2]:cut_rowcol[3]];
     phase = np.arctan2(imag, real);
     complex_numbers = np.float32(real) + 1j * np.float32(imag);
     cor32 = np.float32(corr);
+    if not write_files:
+        return complex_numbers, cor32;
     xdata = range(0, np.shape(phase)[1]);
     ydata = range(0, np.shape(phase)[0]);
     (ny, nx) = np.shape(phase);
@@ -42,7 +195,7 @@ def cut_and_write_out_igram(real, imag, corr, cut_rowcol):
                                      invert_yaxis=False);
     isce_read_write.write_isce_data(complex_numbers, nx, ny, 'CFLOAT', 'cut_slc.int');
     isce_read_write.write_isce_data(cor32, nx, ny, 'FLOAT', 'cut_cor.cor');
-    return;
+    return complex_numbers, cor32;
 
 
 def filter_with_looks_py(after_filtering, after_filtering_corr, looks_x, looks_y):
@@ -56,9 +209,21 @@ def filter_with_looks_py(after_filtering, after_filtering_corr, looks_x, looks_y
     return;
 
 
+def filter_with_numpy_looks(cut_igram, cut_corr, looks_x, looks_y, coherence_weighted=False, plot=True):
+    """
+    # FILTER STEP: Multilook in memory instead of with looks.py.
+    :returns: multilooked igram and corr arrays, ready for multiply_igram_by_coherence_mask
+    """
+    ml_igram, ml_corr = multilook_igram_and_coherence(cut_igram, cut_corr, looks_x, looks_y, coherence_weighted);
+    if plot:
+        plotting_filtering(np.angle(cut_igram), np.angle(ml_igram));
+    return ml_igram, ml_corr;
+
+
 def plotting_filtering(before_file, after_file):
-    before_phase = isce_read_write.read_phase_data(before_file);
-    after_phase = isce_read_write.read_phase_data(after_file);
+    """Before and after phase, given as isce filenames or as phase arrays"""
+    before_phase = isce_read_write.read_phase_data(before_file) if isinstance(before_file, str) else before_file;
+    after_phase = isce_read_write.read_phase_data(after_file) if isinstance(after_file, str) else after_file;
     f, axarr = plt.subplots(1, 2, figsize=(10, 8), dpi=300);
     axarr[0].imshow(before_phase, cmap='rainbow');
     axarr[0].set_title('Before')
@@ -69,9 +234,16 @@ def plotting_filtering(before_file, after_file):
 
 
 def multiply_igram_by_coherence_mask(after_filtering, after_filtering_corr, cutoff):
-    """Multiply by coherence mask"""
-    phase = isce_read_write.read_phase_data(after_filtering);
-    corr = isce_read_write.read_scalar_data(after_filtering_corr);
+    """Multiply by coherence mask.
+    Inputs are either isce filenames, or arrays (complex igram or phase, and corr) from filter_with_numpy_looks."""
+    if isinstance(after_filtering, str):
+        phase = isce_read_write.read_phase_data(after_filtering);
+    else:
+        phase = np.angle(after_filtering) if np.iscomplexobj(after_filtering) else after_filtering;
+    if isinstance(after_filtering_corr, str):
+        corr = isce_read_write.read_scalar_data(after_filtering_corr);
+    else:
+        corr = after_filtering_corr;
     coherence_mask = mask_and_interpolate.make_coherence_mask(corr, cutoff);
     masked_phase = mask_and_interpolate.apply_coherence_mask(phase, coherence_mask);
     xdata = range(0, np.shape(phase)[1]);
@@ -111,7 +283,7 @@ def read_and_reapply_mask(mask):  # re-apply the mask
 
 
 def main(ann_file, data_file, corr_file, after_filtering, after_filtering_corr, cut_rowcol, cor_cutoff, looks_x,
-         looks_y, wavelength):
+         looks_y, wavelength, tile_rows=1000, write_intermediates=False, coherence_weighted=False):
     # Example: ann_file = "Downloads/SanAnd_08508_11073-010_12083-007_0321d_s01_L090HH_01.ann";
     # data_file = "Downloads/SanAnd_08508_11073-010_12083-007_0321d_s01_L090HH_01.int.grd";  # 1 GB
     # corr_file = "Downloads/SanAnd_08508_11073-010_12083-007_0321d_s01_L090HH_01.cor.grd";  # 500 Mb
@@ -122,16 +294,15 @@ def main(ann_file, data_file, corr_file, after_filtering, after_filtering_corr,
     # wavelength=237.9;  # mm
     # looks_y = 5;
     # looks_x = 5;
+    # tile_rows = 1000;  # full-resolution rows held in memory at once
 
-    # # WE BEGIN WITH CUTTING, WRITING, AND FILTERING THE INTERFEROGRAM.
-    real, imag, corr = read_jpl_ground_range_data(data_file, corr_file, ann_file);
-    cut_and_write_out_igram(real, imag, corr, cut_rowcol);  # cut and write in many formats
-    filter_with_looks_py(after_filtering, after_filtering_corr, looks_x,
-                         looks_y);  # Filter the igrams using ISCE's toolkit
+    # # WE BEGIN WITH STREAMING THE CUT REGION: MULTILOOK AND MASK BY COHERENCE, TILE BY TILE
+    igram, corr = memmap_jpl_ground_range_data(data_file, corr_file, ann_file);
+    ml_igram, ml_corr, masked_phase, mask = tiled_cut_multilook_and_mask(igram, corr, cut_rowcol, looks_x, looks_y,
+                                                                         cor_cutoff, tile_rows, coherence_weighted);
+    write_tiled_products(ml_igram, ml_corr, masked_phase, after_filtering, after_filtering_corr, write_intermediates);
 
-    # # MASK, INTERPOLATE, AND UNWRAP STEP
-    masked_phase, mask = multiply_igram_by_coherence_mask(after_filtering, after_filtering_corr,
-                                                          cor_cutoff);  # multiply by coherence mask
+    # # INTERPOLATE AND UNWRAP STEP
     phase_interpolation(masked_phase);  # perform phase interpolation
     subprocess.call(['/Users/kmaterna/Documents/B_Research/Salton/Brawley_multiSAR_project/Code/custom_unwrap.sh'],
                     shell=True);  # THEN UNWRAP
@@ -13,10 +13,47 @@ def avg_uavsar_disp(TS, slicenum, row, col):
     return np.nanmean(TS[slicenum, row - width_pixels:row + width_pixels, col - width_pixels:col + width_pixels]);
 
 
+def get_station_window_means(TS, rows, cols, width_pixels=80):
+    """
+    Extract time series at many pixels at once: the mean of a square window around each pixel, and the pixel itself.
+    Window sums come from a summed-area table of each slice, so every slice is reduced once for all stations.
+
+    :param TS: 3D array-like (date, row, col), such as the TS field of a GrdTSData
+    :param rows: array of row indices of the stations (-1 for stations outside the raster)
+    :param cols: array of col indices of the stations (-1 for stations outside the raster)
+    :param width_pixels: int, half-width of the averaging window
+    :returns: window_means, pixel_values, each a (stations x dates) array
+    """
+    rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int);
+    inside = (rows >= 0) & (cols >= 0);
+    num_dates, nrows, ncols = np.shape(TS);
+    r0, r1 = np.clip(rows - width_pixels, 0, nrows), np.clip(rows + width_pixels, 0, nrows);
+    c0, c1 = np.clip(cols - width_pixels, 0, ncols), np.clip(cols + width_pixels, 0, ncols);
+    window_means = np.full((len(rows), num_dates), np.nan);
+    pixel_values = np.full((len(rows), num_dates), np.nan);
+    for k in range(num_dates):
+        data = np.asarray(TS[k, :, :], dtype=np.float64);
+        valid = ~np.isnan(data);
+        sums, counts = summed_area_table(np.where(valid, data, 0)), summed_area_table(valid.astype(np.float64));
+        window_sums = sums[r1, c1] - sums[r0, c1] - sums[r1, c0] + sums[r0, c0];
+        window_counts = counts[r1, c1] - counts[r0, c1] - counts[r1, c0] + counts[r0, c0];
+        with np.errstate(invalid='ignore', divide='ignore'):
+            window_means[inside, k] = (window_sums / window_counts)[inside];
+        pixel_values[inside, k] = data[rows[inside], cols[inside]];
+    return window_means, pixel_values;
+
+
+def summed_area_table(data):
+    """Summed-area table with a leading row and column of zeros, so window sums need no edge cases."""
+    table = np.zeros((np.shape(data)[0] + 1, np.shape(data)[1] + 1));
+    table[1:, 1:] = np.cumsum(np.cumsum(data, axis=0), axis=1);
+    return table;
+
+
 def get_onetime_displacements(myGridTS, start_idx, end_idx):
     """ Turns a GridTS object into an InSAR_1D_Object.
-    Turning a raster into a vector in the process."""
-    los_raster = np.subtract(myGridTS.TS[end_idx][:, :], myGridTS.TS[start_idx][:, :]);
+    Turning a raster into a vector in the process. Only the two requested epochs are read."""
+    los_raster = np.subtract(myGridTS.TS[end_idx, :, :], myGridTS.TS[start_idx, :, :]);
     los_vector = np.reshape(los_raster, (np.size(los_raster),));
     lon_vector = np.reshape(myGridTS.lon, (np.size(los_raster),));
     lat_vector = np.reshape(myGridTS.lat, (np.size(los_raster),));
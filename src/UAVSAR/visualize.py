@@ -21,6 +21,7 @@ def visualize_timedep_timeseries(config_filename, gps_filename, outdir):
     selected_epochs = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]);  # allows you to combine intervals if necessary
     # selected currently breaks because it's a list not slices. But this is not a big deal.
     uavsar_readwrite.total_ts_visualizing(myUAVSAR_TS, gps_lons, gps_lats, gps_names, selected_epochs, outdir);
+    myUAVSAR_TS.TS.close();
     return;
 
 
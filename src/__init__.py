@@ -1 +1,4 @@
 from . import multiSAR_utilities
+from . import cache_utilities
+from . import task_runner
+from . import pipeline
@@ -17,10 +17,121 @@ import matplotlib.pyplot as plt
 import matplotlib
 import matplotlib.cm as cm
 import datetime as dt
-import sys
+import sys, collections
+import concurrent.futures
 from Geodesy_Modeling.src import multiSAR_utilities, InSAR_1D_Object, Leveling_Object, UAVSAR
 from Tectonic_Utils.read_write import general_python_io_functions
 
+# One InSAR dataset, loaded and cleaned once. proj_data is the data used for comparison (maybe pseudo-vertical).
+# gps: (lons, lats, names) to annotate on the map, or None
+InSARProduct = collections.namedtuple('InSARProduct', ['sat', 'data', 'proj_data', 'label', 'graph_scale', 'gps']);
+# One comparison to make: name of an InSARProduct, [start, end] indices into the leveling dates, output figure
+ComparisonSpec = collections.namedtuple('ComparisonSpec', ['product', 'lev_slice', 'outfile']);
+ComparisonResult = collections.namedtuple('ComparisonResult', ['spec', 'leveling_title', 'satellite_title', 'lon',
+                                                               'lat', 'oto_lev', 'oto_insar', 'misfit', 'r2',
+                                                               'reference_insar_los']);
+
+
+def make_insar_product(InSAR_Data, sat, label="LOS", graph_scale=80, proj_vertical=0, lkv=(0, 0, 1), gps=None):
+    """Can do LOS or projected pseudo-vertical, depending on experimental step"""
+    if proj_vertical:  # experimental step
+        proj_InSAR_Data = InSAR_1D_Object.utilities.proj_los_into_vertical_no_horiz(InSAR_Data, const_lkv=lkv);
+    else:
+        proj_InSAR_Data = InSAR_Data;
+    return InSARProduct(sat=sat, data=InSAR_Data, proj_data=proj_InSAR_Data, label=label, graph_scale=graph_scale,
+                        gps=gps);
+
+
+def compare_all_pairs(lev_network, products, specs):
+    """
+    Compute the one-to-one arrays, misfit, and r^2 of every (leveling slice, InSAR product) comparison.
+    Each product gets one spatial index and one pass over its pixels, shared by all of its leveling slices.
+    The first leveling benchmark is the datum Y-1225, so InSAR near it is used as the InSAR reference.
+
+    :param lev_network: LevNetwork of leveling, referenced to the datum
+    :param products: dictionary of {name: InSARProduct}
+    :param specs: list of ComparisonSpec
+    :returns: list of ComparisonResult, matching specs
+    """
+    insar_disps, reference_values = {}, {};
+    for name in sorted(set(spec.product for spec in specs)):
+        product = products[name];
+        print("Finding target leveling pixels in %s" % name);
+        operator, inside, _ = multiSAR_utilities.get_close_pixel_operator(product.data.lon, product.data.lat,
+                                                                          lev_network.lon, lev_network.lat);
+        station_means = multiSAR_utilities.close_pixel_means(operator, product.proj_data.LOS);
+        reference_values[name] = station_means[0];  # InSAR disp near lev. refpixel.
+        insar_disps[name] = np.where(inside, station_means - station_means[0], np.nan);
+
+    lev_rows, insar_rows = [], [];
+    for spec in specs:
+        lev_rows.append(1000 * (lev_network.leveling[:, spec.lev_slice[1]] -
+                                lev_network.leveling[:, spec.lev_slice[0]]));  # negative sign convention
+        insar_rows.append(insar_disps[spec.product]);
+    lev_rows, insar_rows = np.array(lev_rows), np.array(insar_rows);
+    valid = ~np.isnan(lev_rows) & ~np.isnan(insar_rows);
+    misfits, r2s = multiSAR_utilities.compute_difference_metrics_batch(np.where(valid, lev_rows, np.nan),
+                                                                       np.where(valid, insar_rows, np.nan));
+
+    results = [];
+    for i, spec in enumerate(specs):
+        InSAR_Data = products[spec.product].data;
+        leveling_title = "Leveling: " + dt.datetime.strftime(lev_network.dtarray[spec.lev_slice[0]], "%m-%Y") + \
+                         " to " + dt.datetime.strftime(lev_network.dtarray[spec.lev_slice[1]], "%m-%Y");
+        satellite_title = products[spec.product].sat + ": " + dt.datetime.strftime(InSAR_Data.starttime, "%m-%Y") + \
+            " to " + dt.datetime.strftime(InSAR_Data.endtime, "%m-%Y");
+        results.append(ComparisonResult(spec=spec, leveling_title=leveling_title, satellite_title=satellite_title,
+                                        lon=lev_network.lon[valid[i]], lat=lev_network.lat[valid[i]],
+                                        oto_lev=lev_rows[i][valid[i]], oto_insar=insar_rows[i][valid[i]],
+                                        misfit=misfits[i], r2=r2s[i],
+                                        reference_insar_los=reference_values[spec.product]));
+    return results;
+
+
+def write_one_to_one_text(result):
+    filename_txt = result.spec.outfile.split('.')[0]+'.txt'
+    print("Writing %s" % filename_txt);
+    ofile = open(filename_txt, 'w');
+    ofile.write("# leveling los / "+result.leveling_title + ' / ' + result.satellite_title + '\n');
+    for i in range(len(result.oto_lev)):
+        ofile.write("%f %f \n" % (result.oto_lev[i], result.oto_insar[i]) );
+    ofile.close();
+    return;
+
+
+def write_comparison_summary(results, filename):
+    """One table with the misfit and r^2 of every comparison"""
+    print("Writing %s" % filename);
+    ofile = open(filename, 'w');
+    ofile.write("# product lev_start lev_end num_pixels avg_misfit(mm) r2 outfile\n");
+    for result in results:
+        ofile.write("%s %d %d %d %.3f %.3f %s\n" % (result.spec.product, result.spec.lev_slice[0],
+                                                    result.spec.lev_slice[1], len(result.oto_lev), result.misfit,
+                                                    result.r2, result.spec.outfile));
+    ofile.close();
+    return;
+
+
+def render_comparison_figures(results, lev_network, products, num_workers=4, vmin=-50, vmax=50):
+    """Render the 4-panel figure of each comparison in a process pool, after all the numbers are computed"""
+    jobs = [(result, lev_network.lon, lev_network.lat, products[result.spec.product], vmin, vmax)
+            for result in results];
+    if num_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(plot_one_to_one_job, jobs));
+    else:
+        for job in jobs:
+            plot_one_to_one_job(job);
+    return;
+
+
+def plot_one_to_one_job(job):
+    result, lev_lons, lev_lats, product, vmin, vmax = job;
+    gps_lon, gps_lat, gps_names = product.gps if product.gps is not None else (None, None, None);
+    plot_one_to_one(result, lev_lons, lev_lats, product.data, product.sat, vmin=vmin, vmax=vmax, gps_lon=gps_lon,
+                    gps_lat=gps_lat, gps_names=gps_names, graph_scale=product.graph_scale, label=product.label);
+    return;
+
 
 def one_to_one_comparison(myLev, InSAR_Data, sat, filename, vmin=-50, vmax=50, gps_lon=None, gps_lat=None,
                           gps_names=None, graph_scale=80, label="LOS", proj_vertical=0, lkv=(0, 0, 1)):
@@ -32,35 +143,23 @@ def one_to_one_comparison(myLev, InSAR_Data, sat, filename, vmin=-50, vmax=50, g
     vmin/vmax : float, in mm
     Can do LOS or projected pseudo-vertical, depending on experimental step
     """
-    if proj_vertical:  # experimental step
-        proj_InSAR_Data = InSAR_1D_Object.utilities.proj_los_into_vertical_no_horiz(InSAR_Data, const_lkv=lkv);
-    else:
-        proj_InSAR_Data = InSAR_Data;
+    gps = (gps_lon, gps_lat, gps_names) if gps_lon is not None else None;
+    product = make_insar_product(InSAR_Data, sat, label, graph_scale, proj_vertical, lkv, gps);
+    lev_network = Leveling_Object.leveling_inputs.lev_list_to_network(myLev);
+    [result] = compare_all_pairs(lev_network, {sat: product}, [ComparisonSpec(product=sat, lev_slice=[0, 1],
+                                                                               outfile=filename)]);
+    plot_one_to_one(result, lev_network.lon, lev_network.lat, InSAR_Data, sat, vmin, vmax, gps_lon, gps_lat,
+                    gps_names, graph_scale, label);
+    write_one_to_one_text(result);
+    return;
 
-    lon_plotting, lat_plotting = [], [];
-    lon_leveling_list = [item.lon for item in myLev];
-    lat_leveling_list = [item.lat for item in myLev];
-    vector_index, close_pixels = multiSAR_utilities.find_pixels_idxs_in_InSAR_Obj(InSAR_Data, lon_leveling_list,
-                                                                                  lat_leveling_list);
-
-    reference_insar_los = np.nanmean(np.array(proj_InSAR_Data.LOS)[close_pixels[0]]);  # InSAR disp near lev. refpixel.
-    # the first element of leveling is the datum Y-1225, so it should be used as reference for InSAR
-
-    # Get the one-to-one pixels
-    oto_lev, oto_tsx = [], [];
-    for i in range(len(lon_leveling_list)):
-        if np.isnan(vector_index[i]):
-            continue;
-        else:
-            leveling_disp = 1000 * (myLev[i].leveling[1] - myLev[i].leveling[0])  # negative sign convention
-            insar_disp = np.nanmean(np.array(proj_InSAR_Data.LOS)[close_pixels[i]]) - reference_insar_los;
-            if ~np.isnan(leveling_disp) and ~np.isnan(insar_disp):
-                oto_lev.append(leveling_disp);
-                oto_tsx.append(insar_disp);
-                lon_plotting.append(lon_leveling_list[i]);
-                lat_plotting.append(lat_leveling_list[i]);
-    # Computing misfit
-    misfit_metric, r2 = multiSAR_utilities.compute_difference_metrics_on_same_pixels(oto_lev, oto_tsx);
+
+def plot_one_to_one(result, lon_leveling_list, lat_leveling_list, InSAR_Data, sat, vmin=-50, vmax=50, gps_lon=None,
+                    gps_lat=None, gps_names=None, graph_scale=80, label="LOS"):
+    """The 4-panel comparison figure of one ComparisonResult"""
+    oto_lev, oto_tsx = result.oto_lev, result.oto_insar;
+    lon_plotting, lat_plotting = result.lon, result.lat;
+    reflon, reflat = lon_leveling_list[0], lat_leveling_list[0];
 
     # Comparison plot between leveling and InSAR
     fig, axarr = plt.subplots(2, 2, figsize=(14, 10));
@@ -75,17 +174,13 @@ def one_to_one_comparison(myLev, InSAR_Data, sat, filename, vmin=-50, vmax=50, g
         axarr[1][0].plot(lon_plotting[i], lat_plotting[i], marker='o', markersize=10, color=dot_color_tsx,
                          fillstyle="full");
 
-    leveling_title = "Leveling: " + dt.datetime.strftime(myLev[0].dtarray[0], "%m-%Y") + " to " + dt.datetime.strftime(
-            myLev[0].dtarray[1], "%m-%Y");
-    axarr[0][0].set_title(leveling_title, fontsize=15);
-    axarr[0][0].plot(myLev[0].lon, myLev[0].lat, '*', markersize=12, color='black');
+    axarr[0][0].set_title(result.leveling_title, fontsize=15);
+    axarr[0][0].plot(reflon, reflat, '*', markersize=12, color='black');
     axarr[0][0].set_xticks([-115.59, -115.57, -115.55, -115.53, -115.51]);
     axarr[0][0].ticklabel_format(useOffset=False)
 
-    satellite_title = sat + ": " + dt.datetime.strftime(InSAR_Data.starttime, "%m-%Y") + " to " + dt.datetime.strftime(
-            InSAR_Data.endtime, "%m-%Y")
-    axarr[1][0].set_title(satellite_title, fontsize=15);
-    axarr[1][0].plot(myLev[0].lon, myLev[0].lat, '*', markersize=12, color='black');
+    axarr[1][0].set_title(result.satellite_title, fontsize=15);
+    axarr[1][0].plot(reflon, reflat, '*', markersize=12, color='black');
     axarr[1][0].set_xticks([-115.59, -115.57, -115.55, -115.53, -115.51]);
     axarr[1][0].ticklabel_format(useOffset=False)
 
@@ -97,15 +192,15 @@ def one_to_one_comparison(myLev, InSAR_Data, sat, filename, vmin=-50, vmax=50, g
     axarr[0][1].tick_params(axis='both', which='major', labelsize=16)
     axarr[0][1].set_xlim([-graph_scale, graph_scale])
     axarr[0][1].set_ylim([-graph_scale, graph_scale])
-    axarr[0][1].set_title("Avg misfit = %.2f mm, Rsq = %.2f" % (misfit_metric, r2), fontsize=15);
+    axarr[0][1].set_title("Avg misfit = %.2f mm, Rsq = %.2f" % (result.misfit, result.r2), fontsize=15);
     axarr[0][1].grid(True)
 
     # Plotting the InSAR data in the bottom panel, as used in other panels
-    plotting_data = np.subtract(InSAR_Data.LOS, reference_insar_los);
+    plotting_data = np.subtract(InSAR_Data.LOS, result.reference_insar_los);
     axarr[1][1].scatter(InSAR_Data.lon, InSAR_Data.lat, c=plotting_data, s=8,
                         marker='o', cmap='RdYlBu_r', vmin=vmin, vmax=vmax);
     axarr[1][1].plot(lon_leveling_list, lat_leveling_list, '*', color='black');
-    axarr[1][1].plot(myLev[0].lon, myLev[0].lat, '*', color='red');
+    axarr[1][1].plot(reflon, reflat, '*', color='red');
     axarr[1][1].plot(-115.510, 33.081, 'v', markersize=10, color='black');
     axarr[1][1].text(-115.510, 33.081, '  P506', color='black');
     if gps_lon is not None:
@@ -120,22 +215,15 @@ def one_to_one_comparison(myLev, InSAR_Data, sat, filename, vmin=-50, vmax=50, g
     cb = plt.colorbar(custom_cmap, aspect=12, fraction=0.2, orientation='vertical');
     cb.set_label(label + ' Displacement (mm)', fontsize=18);
     cb.ax.tick_params(labelsize=12);
-    plt.savefig(filename);
-    print("Saving %s " % filename);
-
-    # Writing file out
-    filename_txt = filename.split('.')[0]+'.txt'
-    print("Writing %s" % filename_txt);
-    ofile = open(filename_txt, 'w');
-    ofile.write("# leveling los / "+leveling_title + ' / ' + satellite_title + '\n');
-    for i in range(len(oto_lev)):
-        ofile.write("%f %f \n" % (oto_lev[i], oto_tsx[i]) );
-    ofile.close();
+    plt.savefig(result.spec.outfile);
+    plt.close(fig);
+    print("Saving %s " % result.spec.outfile);
     return;
 
 
-def read_leveling_data(data_file, error_file):
-    myLev = Leveling_Object.leveling_inputs.inputs_brawley_leveling(data_file, error_file);
+def read_leveling_data(data_file, error_file, cache_dir="leveling_cache/"):
+    """The parsed spreadsheet is cached, so each drive_* call after the first skips the Excel parsing."""
+    myLev = Leveling_Object.leveling_inputs.inputs_brawley_leveling(data_file, error_file, cache_dir=cache_dir);
     myLev = Leveling_Object.leveling_inputs.compute_rel_to_datum_nov_2009(myLev);
     return myLev;
 
@@ -193,6 +281,7 @@ def drive_uavsar_ts_compare(file_dict, lev_slice, uav_slice, outfile):
                                              skiprows=1, unpack=True);
     myLev = Leveling_Object.utilities.get_onetime_displacements(myLev, lev_slice[0], lev_slice[1]);  # one lev slice
     myUAVSAR_insarobj = UAVSAR.utilities.get_onetime_displacements(myUAVSAR_TS, uav_slice[0], uav_slice[1]);
+    myUAVSAR_TS.TS.close();
     myUAVSAR_insarobj = InSAR_1D_Object.utilities.flip_los_sign(myUAVSAR_insarobj);
     myUAVSAR_insarobj = InSAR_1D_Object.remove_ramp.remove_ramp(myUAVSAR_insarobj);  # experimental step
     one_to_one_comparison(myLev, myUAVSAR_insarobj, "UAVSAR", outfile, gps_lon=gps_lon, gps_lat=gps_lat,
@@ -200,57 +289,118 @@ def drive_uavsar_ts_compare(file_dict, lev_slice, uav_slice, outfile):
     return;
 
 
-if __name__ == "__main__":
-    config_filename = sys.argv[1];
-    file_dict = multiSAR_utilities.get_file_dictionary(config_filename);
+def load_ou_cornell_product(file_dict, s1_slice, track):
+    if track == 'ascending' or track == 'asc':
+        data_file, los_file = file_dict["s1_ou_ascending"], file_dict["s1_ou_ascending_los"];
+        lkv = np.array([float(x) for x in file_dict["s1_ascending_lkv"].split('/')]);
+    else:
+        data_file, los_file = file_dict["s1_ou_descending"], file_dict["s1_ou_descending_los"];
+        lkv = np.array([float(x) for x in file_dict["s1_descending_lkv"].split('/')]);
+    InSAR_Data = InSAR_1D_Object.inputs.inputs_cornell_ou_velocities_hdf5(data_file, los_file, s1_slice);
+    InSAR_Data = InSAR_1D_Object.utilities.remove_nans(InSAR_Data);
+    return make_insar_product(InSAR_Data, "S1", label="LOS", graph_scale=50, proj_vertical=1, lkv=lkv);
+
+
+def load_uavsar_intf_product(file_dict, bounds, uavsar_filename, los_filename):
+    lkv = np.array([float(x) for x in file_dict["uavsar_08508_lkv"].split('/')]);
+    InSAR_Data = InSAR_1D_Object.inputs.inputs_isce_unw_geo_losrdr(uavsar_filename, los_filename, starttime=bounds[0],
+                                                                   endtime=bounds[1]);
+    InSAR_Data = InSAR_1D_Object.utilities.remove_nans(InSAR_Data);
+    InSAR_Data = InSAR_1D_Object.utilities.flip_los_sign(InSAR_Data);
+    InSAR_Data = InSAR_1D_Object.remove_ramp.remove_ramp(InSAR_Data);  # experimental step
+    return make_insar_product(InSAR_Data, "UAV", label="LOS", proj_vertical=1, lkv=lkv);
+
+
+def load_tre_product(file_dict, insar_key, outdir):
+    """Don't need to project into vertical."""
+    VertTSXData, _ = InSAR_1D_Object.inputs.inputs_TRE_vert_east(file_dict[insar_key]);
+    fields = general_python_io_functions.read_gmt_multisegment_latlon(file_dict["field_file"], split_delimiter=',');
+    InSAR_1D_Object.outputs.plot_insar(VertTSXData, outdir+"InSAR_velo.png", lons_annot=fields[0][0],
+                                       lats_annot=fields[1][0]);
+    return make_insar_product(VertTSXData, insar_key, label="Vertical", graph_scale=50);
+
+
+def load_uavsar_ts_products(file_dict, uav_slices):
+    """Read the UAVSAR time series once, and make one product for each [start, end] slice"""
+    losfile, lonfile, latfile = file_dict["uavsar_file"], file_dict["uavsar_lon"], file_dict["uavsar_lat"];
+    myUAVSAR_TS = UAVSAR.uavsar_readwrite.inputs_TS_grd(losfile, lonfile, latfile);
+    lkv = np.array([float(x) for x in file_dict["uavsar_26509_lkv"].split('/')]);
+    gps_lon, gps_lat, gps_names = np.loadtxt(file_dict["gnss_file"], dtype={'names': ('lon', 'lat', 'name'),
+                                                                            'formats': (float, float, 'U4')},
+                                             skiprows=1, unpack=True);
+    products = {};
+    for uav_slice in uav_slices:
+        myUAVSAR_insarobj = UAVSAR.utilities.get_onetime_displacements(myUAVSAR_TS, uav_slice[0], uav_slice[1]);
+        myUAVSAR_insarobj = InSAR_1D_Object.utilities.flip_los_sign(myUAVSAR_insarobj);
+        myUAVSAR_insarobj = InSAR_1D_Object.remove_ramp.remove_ramp(myUAVSAR_insarobj);  # experimental step
+        products["uavsar_ts_%d_%d" % (uav_slice[0], uav_slice[1])] = make_insar_product(
+            myUAVSAR_insarobj, "UAVSAR", label="LOS", proj_vertical=1, lkv=lkv, gps=(gps_lon, gps_lat, gps_names));
+    myUAVSAR_TS.TS.close();
+    return products;
+
+
+def run_all_comparisons(file_dict, summary_file="comparison_summary.txt", num_workers=4):
+    """Load each dataset once, compute every comparison, write one summary table, then render figures in parallel"""
+    myLev = read_leveling_data(file_dict["leveling"], file_dict["lev_error"]);
+    lev_network = Leveling_Object.leveling_inputs.lev_list_to_network(myLev);
+    products, specs = {}, [];
 
     # # TSX experiment: 2012-2013, leveling slice 3-4
-    drive_tre_compare(file_dict, 'tsx', lev_slice=[3, 4], outdir="TSX/", outfile="one_to_one_34.png");
+    products["tsx"] = load_tre_product(file_dict, "tsx", outdir="TSX/");
+    specs.append(ComparisonSpec(product="tsx", lev_slice=[3, 4], outfile="TSX/one_to_one_34.png"));
     # # S1 experiment: 2014-2018, leveling slice 5-8
-    # drive_tre_compare(file_dict, "snt1", lev_slice=[5, 8], outdir="SNT1/", outfile="vert_58.png");
+    # products["snt1"] = load_tre_product(file_dict, "snt1", outdir="SNT1/");
+    # specs.append(ComparisonSpec(product="snt1", lev_slice=[5, 8], outfile="SNT1/vert_58.png"));
     # # S1 experiment: 2018-2019, leveling slice 8-9
-    # drive_tre_compare(file_dict, "snt2", lev_slice=[8, 9], outdir="SNT2/", outfile="vert_89.png");
-
-    # # # S1_Cornell experiment (2015 data), leveling slice 5-6
-    drive_ou_cornell_compare(file_dict, s1_slice=0, lev_slice=[5, 6], track='asc', outfile='S1_OU/T4D/asc_56.png');
-    drive_ou_cornell_compare(file_dict, s1_slice=0, lev_slice=[5, 6], track='desc', outfile='S1_OU/T4D/desc_56.png');
-
-    # # # S1_Cornell experiment (2016 data), leveling slice 6-7
-    drive_ou_cornell_compare(file_dict, s1_slice=1, lev_slice=[6, 7], track='asc', outfile='S1_OU/T4E/asc_67.png');
-    drive_ou_cornell_compare(file_dict, s1_slice=1, lev_slice=[6, 7], track='desc', outfile='S1_OU/T4E/desc_67.png');
-    #
-    # # # S1_Cornell experiment (2017 data), leveling slice 7-8
-    drive_ou_cornell_compare(file_dict, s1_slice=2, lev_slice=[7, 8], track='asc', outfile='S1_OU/T4F/asc_78.png');
-    drive_ou_cornell_compare(file_dict, s1_slice=2, lev_slice=[7, 8], track='desc', outfile='S1_OU/T4F/desc_78.png');
-    #
-    # S1_Cornell experiment (2018 data), leveling slice 8-9
-    drive_ou_cornell_compare(file_dict, s1_slice=3, lev_slice=[8, 9], track='asc', outfile='S1_OU/T5/asc_89.png');
-    drive_ou_cornell_compare(file_dict, s1_slice=3, lev_slice=[8, 9], track='desc', outfile='S1_OU/T5/desc_89.png');
-
-    # Individual UAVSAR experiments, starting with 2011-2012, leveling slice 2-3
-    # Should set vmin/vmax to -150/150 for this one.
+    # products["snt2"] = load_tre_product(file_dict, "snt2", outdir="SNT2/");
+    # specs.append(ComparisonSpec(product="snt2", lev_slice=[8, 9], outfile="SNT2/vert_89.png"));
+
+    # # # S1_Cornell experiments (2015-2018 data), leveling slices 5-6, 6-7, 7-8, 8-9
+    for s1_slice, lev_slice, outdir in [(0, [5, 6], "T4D"), (1, [6, 7], "T4E"), (2, [7, 8], "T4F"), (3, [8, 9], "T5")]:
+        for track in ['asc', 'desc']:
+            name = "s1_ou_%s_%d" % (track, s1_slice);
+            products[name] = load_ou_cornell_product(file_dict, s1_slice, track);
+            outfile = "S1_OU/%s/%s_%d%d.png" % (outdir, track, lev_slice[0], lev_slice[1]);
+            specs.append(ComparisonSpec(product=name, lev_slice=lev_slice, outfile=outfile));
+
+    # Individual UAVSAR experiments, 2011-2012 (slice 2-3), 2010-2011 (slice 1-2), 2009-2010 (slice 0-1)
+    # Should set vmin/vmax to -150/150 for these.
     output_dir = "UAVSAR_intfs/"
-    bounds = (dt.datetime.strptime("20111110", "%Y%m%d"), dt.datetime.strptime("20120926", "%Y%m%d"));
-    drive_single_uavsar_intf_compare(file_dict, bounds, file_dict["uavsar_08508_2011_2012_unw"],
-                                     file_dict["uavsar_08508_2011_2012_los"], lev_slice=[2, 3],
-                                     outfile=output_dir+"one_to_one_23.png");
-    # Individual UAVSAR experiments, 2010-2011, leveling slice 1-2
-    bounds = (dt.datetime.strptime("20101215", "%Y%m%d"), dt.datetime.strptime("20111110", "%Y%m%d"));
-    drive_single_uavsar_intf_compare(file_dict, bounds, file_dict["uavsar_08508_2010_2011_unw"],
-                                     file_dict["uavsar_08508_2010_2011_los"], lev_slice=[1, 2],
-                                     outfile=output_dir+"one_to_one_12.png");
-    # Individual UAVSAR experiments, 2009-2010, leveling slice 0-1
-    bounds = (dt.datetime.strptime("20091015", "%Y%m%d"), dt.datetime.strptime("20101215", "%Y%m%d"));
-    drive_single_uavsar_intf_compare(file_dict, bounds, file_dict["uavsar_08508_2009_2010_unw"],
-                                     file_dict["uavsar_08508_2009_2010_los"], lev_slice=[0, 1],
-                                     outfile=output_dir+"one_to_one_01.png");
+    for start, end, years, lev_slice in [("20111110", "20120926", "2011_2012", [2, 3]),
+                                         ("20101215", "20111110", "2010_2011", [1, 2]),
+                                         ("20091015", "20101215", "2009_2010", [0, 1])]:
+        bounds = (dt.datetime.strptime(start, "%Y%m%d"), dt.datetime.strptime(end, "%Y%m%d"));
+        name = "uavsar_08508_" + years;
+        products[name] = load_uavsar_intf_product(file_dict, bounds, file_dict[name + "_unw"],
+                                                  file_dict[name + "_los"]);
+        specs.append(ComparisonSpec(product=name, lev_slice=lev_slice,
+                                    outfile=output_dir + "one_to_one_%d%d.png" % (lev_slice[0], lev_slice[1])));
 
+    # UAVSAR time series slices
     outdir = "UAVSAR_Apr29/";
-    drive_uavsar_ts_compare(file_dict, lev_slice=[0, 1], uav_slice=[1, 4], outfile=outdir+"o_01_14.png");  # 2009-11
-    drive_uavsar_ts_compare(file_dict, lev_slice=[1, 2], uav_slice=[4, 6], outfile=outdir+"o_12_46.png");  # 2011-11
-    drive_uavsar_ts_compare(file_dict, lev_slice=[2, 3], uav_slice=[6, 7], outfile=outdir+"o_23_67.png");  # 2011-12
-    drive_uavsar_ts_compare(file_dict, lev_slice=[3, 4], uav_slice=[7, 8], outfile=outdir+"o_34_78.png");  # 2012-13
-    drive_uavsar_ts_compare(file_dict, lev_slice=[4, 5], uav_slice=[8, 9], outfile=outdir+"o_45_89.png");  # 2013-14
-    drive_uavsar_ts_compare(file_dict, lev_slice=[3, 5], uav_slice=[7, 9], outfile=outdir+"o_35_79.png");  # 2012-14
-    drive_uavsar_ts_compare(file_dict, lev_slice=[5, 8], uav_slice=[9, 10], outfile=outdir+"o_58_910.png");  # 2014-17
-    drive_uavsar_ts_compare(file_dict, lev_slice=[3, 8], uav_slice=[7, 10], outfile=outdir+"o_38_710.png");  # 2012-14
+    ts_pairs = [([0, 1], [1, 4]),  # 2009-11
+                ([1, 2], [4, 6]),  # 2011-11
+                ([2, 3], [6, 7]),  # 2011-12
+                ([3, 4], [7, 8]),  # 2012-13
+                ([4, 5], [8, 9]),  # 2013-14
+                ([3, 5], [7, 9]),  # 2012-14
+                ([5, 8], [9, 10]),  # 2014-17
+                ([3, 8], [7, 10])];  # 2012-14
+    products.update(load_uavsar_ts_products(file_dict, [x[1] for x in ts_pairs]));
+    for lev_slice, uav_slice in ts_pairs:
+        outfile = outdir + "o_%d%d_%d%d.png" % (lev_slice[0], lev_slice[1], uav_slice[0], uav_slice[1]);
+        specs.append(ComparisonSpec(product="uavsar_ts_%d_%d" % (uav_slice[0], uav_slice[1]), lev_slice=lev_slice,
+                                    outfile=outfile));
+
+    results = compare_all_pairs(lev_network, products, specs);
+    for result in results:
+        write_one_to_one_text(result);
+    write_comparison_summary(results, summary_file);
+    render_comparison_figures(results, lev_network, products, num_workers=num_workers);
+    return;
+
+
+if __name__ == "__main__":
+    config_filename = sys.argv[1];
+    file_dict = multiSAR_utilities.get_file_dictionary(config_filename);
+    run_all_comparisons(file_dict, num_workers=4);
@@ -5,8 +5,10 @@ A generic driver for multiple projects
 Run Slippy across multiple choices of parameters, for l-curve analysis
 """
 
-import sys, json, subprocess
+import sys, json, subprocess, time
+import numpy as np
 from Geodesy_Modeling.src import MultiTemporalInversion
+from Geodesy_Modeling.src.Inversion import run_index, l_curve_corner
 
 
 def welcome_and_parse(argv):
@@ -30,27 +32,109 @@ def welcome_and_parse(argv):
         json.dump(config1, fp, indent="  ");   # save master config file, record-keeping
     return config1;
 
+def run_one_inversion(config, norm_type='slip'):
+    """
+    Invert, compute metrics in memory, and record the run in the sweep's run index.
+    Returns the normalized misfit and the model norm, the two axes of the L-curve.
+    The model norm is the norm that the swept parameter regularizes: the fault-slip norm for alpha ('slip'),
+    or the smoothing seminorm ||L m|| for penalty ('smoothing'). Leveling offsets are never included.
+    """
+    start_time = time.time();
+    result = MultiTemporalInversion.buildG.beginning_calc(config);
+    metrics = MultiTemporalInversion.metrics.main_function(config, result);
+    i = metrics.misfit.names.index("all");
+    faults = list(config["faults"].keys());
+    params = {"alpha": config["alpha"], "penalty": config["faults"][faults[0]]["penalty"]};
+    misfits = {"rms": metrics.misfit.rms[i], "normalized_misfit": metrics.misfit.chi2[i],
+               "l1": metrics.misfit.l1[i], "weighted_rms": metrics.misfit.weighted_rms[i],
+               "moment": metrics.moments[0]};
+    model_norm = result.smoothing_norm if norm_type == 'smoothing' else result.slip_norm;
+    run_index.append_run(config["output_dir_lcurve"], config["output_dir"], params, misfits,
+                         model_norm=model_norm, runtime=time.time() - start_time, status="ok");
+    return misfits["normalized_misfit"], model_norm;
+
+
+def run_alpha(config, alpha):
+    config["alpha"] = alpha;    # set the alpha
+    config["output_dir"] = config["output_dir_lcurve"]+"/alpha_"+str(alpha)+"/";   # set the output dir
+    subprocess.call(['mkdir', '-p', config["output_dir"]], shell=False);
+    return run_one_inversion(config);
+
+
+def run_penalty(config, penalty):
+    for key in config["faults"].keys():
+        config["faults"][key]["penalty"] = penalty;    # set the smoothing penalty
+    config["output_dir"] = config["output_dir_lcurve"]+"/penalty_"+str(penalty)+"/";   # set the output dir
+    subprocess.call(['mkdir', '-p', config["output_dir"]], shell=False);
+    return run_one_inversion(config, norm_type='smoothing');
+
+
+def adaptive_1d_search(config, run_function, param_range):
+    """
+    Find the L-curve corner between the smallest and largest values of param_range,
+    refining only near the corner instead of running the whole grid.
+    """
+    search = l_curve_corner.adaptive_corner_search(lambda x: run_function(config, x), min(param_range),
+                                                   max(param_range), n_initial=config.get("n_initial", 5),
+                                                   n_refine=config.get("n_refine", 4),
+                                                   method=config.get("corner_method", "triangle"));
+    return search;
+
+
+def criterion_1d_search(config, run_function, param_range, sweep):
+    """
+    Choose alpha or penalty by minimizing GCV or ABIC (config["corner_method"]) between the smallest and largest
+    values of param_range, then run that one inversion.  G and L are built once, without any inversions.
+    GCV and ABIC use the unconstrained Tikhonov solution: the NNLS bounds of the real inversion are ignored.
+    For an alpha sweep, smoothing at the configured penalties is kept as extra zero-data rows of G.
+    For a penalty sweep, the configured alpha (if any) is kept the same way.
+
+    :param sweep: 'alpha' or 'penalty'
+    :returns: chosen parameter value
+    """
+    system = MultiTemporalInversion.buildG.beginning_calc(config, write_outputs=False, system_only=True);
+    n_cols = np.shape(system.G)[1];
+    fault_identity = np.hstack((np.identity(system.n_fault_params),
+                                np.zeros((system.n_fault_params, n_cols - system.n_fault_params))));
+    if sweep == 'alpha':
+        fixed_rows, L = system.penalized_smoothing, fault_identity;
+    else:
+        fixed_rows, L = config["alpha"] * fault_identity, system.smoothing;
+    G = np.vstack((system.G, fixed_rows));
+    d = np.concatenate((system.d, np.zeros((len(fixed_rows),))));
+    best_param, _ = l_curve_corner.select_lambda(G, d, L, min(param_range), max(param_range),
+                                                 method=config["corner_method"]);
+    run_function(config, best_param);
+    return best_param;
+
+
 def iterate_many_inversions(config):
     """
     A driver for looping multiple inversions depending on the experiment, testing the impact of alpha or smoothing.
+    With "adaptive_search", a 1d search only spans the range of range_alpha or range_penalty,
+    with a few coarse inversions and then bisection toward the L-curve corner.
+    With "corner_method" set to "gcv" or "abic", a 1d search minimizes that criterion instead of finding a corner,
+    and only the chosen inversion is run.
     """
+    criterion_search = config.get("corner_method") in ("gcv", "abic");
     if not config["switch_alpha"] and not config["switch_penalty"]:   # no search at all.
         return;
     elif config["switch_alpha"] and not config["switch_penalty"]:   # 1d search in slip penalty
-        for alpha in config['range_alpha']:
-            config["alpha"] = alpha;    # set the alpha
-            config["output_dir"] = config["output_dir_lcurve"]+"/alpha_"+str(alpha)+"/";   # set the output dir
-            subprocess.call(['mkdir', '-p', config["output_dir"]], shell=False);
-            MultiTemporalInversion.buildG.beginning_calc(config);
-            MultiTemporalInversion.metrics.main_function(config);
+        if criterion_search:
+            criterion_1d_search(config, run_alpha, config['range_alpha'], 'alpha');
+        elif config.get("adaptive_search"):
+            adaptive_1d_search(config, run_alpha, config['range_alpha']);
+        else:
+            for alpha in config['range_alpha']:
+                run_alpha(config, alpha);
     elif config["switch_penalty"] and not config["switch_alpha"]:   # 1d search in smoothing penalty
-        for penalty in config['range_penalty']:
-            for key in config["faults"].keys():
-                config["faults"][key]["penalty"] = penalty;    # set the smoothing penalty
-            config["output_dir"] = config["output_dir_lcurve"]+"/penalty_"+str(penalty)+"/";   # set the output dir
-            subprocess.call(['mkdir', '-p', config["output_dir"]], shell=False);
-            MultiTemporalInversion.buildG.beginning_calc(config);
-            MultiTemporalInversion.metrics.main_function(config);
+        if criterion_search:
+            criterion_1d_search(config, run_penalty, config['range_penalty'], 'penalty');
+        elif config.get("adaptive_search"):
+            adaptive_1d_search(config, run_penalty, config['range_penalty']);
+        else:
+            for penalty in config['range_penalty']:
+                run_penalty(config, penalty);
     else:
         for alpha in config['range_alpha']:
             for penalty in config['range_penalty']:
@@ -59,8 +143,7 @@ def iterate_many_inversions(config):
                 config["alpha"] = alpha;  # set the alpha
                 config["output_dir"] = config["output_dir_lcurve"]+"/alpha_"+str(alpha)+"_"+str(penalty)+"/";
                 subprocess.call(['mkdir', '-p', config["output_dir"]], shell=False);
-                MultiTemporalInversion.buildG.beginning_calc(config);
-                MultiTemporalInversion.metrics.main_function(config);
+                run_one_inversion(config);
     return;
 
 
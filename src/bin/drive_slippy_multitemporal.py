@@ -6,7 +6,7 @@ Run Slippy with multiple time intervals in the input (a really big G matrix)
 """
 
 import sys, json, subprocess
-from Geodesy_Modeling.src import MultiTemporalInversion
+from Geodesy_Modeling.src import MultiTemporalInversion, pipeline, cache_utilities
 
 
 def welcome_and_parse(argv):
@@ -27,7 +27,39 @@ def welcome_and_parse(argv):
     return config1;
 
 
+def stage_inversion(config, _upstream):
+    return MultiTemporalInversion.buildG.beginning_calc(config);
+
+
+def stage_metrics(config, upstream):
+    return MultiTemporalInversion.metrics.main_function(config, upstream["inversion"]);
+
+
+def inversion_input_files(config):
+    return cache_utilities.collect_input_files([config["data_files"], config["faults"]]);
+
+
+def inversion_output_files(config):
+    slip_files = [config["output_dir"] + config["epochs"][x]["slip_output_file"] for x in config["epochs"].keys()];
+    pred_files = [config["output_dir"] + config["data_files"][x]["outfile"] for x in config["data_files"].keys()];
+    return slip_files + pred_files;
+
+
+def metrics_output_files(config):
+    return [config["output_dir"] + x for x in ("summary_stats_compound.txt", "summary_stats_simple.txt",
+                                               "summary_moments.txt")];
+
+
+# The inversion re-runs when data files, fault files, or any inversion parameter change.
+INVERSION_CONFIG_KEYS = ["data_files", "faults", "epochs", "alpha", "G", "resolution_test", "resolution_method",
+                         "resolution_k", "resolution_suite", "n_realizations", "smoothing_type", "output_dir"];
+MULTITEMPORAL_STAGES = [
+    pipeline.Stage(name="inversion", function=stage_inversion, inputs=inversion_input_files,
+                   config_keys=INVERSION_CONFIG_KEYS, upstream=[], outputs=inversion_output_files),
+    pipeline.Stage(name="metrics", function=stage_metrics, inputs=None, config_keys=["output_dir", "G"],
+                   upstream=["inversion"], outputs=metrics_output_files)];
+
+
 if __name__ == "__main__":
     config = welcome_and_parse(sys.argv);
-    MultiTemporalInversion.buildG.beginning_calc(config);
-    MultiTemporalInversion.metrics.main_function(config);
+    pipeline.run_pipeline(MULTITEMPORAL_STAGES, config, config.get("cache_dir", config["output_dir"] + "stage_cache/"));
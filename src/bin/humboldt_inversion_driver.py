@@ -9,11 +9,14 @@ Depends on Humboldt Bay project code for some functions. It will not work on a d
 
 import numpy as np
 import scipy.optimize
-import subprocess, json, sys, argparse, os
+import subprocess, json, sys, argparse, os, time
 import Elastic_stresses_py.PyCoulomb.fault_slip_object as library
 import Elastic_stresses_py.PyCoulomb as PyCoulomb
 import Geodesy_Modeling.src.Inversion.inversion_tools as inv_tools
 import Geodesy_Modeling.src.Inversion.readers as readers
+import Geodesy_Modeling.src.Inversion.run_index as run_index
+import Geodesy_Modeling.src.Inversion.monte_carlo as monte_carlo
+from Geodesy_Modeling.src import pipeline
 import Elastic_stresses_py.PyCoulomb.disp_points_object as dpo
 import Elastic_stresses_py.PyCoulomb.disp_points_object.outputs as dpo_out
 sys.path.append("/Users/kmaterna/Documents/B_Research/Mendocino_Geodesy/Humboldt/_Project_Code");  # add local code
@@ -48,6 +51,9 @@ def configure():
     p.add_argument('--inverse_dir', type=str, help='''Way to get to the home directory of inverses''');
     p.add_argument('--lsfrev_min', type=str, help='''Constraint on little salmon reverse slip component, minimum cm''');
     p.add_argument('--ghost_transient_mult', type=str, help='''Ghost transient multiplier, cm''');
+    p.add_argument('--cache_dir', type=str, default='stage_cache/', help='''Directory for cached stage results''');
+    p.add_argument('--n_realizations', type=int, help='''Number of Monte Carlo realizations for uncertainties''');
+    p.add_argument('--run_index_dir', type=str, help='''Sweep directory whose run index records this run''');
     exp_dict = vars(p.parse_args())
 
     if os.path.exists(exp_dict["configfile"]):
@@ -143,11 +149,8 @@ def read_hb_fault_gf_elements(exp_dict):
     return gf_elements;
 
 
-def run_humboldt_inversion():
-    # Starting program.  Configure stage
-    exp_dict = configure();
-
-    # # INPUT stage: Read obs velocities as cc.Displacement_Points
+def stage_read_observations(exp_dict, _upstream):
+    """INPUT stage: Read obs velocities as cc.Displacement_Points"""
     obs_disp_pts = HR.read_all_data_table(exp_dict["data_file"]);   # all 783 points
     obs_disp_pts = correct_for_far_field_terms(exp_dict, obs_disp_pts);  # needed from Fred's work
     # Experimental options:
@@ -158,11 +161,19 @@ def run_humboldt_inversion():
     for excluded_region in exp_dict["exclude_regions"]:
         obs_disp_pts = dpo.utilities.filter_to_exclude_bounding_box(obs_disp_pts, excluded_region);  # Lassen etc.
     obs_disp_pts = dpo.utilities.filter_by_bounding_box(obs_disp_pts, exp_dict["bbox"]);  # north of 38.5
+    return obs_disp_pts;
+
 
-    # INPUT stage: Read GF models based on the configuration parameters
-    gf_elements = read_hb_fault_gf_elements(exp_dict);  # list of GF_elements, one for each fault-related column of G.
+def stage_read_fault_gfs(exp_dict, _upstream):
+    """INPUT stage: Read GF models based on the configuration parameters"""
+    return read_hb_fault_gf_elements(exp_dict);  # list of GF_elements, one for each fault-related column of G.
 
-    # COMPUTE STAGE: PREPARE ROTATION GREENS FUNCTIONS AND LEVELING OFFSET
+
+def stage_build_G(exp_dict, upstream):
+    """COMPUTE stage: rotation and leveling elements, pairing with observations, and the weighted G matrix"""
+    obs_disp_pts, gf_elements = upstream["observations"], upstream["fault_gfs"];
+
+    # PREPARE ROTATION GREENS FUNCTIONS AND LEVELING OFFSET
     gf_elements_rotation = inv_tools.get_GF_rotation_elements(obs_disp_pts);  # 3 elements: rot_x, rot_y, rot_z
     gf_elements = gf_elements + gf_elements_rotation;  # add rotation elements to matrix
     gf_elements_rotation2 = inv_tools.get_GF_rotation_elements(obs_disp_pts, target_region=[-126, -119, 40.4, 46]);
@@ -170,12 +181,10 @@ def run_humboldt_inversion():
     gf_element_lev = inv_tools.get_GF_leveling_offset_element(obs_disp_pts);  # 1 element: lev reference frame
     gf_elements = gf_elements + gf_element_lev;
 
-    # COMPUTE STAGE: Pairing is necessary in case you've filtered out any observations along the way.
+    # Pairing is necessary in case you've filtered out any observations along the way.
     paired_obs, paired_gf_elements = inv_tools.pair_gf_elements_with_obs(obs_disp_pts, gf_elements);
 
-    inv_tools.visualize_GF_elements(paired_gf_elements, exp_dict["outdir"], exclude_list='all');
-
-    # COMPUTE STAGE: INVERSE.  Reduces certain points to only-horizontal, only-vertical, etc.
+    # INVERSE.  Reduces certain points to only-horizontal, only-vertical, etc.
     list_of_gf_columns = [];
     for paired_gf in paired_gf_elements:
         G_one_col = inv_tools.buildG_column(paired_gf.disp_points, paired_obs);  # for one fault model parameter
@@ -189,6 +198,12 @@ def run_humboldt_inversion():
         sigmas = np.ones(np.shape(obs));
     G /= sigmas[:, None];
     weighted_obs = obs / sigmas;
+    return paired_obs, paired_gf_elements, G, weighted_obs, sigmas;
+
+
+def stage_solve(exp_dict, upstream):
+    """COMPUTE stage: regularization and the constrained inversion"""
+    _, paired_gf_elements, G, weighted_obs, sigmas = upstream["build_G"];
 
     # Add optional smoothing penalty, overwriting old variables
     if 'smoothing' in exp_dict.keys():
@@ -209,6 +224,33 @@ def run_humboldt_inversion():
     if response.message == "The maximum number of iterations is exceeded.":
         print("Maximum number of iterations exceeded. Cannot trust this inversion. Exiting");
         sys.exit(0);
+    return M_opt, G, sigmas, response.message, weighted_obs;
+
+
+def stage_uncertainty(exp_dict, upstream):
+    """UNCERTAINTY stage: Monte Carlo re-inversions with the same bounds, if n_realizations is set"""
+    if not exp_dict.get("n_realizations"):
+        return None;
+    paired_obs, paired_gf_elements, _, _, data_sigmas = upstream["build_G"];
+    M_opt, G, _, _, weighted_obs = upstream["solve"];  # M_opt only for the output file
+    _, raw_sigmas = inv_tools.build_obs_vector(paired_obs);
+    # Data rows were divided by data_sigmas; regularization rows get no noise
+    noise_sigmas = np.concatenate((raw_sigmas / data_sigmas, np.zeros((len(weighted_obs) - len(data_sigmas),))));
+    lb = [x.lower_bound for x in paired_gf_elements];
+    ub = [x.upper_bound for x in paired_gf_elements];
+    mc_result = monte_carlo.monte_carlo_uncertainty(G, weighted_obs, noise_sigmas, bounds=(lb, ub),
+                                                    n_realizations=exp_dict["n_realizations"],
+                                                    num_workers=exp_dict.get("num_workers", 1));
+    inv_tools.write_model_uncertainties(M_opt, mc_result, exp_dict["outdir"] + '/model_uncertainties.txt',
+                                        paired_gf_elements);
+    return mc_result;
+
+
+def stage_outputs(exp_dict, upstream):
+    """OUTPUT stage: forward predictions, text files, and figures"""
+    paired_obs, paired_gf_elements = upstream["build_G"][0:2];
+    M_opt, G, sigmas, message = upstream["solve"][0:4];
+    inv_tools.visualize_GF_elements(paired_gf_elements, exp_dict["outdir"], exclude_list='all');
 
     # Make forward predictions.  Work in disp_pts as soon as possible, not matrices.
     M_rot_only, M_no_rot = inv_tools.unpack_model_of_rotation_only(M_opt, [x.fault_name for x in paired_gf_elements]);
@@ -242,7 +284,8 @@ def run_humboldt_inversion():
 
     inv_tools.write_model_params(M_opt, rms_mm_t, exp_dict["outdir"] + '/' + exp_dict["model_file"], paired_gf_elements)
     inv_tools.write_summary_params(M_opt, rms_obj, exp_dict["outdir"] + '/model_results_human.txt',
-                                   paired_gf_elements, ignore_faults=['CSZ_dist'], message=response.message);
+                                   paired_gf_elements, ignore_faults=['CSZ_dist'], message=message,
+                                   regions=exp_dict.get("moment_regions"), years=exp_dict.get("moment_years", 300));
     inv_tools.write_fault_traces(M_opt, paired_gf_elements, exp_dict["outdir"] + '/fault_output.txt',
                                  ignore_faults=['CSZ_dist', 'x_rot', 'y_rot', 'z_rot', 'lev_offset']);
     readers.write_csz_dist_fault_patches(fault_dict_lists, M_opt, exp_dict["outdir"] + '/csz_model.gmt');
@@ -255,6 +298,74 @@ def run_humboldt_inversion():
                                                      model_disp_pts, residual_pts, [-126, -119.7, 37.7, 43.3],
                                                      scale_arrow=(0.5, 0.020, "2 cm"), v_labeling_interval=0.003,
                                                      fault_dict_list=[], rms=rms_mm_t);
+    misfits = {"RMS": rms_mm_t, "RMS horizontal": rms_mm_h, "RMS vertical": rms_mm_v, "RMS normalized": rms_chi2_t,
+               "RMS normalized horizontal": rms_chi2_h, "RMS normalized vertical": rms_chi2_v};
+    return {"misfits": misfits, "model_norm": np.linalg.norm(M_opt), "status": message};
+
+
+def observation_input_files(exp_dict):
+    files = [exp_dict["data_file"], exp_dict["lonlatfile"]];
+    files += [exp_dict["inverse_dir"] + correction["file"] for correction in exp_dict["corrections"]];
+    files += [exp_dict["inverse_dir"] + exp_dict["faults"][name]["points"] for name in ("Maa", "BSF")];
+    return files;
+
+
+def fault_gf_input_files(exp_dict):
+    files = [exp_dict["lonlatfile"]];
+    for fault_name in exp_dict["exp_faults"]:
+        fault_dict = exp_dict["faults"]["CSZ"] if fault_name == "CSZ_dist" else exp_dict["faults"][fault_name];
+        for key in ("GF", "geometry", "points", "GF_15km_visco", "GF_15km_stat"):
+            if key in fault_dict.keys():
+                files.append(exp_dict["inverse_dir"] + fault_dict[key]);
+    return files;
+
+
+def uncertainty_output_files(exp_dict):
+    return [exp_dict["outdir"] + '/model_uncertainties.txt'] if exp_dict.get("n_realizations") else [];
+
+
+def output_files(exp_dict):
+    return [exp_dict["outdir"] + '/model_pred_file.txt', exp_dict["outdir"] + '/' + exp_dict["model_file"],
+            exp_dict["outdir"] + '/model_results_human.txt', exp_dict["outdir"] + "/results.png"];
+
+
+# Stages are re-run only when their files, config values, or upstream stages change.
+# Changing a smoothing or penalty weight re-runs only the solve and output stages.
+HUMBOLDT_STAGES = [
+    pipeline.Stage(name="observations", function=stage_read_observations, inputs=observation_input_files,
+                   config_keys=["data_file", "lonlatfile", "inverse_dir", "corrections", "continuous_only",
+                                "exclude_regions", "bbox", "faults"], upstream=[], outputs=None),
+    pipeline.Stage(name="fault_gfs", function=stage_read_fault_gfs, inputs=fault_gf_input_files,
+                   config_keys=["exp_faults", "faults", "inverse_dir", "lonlatfile", "max_depth_csz_slip",
+                                "depth_of_forced_coupling"], upstream=[], outputs=None),
+    pipeline.Stage(name="build_G", function=stage_build_G, inputs=None, config_keys=["unc_weighted"],
+                   upstream=["observations", "fault_gfs"], outputs=None),
+    pipeline.Stage(name="solve", function=stage_solve, inputs=None, config_keys=["smoothing", "slip_penalty"],
+                   upstream=["build_G"], outputs=None),
+    pipeline.Stage(name="outputs", function=stage_outputs, inputs=None,
+                   config_keys=["outdir", "model_file", "moment_regions", "moment_years"],
+                   upstream=["build_G", "solve"], outputs=output_files),
+    pipeline.Stage(name="uncertainty", function=stage_uncertainty, inputs=None,
+                   config_keys=["outdir", "n_realizations"],
+                   upstream=["build_G", "solve"], outputs=uncertainty_output_files)];
+
+
+# Parameters recorded in the run index, for L-curves and other sweeps
+RUN_INDEX_PARAMS = ["smoothing", "slip_penalty", "max_depth_csz_slip", "depth_of_forced_coupling", "lsfrev_min",
+                    "ghost_transient_mult"];
+
+
+def run_humboldt_inversion():
+    # Starting program.  Configure stage
+    exp_dict = configure();
+    start_time = time.time();
+    results = pipeline.run_pipeline(HUMBOLDT_STAGES, exp_dict, exp_dict["cache_dir"]);
+    summary = results["outputs"];
+    if exp_dict.get("run_index_dir") and summary is not None:
+        run_index.append_run(exp_dict["run_index_dir"], exp_dict["outdir"],
+                             {key: exp_dict.get(key) for key in RUN_INDEX_PARAMS}, summary["misfits"],
+                             model_norm=summary["model_norm"], runtime=time.time() - start_time,
+                             status=summary["status"]);
     return;
 
 
@@ -10,10 +10,11 @@ Leveling: write out
 """
 
 import numpy as np
-import sys, json, subprocess
+import sys, os, json, subprocess
 import datetime as dt
 from GNSS_TimeSeries_Viewers import gps_tools
 from Geodesy_Modeling.src import Downsample, InSAR_1D_Object, GNSS_Object, Leveling_Object
+from Geodesy_Modeling.src import task_runner, cache_utilities
 from S1_batches.read_write_insar_utilities import isce_read_write
 
 
@@ -57,28 +58,35 @@ def write_gps_displacements(config):
     """
     For GPS, we have to write the proper format text file, and sometimes we make other corrections.
     """
-    # For each interval in gps:
-    prep_dir = config["prep_inputs_dir"];
-    network = 'pbo';
     if "gps_data" not in config.keys():
         print("\nNo GPS in this inversion");
         return;
     for interval_dict_key in config["gps_data"]:
-        new_interval_dict = config["gps_data"][interval_dict_key];  # for each interval in GPS
-        gps_sigma = new_interval_dict["gps_sigma"];
-        starttime, endtime = get_starttime_endtime(config["epochs"], new_interval_dict);
-
-        print("\nFor GPS %s, starting to extract GPS from %s to %s " % (interval_dict_key, starttime, endtime));
-        stations = GNSS_Object.read_gnss.read_station_ts_NBGF(new_interval_dict["gps_bbox"],
-                                                              new_interval_dict["gps_reference"],
-                                                              remove_coseismic=new_interval_dict["remove_coseismic"],
-                                                              network=network);
-        displacement_objects = Downsample.downsample_gps_ts.get_displacements_show_ts(stations, starttime, endtime,
-                                                                                      gps_sigma, prep_dir);
-        if "gps_add_offset_mm" in new_interval_dict.keys():  # an option to add a constant (in enu) to the GNSS offsets
-            displacement_objects = loop_removing_constant(displacement_objects, new_interval_dict["gps_add_offset_mm"]);
-        GNSS_Object.outputs.write_gps_invertible_format(displacement_objects, config["prep_inputs_dir"]
-                                                        + new_interval_dict["gps_textfile"]);
+        write_one_gps_interval(config, interval_dict_key);
+    return;
+
+
+def write_one_gps_interval(config, interval_dict_key, work_dir=None):
+    """One interval of GPS. work_dir is unused; GPS outputs go straight into the prep directory."""
+    prep_dir = config["prep_inputs_dir"];
+    network = 'pbo';
+    new_interval_dict = config["gps_data"][interval_dict_key];  # for each interval in GPS
+    gps_sigma = new_interval_dict["gps_sigma"];
+    starttime, endtime = get_starttime_endtime(config["epochs"], new_interval_dict);
+
+    print("\nFor GPS %s, starting to extract GPS from %s to %s " % (interval_dict_key, starttime, endtime));
+    stations = GNSS_Object.read_gnss.read_station_ts_NBGF(new_interval_dict["gps_bbox"],
+                                                          new_interval_dict["gps_reference"],
+                                                          gps_data_config_file=config["gps_data_config_file"],
+                                                          remove_coseismic=new_interval_dict["remove_coseismic"],
+                                                          network=network, cache_dir=prep_dir + "gnss_cache/",
+                                                          num_workers=config.get("gnss_num_workers", 1));
+    displacement_objects = Downsample.downsample_gps_ts.get_displacements_show_ts(stations, starttime, endtime,
+                                                                                  gps_sigma, prep_dir);
+    if "gps_add_offset_mm" in new_interval_dict.keys():  # an option to add a constant (in enu) to the GNSS offsets
+        displacement_objects = loop_removing_constant(displacement_objects, new_interval_dict["gps_add_offset_mm"]);
+    GNSS_Object.outputs.write_gps_invertible_format(displacement_objects, config["prep_inputs_dir"]
+                                                    + new_interval_dict["gps_textfile"]);
     return;
 
 
@@ -90,20 +98,28 @@ def write_leveling_displacements(config):
         print("\nNo Leveling in this inversion");
         return;
     for interval_dict_key in config["leveling_data"]:
-        new_interval_dict = config["leveling_data"][interval_dict_key];  # for each interval in Leveling
-        print("\nPreparing leveling for file %s" % new_interval_dict["lev_outfile"])
-        myLev = Leveling_Object.leveling_inputs.inputs_brawley_leveling(new_interval_dict["leveling_filename"],
-                                                                        new_interval_dict["leveling_errors_filename"]);
-        myLev = Leveling_Object.leveling_inputs.compute_rel_to_datum_nov_2009(myLev);  # Relative disp after 2009
-        Leveling_Object.leveling_outputs.write_leveling_invertible_format(myLev, new_interval_dict["leveling_start"],
-                                                                          new_interval_dict["leveling_end"],
-                                                                          new_interval_dict["leveling_unc"],
-                                                                          config["prep_inputs_dir"] +
-                                                                          new_interval_dict["lev_outfile"]);
-        Leveling_Object.leveling_outputs.plot_simple_leveling(config["prep_inputs_dir"] +
-                                                              new_interval_dict["lev_outfile"],
-                                                              config["prep_inputs_dir"] +
-                                                              new_interval_dict["lev_plot"]);
+        write_one_leveling_interval(config, interval_dict_key);
+    return;
+
+
+def write_one_leveling_interval(config, interval_dict_key, work_dir=None):
+    """One interval of leveling. work_dir is unused."""
+    new_interval_dict = config["leveling_data"][interval_dict_key];  # for each interval in Leveling
+    print("\nPreparing leveling for file %s" % new_interval_dict["lev_outfile"])
+    myLev = Leveling_Object.leveling_inputs.inputs_brawley_leveling(new_interval_dict["leveling_filename"],
+                                                                    new_interval_dict["leveling_errors_filename"],
+                                                                    cache_dir=config["prep_inputs_dir"] +
+                                                                    "leveling_cache/");
+    myLev = Leveling_Object.leveling_inputs.compute_rel_to_datum_nov_2009(myLev);  # Relative disp after 2009
+    Leveling_Object.leveling_outputs.write_leveling_invertible_format(myLev, new_interval_dict["leveling_start"],
+                                                                      new_interval_dict["leveling_end"],
+                                                                      new_interval_dict["leveling_unc"],
+                                                                      config["prep_inputs_dir"] +
+                                                                      new_interval_dict["lev_outfile"]);
+    Leveling_Object.leveling_outputs.plot_simple_leveling(config["prep_inputs_dir"] +
+                                                          new_interval_dict["lev_outfile"],
+                                                          config["prep_inputs_dir"] +
+                                                          new_interval_dict["lev_plot"]);
     return;
 
 
@@ -115,55 +131,66 @@ def write_uavsar_displacements(config):
         print("\nNo UAVSAR in this inversion");
         return;
     for interval_dict_key in config["uavsar_data"]:
-        print("\nStarting to prepare UAVSAR data for %s" % interval_dict_key);
-        new_interval_dict = config["uavsar_data"][interval_dict_key];  # for each interval in UAVSAR
-
-        # Get uavsar data
-        if 'uav_sourcefile_begin' in new_interval_dict.keys():  # Using time series format
-            source_xml_name = new_interval_dict["uav_sourcefile_begin"] + ".xml";
-            scene0 = isce_read_write.read_scalar_data(new_interval_dict["uav_sourcefile_begin"], band=2);
-            scene1 = isce_read_write.read_scalar_data(new_interval_dict["uav_sourcefile_end"], band=2);
-            data = np.float32(np.subtract(scene1, scene0));  # must be 4-byte floats for quadtree
-        else:  # using an individual interferogram format
-            source_xml_name = new_interval_dict["uav_sourcefile_unw_geo"] + ".xml";
-            data = isce_read_write.read_scalar_data(new_interval_dict["uav_sourcefile_unw_geo"], band=2);
-
-        if new_interval_dict["flip_uavsar_los"] == 1:
-            data = -1 * data;  # away from satellite = negative motion
-            print("Multiplying UAVSAR by -1 for LOS motion sign convention. ");
-
-        # Write the .unw.geo file and metadata
-        uavsar_unw_file = config["prep_inputs_dir"] + new_interval_dict["uavsar_unw_file"];  # output file
-        subprocess.call(['cp', source_xml_name, uavsar_unw_file + ".xml"]);  # write the xml out
-        isce_read_write.data_to_file_2_bands(data, data, filename=uavsar_unw_file);  # write data bytes out.
-
-        # Quadtree downsampling by Kite
-        uav_textfile = config["prep_inputs_dir"] + new_interval_dict["uav_textfile"];  # .txt, invertible format
-        drive_uavsar_kite_downsampling(new_interval_dict, config["prep_inputs_dir"]);
-
-        # Now we optionally remove a ramp.
-        if new_interval_dict["remove_ramp"] == 1:
-            InSAR_1D_Object.remove_ramp.remove_ramp_filewise(uav_textfile, uav_textfile,
-                                                             ref_coord=config['reference_ll']);
-
-        # Now we optionally remove a constant
-        if new_interval_dict["remove_constant"] == 1:
-            InSAR_1D_Object.remove_ramp.remove_constant_filewise(uav_textfile, uav_textfile);
-
-        # Now we make a plot
-        InSAR_Obj = InSAR_1D_Object.inputs.inputs_txt(uav_textfile);
-        InSAR_1D_Object.outputs.plot_insar(InSAR_Obj, config["prep_inputs_dir"] + new_interval_dict["uav_ending_plot"]);
+        write_one_uavsar_interval(config, interval_dict_key);
+    return;
+
+
+def write_one_uavsar_interval(config, interval_dict_key, work_dir=None):
+    """
+    One interval of UAVSAR. The .unw.geo file and the copied rdrfile go into work_dir,
+    which defaults to the prep directory. Separate work_dirs let several intervals run at once.
+    """
+    work_dir = config["prep_inputs_dir"] if work_dir is None else os.path.join(work_dir, '');
+    new_interval_dict = config["uavsar_data"][interval_dict_key];  # for each interval in UAVSAR
+    print("\nStarting to prepare UAVSAR data for %s" % interval_dict_key);
+
+    # Get uavsar data
+    if 'uav_sourcefile_begin' in new_interval_dict.keys():  # Using time series format
+        source_xml_name = new_interval_dict["uav_sourcefile_begin"] + ".xml";
+        scene0 = isce_read_write.read_scalar_data(new_interval_dict["uav_sourcefile_begin"], band=2);
+        scene1 = isce_read_write.read_scalar_data(new_interval_dict["uav_sourcefile_end"], band=2);
+        data = np.float32(np.subtract(scene1, scene0));  # must be 4-byte floats for quadtree
+    else:  # using an individual interferogram format
+        source_xml_name = new_interval_dict["uav_sourcefile_unw_geo"] + ".xml";
+        data = isce_read_write.read_scalar_data(new_interval_dict["uav_sourcefile_unw_geo"], band=2);
+
+    if new_interval_dict["flip_uavsar_los"] == 1:
+        data = -1 * data;  # away from satellite = negative motion
+        print("Multiplying UAVSAR by -1 for LOS motion sign convention. ");
+
+    # Write the .unw.geo file and metadata
+    uavsar_unw_file = work_dir + new_interval_dict["uavsar_unw_file"];  # output file
+    subprocess.call(['cp', source_xml_name, uavsar_unw_file + ".xml"]);  # write the xml out
+    isce_read_write.data_to_file_2_bands(data, data, filename=uavsar_unw_file);  # write data bytes out.
+
+    # Quadtree downsampling by Kite
+    uav_textfile = config["prep_inputs_dir"] + new_interval_dict["uav_textfile"];  # .txt, invertible format
+    drive_uavsar_kite_downsampling(new_interval_dict, config["prep_inputs_dir"], work_dir);
+
+    # Now we optionally remove a ramp.
+    if new_interval_dict["remove_ramp"] == 1:
+        InSAR_1D_Object.remove_ramp.remove_ramp_filewise(uav_textfile, uav_textfile,
+                                                         ref_coord=config['reference_ll']);
+
+    # Now we optionally remove a constant
+    if new_interval_dict["remove_constant"] == 1:
+        InSAR_1D_Object.remove_ramp.remove_constant_filewise(uav_textfile, uav_textfile);
+
+    # Now we make a plot
+    InSAR_Obj = InSAR_1D_Object.inputs.inputs_txt(uav_textfile);
+    InSAR_1D_Object.outputs.plot_insar(InSAR_Obj, config["prep_inputs_dir"] + new_interval_dict["uav_ending_plot"]);
     return;
 
 
-def drive_uavsar_kite_downsampling(interval_dictionary, inputs_dir):
-    """Setup Downsampling: rdrfile, xmlfile, datafile"""
-    uavsar_unw_file = inputs_dir + interval_dictionary["uavsar_unw_file"];
+def drive_uavsar_kite_downsampling(interval_dictionary, inputs_dir, work_dir=None):
+    """Setup Downsampling: rdrfile, xmlfile, datafile. The datafile and rdrfile live in work_dir."""
+    work_dir = inputs_dir if work_dir is None else work_dir;
+    uavsar_unw_file = work_dir + interval_dictionary["uavsar_unw_file"];
     geojson_file = inputs_dir + interval_dictionary["geojson_file"];
     uav_plotfile = inputs_dir + interval_dictionary["uav_plotfile"];
     uav_textfile = inputs_dir + interval_dictionary["uav_textfile"];
-    print("Copying %s into directory %s" % (interval_dictionary['rdrfile'], inputs_dir));
-    subprocess.call(['cp', interval_dictionary["rdrfile"], inputs_dir], shell=False);
+    print("Copying %s into directory %s" % (interval_dictionary['rdrfile'], work_dir));
+    subprocess.call(['cp', interval_dictionary["rdrfile"], work_dir], shell=False);
 
     # Downsample, bbox, and Print
     Downsample.quadtree_downsample_kite.kite_downsample_isce_unw(uavsar_unw_file, geojson_file,
@@ -186,41 +213,45 @@ def write_tsx_tre_displacements(config):
     if "tsx_data" not in config.keys():
         print("\nNo TSX in this inversion");
         return;
-    else:
-        for interval_dict_key in config["tsx_data"]:
-            new_interval_dict = config["tsx_data"][interval_dict_key];  # for each interval in TSX
-            print("\nStarting to extract TSX TRE-format from %s " % (new_interval_dict["tsx_filename"]));
-
-            # We can get both vertical and east from the TRE data.
-            Vert_InSAR, East_InSAR = InSAR_1D_Object.inputs.inputs_TRE_vert_east(new_interval_dict["tsx_filename"]);
-            Vert_InSAR = InSAR_1D_Object.utilities.impose_InSAR_bounding_box(Vert_InSAR, new_interval_dict[
-                "tsx_bbox"]);  # bounding box vertical
-            East_InSAR = InSAR_1D_Object.utilities.impose_InSAR_bounding_box(East_InSAR, new_interval_dict[
-                "tsx_bbox"]);  # bounding box east
-            Vert_InSAR = Downsample.uniform_downsample.uniform_downsampling(Vert_InSAR,
-                                                                            new_interval_dict[
-                                                                                "tsx_downsample_interval"],
-                                                                            new_interval_dict["tsx_averaging_window"]);
-            East_InSAR = Downsample.uniform_downsample.uniform_downsampling(East_InSAR,
-                                                                            new_interval_dict[
-                                                                                "tsx_downsample_interval"],
-                                                                            new_interval_dict["tsx_averaging_window"]);
-
-            Total_InSAR = InSAR_1D_Object.utilities.combine_objects(Vert_InSAR, East_InSAR);
-            InSAR_1D_Object.outputs.write_insar_invertible_format(Total_InSAR, new_interval_dict["tsx_unc"],
-                                                                  config["prep_inputs_dir"] +
-                                                                  new_interval_dict["tsx_datafile"]);  # vert+east
-            InSAR_1D_Object.outputs.write_insar_invertible_format(Vert_InSAR, new_interval_dict["tsx_unc"],
-                                                                  config["prep_inputs_dir"] +
-                                                                  new_interval_dict["tsx_vertical_datafile"]);
-            InSAR_1D_Object.outputs.write_insar_invertible_format(East_InSAR, new_interval_dict["tsx_unc"],
-                                                                  config["prep_inputs_dir"] +
-                                                                  new_interval_dict["tsx_horiz_datafile"]);
-            InSAR_obj = InSAR_1D_Object.inputs.inputs_txt(config["prep_inputs_dir"] +
-                                                          new_interval_dict["tsx_vertical_datafile"]);
-            InSAR_1D_Object.outputs.plot_insar(InSAR_obj, config["prep_inputs_dir"] +
-                                               new_interval_dict["tsx_vertical_plot"]);
+    for interval_dict_key in config["tsx_data"]:
+        write_one_tsx_tre_interval(config, interval_dict_key);
+    return;
 
+
+def write_one_tsx_tre_interval(config, interval_dict_key, work_dir=None):
+    """One interval of TSX. work_dir is unused."""
+    new_interval_dict = config["tsx_data"][interval_dict_key];  # for each interval in TSX
+    print("\nStarting to extract TSX TRE-format from %s " % (new_interval_dict["tsx_filename"]));
+
+    # We can get both vertical and east from the TRE data.
+    Vert_InSAR, East_InSAR = InSAR_1D_Object.inputs.inputs_TRE_vert_east(new_interval_dict["tsx_filename"]);
+    Vert_InSAR = InSAR_1D_Object.utilities.impose_InSAR_bounding_box(Vert_InSAR, new_interval_dict[
+        "tsx_bbox"]);  # bounding box vertical
+    East_InSAR = InSAR_1D_Object.utilities.impose_InSAR_bounding_box(East_InSAR, new_interval_dict[
+        "tsx_bbox"]);  # bounding box east
+    Vert_InSAR = Downsample.uniform_downsample.uniform_downsampling(Vert_InSAR,
+                                                                    new_interval_dict[
+                                                                        "tsx_downsample_interval"],
+                                                                    new_interval_dict["tsx_averaging_window"]);
+    East_InSAR = Downsample.uniform_downsample.uniform_downsampling(East_InSAR,
+                                                                    new_interval_dict[
+                                                                        "tsx_downsample_interval"],
+                                                                    new_interval_dict["tsx_averaging_window"]);
+
+    Total_InSAR = InSAR_1D_Object.utilities.combine_objects(Vert_InSAR, East_InSAR);
+    InSAR_1D_Object.outputs.write_insar_invertible_format(Total_InSAR, new_interval_dict["tsx_unc"],
+                                                          config["prep_inputs_dir"] +
+                                                          new_interval_dict["tsx_datafile"]);  # vert+east
+    InSAR_1D_Object.outputs.write_insar_invertible_format(Vert_InSAR, new_interval_dict["tsx_unc"],
+                                                          config["prep_inputs_dir"] +
+                                                          new_interval_dict["tsx_vertical_datafile"]);
+    InSAR_1D_Object.outputs.write_insar_invertible_format(East_InSAR, new_interval_dict["tsx_unc"],
+                                                          config["prep_inputs_dir"] +
+                                                          new_interval_dict["tsx_horiz_datafile"]);
+    InSAR_obj = InSAR_1D_Object.inputs.inputs_txt(config["prep_inputs_dir"] +
+                                                  new_interval_dict["tsx_vertical_datafile"]);
+    InSAR_1D_Object.outputs.plot_insar(InSAR_obj, config["prep_inputs_dir"] +
+                                       new_interval_dict["tsx_vertical_plot"]);
     return;
 
 
@@ -232,31 +263,86 @@ def write_s1_displacements(config):
     if "s1_data" not in config.keys():
         print("\nNo S1 in this inversion");
         return;
-    else:
-        for interval_dict_key in config["s1_data"]:
-            new_interval_dict = config["s1_data"][interval_dict_key];  # for each interval in S1
-            print("\nStarting to extract S1 Cornell/OU-format from %s " % (new_interval_dict["s1_filename"]));
-            InSAR_Data = InSAR_1D_Object.inputs.inputs_cornell_ou_velocities_hdf5(new_interval_dict["s1_filename"],
-                                                                                  new_interval_dict["s1_lkv_filename"],
-                                                                                  new_interval_dict["s1_slicenum"]);
-            InSAR_Data = InSAR_1D_Object.utilities.impose_InSAR_bounding_box(InSAR_Data, new_interval_dict["s1_bbox"]);
-            InSAR_Data = Downsample.uniform_downsample.uniform_downsampling(InSAR_Data,
-                                                                            new_interval_dict["s1_downsample_interval"],
-                                                                            new_interval_dict["s1_averaging_window"]);
-
-            InSAR_1D_Object.outputs.write_insar_invertible_format(InSAR_Data, new_interval_dict["s1_unc"],
-                                                                  config["prep_inputs_dir"] + new_interval_dict[
-                                                                      "s1_datafile"]);
-            InSAR_obj = InSAR_1D_Object.inputs.inputs_txt(config["prep_inputs_dir"] + new_interval_dict["s1_datafile"]);
-            InSAR_1D_Object.outputs.plot_insar(InSAR_obj, config["prep_inputs_dir"] + new_interval_dict["s1_plot"]);
+    for interval_dict_key in config["s1_data"]:
+        write_one_s1_interval(config, interval_dict_key);
+    return;
+
+
+def write_one_s1_interval(config, interval_dict_key, work_dir=None):
+    """One interval of S1. work_dir is unused."""
+    new_interval_dict = config["s1_data"][interval_dict_key];  # for each interval in S1
+    print("\nStarting to extract S1 Cornell/OU-format from %s " % (new_interval_dict["s1_filename"]));
+    InSAR_Data = InSAR_1D_Object.inputs.inputs_cornell_ou_velocities_hdf5(new_interval_dict["s1_filename"],
+                                                                          new_interval_dict["s1_lkv_filename"],
+                                                                          new_interval_dict["s1_slicenum"]);
+    InSAR_Data = InSAR_1D_Object.utilities.impose_InSAR_bounding_box(InSAR_Data, new_interval_dict["s1_bbox"]);
+    InSAR_Data = Downsample.uniform_downsample.uniform_downsampling(InSAR_Data,
+                                                                    new_interval_dict["s1_downsample_interval"],
+                                                                    new_interval_dict["s1_averaging_window"]);
+
+    InSAR_1D_Object.outputs.write_insar_invertible_format(InSAR_Data, new_interval_dict["s1_unc"],
+                                                          config["prep_inputs_dir"] + new_interval_dict[
+                                                              "s1_datafile"]);
+    InSAR_obj = InSAR_1D_Object.inputs.inputs_txt(config["prep_inputs_dir"] + new_interval_dict["s1_datafile"]);
+    InSAR_1D_Object.outputs.plot_insar(InSAR_obj, config["prep_inputs_dir"] + new_interval_dict["s1_plot"]);
+    return;
 
+
+# Each data type: (config key, function for one interval, output file keys that must exist to skip the task)
+PREP_TASK_TYPES = [("uavsar_data", write_one_uavsar_interval, ["uav_textfile"]),
+                   ("leveling_data", write_one_leveling_interval, ["lev_outfile"]),
+                   ("gps_data", write_one_gps_interval, ["gps_textfile"]),
+                   ("tsx_data", write_one_tsx_tre_interval, ["tsx_datafile"]),
+                   ("s1_data", write_one_s1_interval, ["s1_datafile"])];
+
+# Config keys that name input files or directories. Only these are made absolute and hashed as task inputs.
+PREP_INPUT_PATH_KEYS = ["prep_inputs_dir", "gps_data_config_file",
+                        "uav_sourcefile_begin", "uav_sourcefile_end", "uav_sourcefile_unw_geo", "rdrfile",
+                        "leveling_filename", "leveling_errors_filename",
+                        "tsx_filename", "s1_filename", "s1_lkv_filename"];
+
+
+def build_prep_tasks(config):
+    """One independent task for each interval of each data type."""
+    tasks = [];
+    gps_config_files = cache_utilities.collect_referenced_files(config.get("gps_data_config_file"));
+    for data_key, function, output_keys in PREP_TASK_TYPES:
+        if data_key not in config.keys():
+            continue;
+        for interval_dict_key in config[data_key]:
+            interval_dict = config[data_key][interval_dict_key];
+            params = {"interval": interval_dict, "epochs": config.get("epochs"),
+                      "gps_data_config_file": config.get("gps_data_config_file"),
+                      "reference_ll": config.get("reference_ll"), "prep_inputs_dir": config["prep_inputs_dir"]};
+            output_files = [config["prep_inputs_dir"] + interval_dict[key] for key in output_keys];
+            input_files = cache_utilities.collect_input_files([interval_dict[key] for key in PREP_INPUT_PATH_KEYS
+                                                               if key in interval_dict]);
+            if data_key == "gps_data":  # GNSS data are found through the GNSS data config file
+                input_files += gps_config_files;
+            tasks.append(task_runner.Task(name=data_key + "_" + interval_dict_key, function=function,
+                                          args=(config, interval_dict_key), params=params, input_files=input_files,
+                                          output_files=output_files));
+    return tasks;
+
+
+def run_prep_pipeline(config):
+    """
+    Run every interval of every data type as an independent task, in parallel if config["num_workers"] > 1.
+    Tasks whose inputs and config have not changed since the last run are skipped.
+    Exits with a non-zero status if any task failed.
+    """
+    os.makedirs(config["prep_inputs_dir"], exist_ok=True);
+    config = task_runner.make_paths_absolute(config, PREP_INPUT_PATH_KEYS);
+    tasks = build_prep_tasks(config);
+    _, failures = task_runner.run_tasks(tasks, work_root=os.path.join(config["prep_inputs_dir"], "task_workdirs"),
+                                        manifest_file=os.path.join(config["prep_inputs_dir"], "task_manifest.json"),
+                                        num_workers=config.get("num_workers", 1));
+    if failures:
+        print("Error! %d prep task(s) failed: %s" % (len(failures), ", ".join(failures)));
+        sys.exit(1);
     return;
 
 
 if __name__ == "__main__":
     config = welcome_and_parse(sys.argv);
-    write_uavsar_displacements(config);
-    write_leveling_displacements(config);
-    write_gps_displacements(config);
-    write_tsx_tre_displacements(config);
-    write_s1_displacements(config);
+    run_prep_pipeline(config);
@@ -9,44 +9,60 @@ import Elastic_stresses_py.PyCoulomb.fault_slip_triangle as fst
 import Elastic_stresses_py.PyCoulomb.disp_points_object as dpo
 import Elastic_stresses_py.PyCoulomb.fault_slip_object as fso
 import Geodesy_Modeling.src.Inversion.inversion_tools as inv_tools
+import Geodesy_Modeling.src.Inversion.triangle_gf as triangle_gf
+import Geodesy_Modeling.src.Inversion.mesh_smoothing as mesh_smoothing
 import Tectonic_Utilities.Tectonic_Utils.seismo.moment_calculations as mo
 import numpy as np
 import scipy.optimize
 import matplotlib.pyplot as plt
 
 exp_dict = {"smoothing": 5,
+            "smoothing_type": "distance",  # or "mesh_laplacian" for mesh_smoothing, from shared triangle edges
             "obs_disp_points": "ssgf_vectors_manual_m.txt",
-            "fault_file": "../../_Data/Lohman_Fault_Geom/forK.mat"}
+            "fault_file": "../../_Data/Lohman_Fault_Geom/forK.mat",
+            "num_workers": 1,
+            "check_gf_triangles": 3}  # triangles re-computed with triangle_okada to check the batched GFs
 
 def read_gf_elements(exp_dict, obs_disp_pts):
-    GF_elements = [];
+    """
+    Green's functions of the whole triangular mesh at all stations, in one batched computation.
+    Returns GF_elements (one per triangle, for bounds and smoothing) and the TriangleGF array container.
+    """
+    GF_elements, changed_tris = [], [];
     fault_tris = fst.io_other.read_brawley_lohman_2005(exp_dict['fault_file']);
     for tri in fault_tris:
         changed_slip = fst.fault_slip_triangle.change_fault_slip(tri, rtlat=1, dipslip=0, tensile=0);
         changed_slip = fst.fault_slip_triangle.change_reference_loc(changed_slip);
-        model_disp_pts = fst.triangle_okada.compute_disp_points_from_triangles([changed_slip], obs_disp_pts,
-                                                                               poisson_ratio=0.25);
-        GF_elements.append(inv_tools.GF_element(disp_points=model_disp_pts, fault_dict_list=[changed_slip], units='m',
+        changed_tris.append(changed_slip);
+        GF_elements.append(inv_tools.GF_element(disp_points=None, fault_dict_list=[changed_slip], units='m',
                                                 fault_name='kalin', lower_bound=-1, upper_bound=1, points=(),
                                                 slip_penalty=0))
-    return GF_elements;
+    tri_gf = triangle_gf.compute_triangle_gfs(changed_tris, [x.lon for x in obs_disp_pts],
+                                              [x.lat for x in obs_disp_pts], poisson_ratio=0.25,
+                                              num_workers=exp_dict["num_workers"]);
+    return GF_elements, tri_gf;
 
 
 if __name__ == "__main__":
     obs_disp_pts = PyCoulomb.io_additionals.read_disp_points(exp_dict["obs_disp_points"]);
-    GF_elements = read_gf_elements(exp_dict, obs_disp_pts);
+    GF_elements, tri_gf = read_gf_elements(exp_dict, obs_disp_pts);
 
     # COMPUTE STAGE: INVERSE.
-    list_of_gf_columns = [];
-    for gf in GF_elements:
-        G_one_col = inv_tools.buildG_column(gf.disp_points, obs_disp_pts);  # for one fault model parameter
-        list_of_gf_columns.append(G_one_col);
-    G = np.concatenate(tuple(list_of_gf_columns), axis=1);
+    G = triangle_gf.build_G_from_triangle_gfs(tri_gf, obs_disp_pts, slip_components=(0,));  # right-lateral slip
+    if exp_dict["check_gf_triangles"] > 0:
+        triangle_gf.check_against_triangle_okada(tri_gf, obs_disp_pts, G, n_check=exp_dict["check_gf_triangles"]);
     obs, sigmas = inv_tools.build_obs_vector(obs_disp_pts);
     G /= sigmas[:, None];
     weighted_obs = obs / sigmas;
-    G, weighted_obs, sigmas = inv_tools.build_smoothing(GF_elements, ('kalin',), exp_dict["smoothing"], G, weighted_obs,
-                                                        sigmas);
+    if exp_dict["smoothing_type"] == "mesh_laplacian":  # neighbors from shared triangle edges
+        tri_vertices = triangle_gf.get_triangle_vertices(tri_gf.fault_triangles, tri_gf.ref_lon, tri_gf.ref_lat);
+        adjacency = mesh_smoothing.triangle_adjacency(mesh_smoothing.get_vertex_indices(tri_vertices));
+        L = mesh_smoothing.second_order_laplacian(adjacency, centroids=np.mean(tri_vertices, axis=1) / 1000);  # km
+        G, weighted_obs, sigmas = mesh_smoothing.append_smoothing_rows(G, weighted_obs, sigmas, L,
+                                                                       exp_dict["smoothing"]);
+    else:
+        G, weighted_obs, sigmas = inv_tools.build_smoothing(GF_elements, ('kalin',), exp_dict["smoothing"], G,
+                                                            weighted_obs, sigmas);
     plt.imshow(G, vmin=-3, vmax=3); plt.savefig("G_matrix.png");
 
     # Money line: Constrained inversion
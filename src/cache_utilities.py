@@ -0,0 +1,121 @@
+"""
+Content hashing and on-disk caching of intermediate results.
+Used to skip work whose inputs and parameters have not changed since the last run.
+"""
+
+import os
+import re
+import json
+import pickle
+import hashlib
+import tempfile
+
+
+def file_content_hash(filename, chunk_size=2**20):
+    """Hash the contents of a file in chunks, so large files are not read into memory at once."""
+    hasher = hashlib.sha256();
+    with open(filename, 'rb') as ifile:
+        for chunk in iter(lambda: ifile.read(chunk_size), b''):
+            hasher.update(chunk);
+    return hasher.hexdigest();
+
+
+def hash_of_parameters(params):
+    """Hash a json-like structure of parameters (dicts, lists, strings, numbers) independent of key order."""
+    text = json.dumps(params, sort_keys=True, default=str);
+    return hashlib.sha256(text.encode()).hexdigest();
+
+
+def hash_of_object(obj):
+    """Hash any picklable object, such as a namedtuple of arrays."""
+    return hashlib.sha256(pickle.dumps(obj, protocol=4)).hexdigest();
+
+
+def collect_input_files(value):
+    """Recursively collect the strings in a dict/list structure that name existing files."""
+    if isinstance(value, str):
+        return [value] if os.path.isfile(value) else [];
+    if isinstance(value, dict):
+        value = list(value.values());
+    files = [];
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            files += collect_input_files(item);
+    return files;
+
+
+def collect_referenced_files(config_file):
+    """
+    A text config file plus every file it names, for configs that point at data elsewhere (like GNSS data configs).
+    Names may be absolute or relative to the config file. Named data directories contribute all the files inside them.
+    """
+    if not config_file or not os.path.isfile(config_file):
+        return [];
+    files = [config_file];
+    config_dir = os.path.dirname(os.path.abspath(config_file));
+    with open(config_file, 'r') as ifile:
+        tokens = re.split(r'[\s=:,;"\']+', ifile.read());
+    for token in tokens:
+        if not token.strip('.'):   # skip empty tokens, ".", and ".."
+            continue;
+        for candidate in (token, os.path.join(config_dir, token)):
+            if os.path.isfile(candidate):
+                files.append(candidate);
+                break;
+            if os.path.isdir(candidate):
+                directory = os.path.abspath(candidate);
+                if all(os.path.commonpath([directory, x]) != directory for x in (config_dir, os.getcwd())):
+                    files += [os.path.join(root, x) for root, _, names in os.walk(directory) for x in names];
+                break;
+    return files;
+
+
+def combined_hash(params, filenames=()):
+    """One hash for a set of parameters and the contents of a set of input files."""
+    file_hashes = {filename: file_content_hash(filename) for filename in sorted(set(filenames))};
+    return hash_of_parameters({"params": params, "files": file_hashes});
+
+
+def cached_object_filename(cache_dir, name, key):
+    return os.path.join(cache_dir, name + "_" + key[0:16] + ".pkl");
+
+
+def read_cached_object(cache_dir, name, key):
+    """
+    :returns: True and the cached object if a result exists for this name and key, else False and None
+    """
+    filename = cached_object_filename(cache_dir, name, key);
+    if not os.path.isfile(filename):
+        return False, None;
+    with open(filename, 'rb') as ifile:
+        obj = pickle.load(ifile);
+    return True, obj;
+
+
+def write_cached_object(cache_dir, name, key, obj):
+    """
+    Write an object into the cache atomically, so an interrupted run never leaves a partial file.
+    Each writer uses its own temporary file, so parallel tasks caching the same key cannot interleave their writes;
+    the last os.replace wins, and every version it could publish is complete.
+    """
+    os.makedirs(cache_dir, exist_ok=True);
+    filename = cached_object_filename(cache_dir, name, key);
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as ofile:
+        pickle.dump(obj, ofile, protocol=4);
+    os.replace(ofile.name, filename);
+    return;
+
+
+def read_manifest(manifest_file):
+    """Read a json dictionary of {name: hash} from the last run. Empty if there was no last run."""
+    if not os.path.isfile(manifest_file):
+        return {};
+    with open(manifest_file, 'r') as ifile:
+        return json.load(ifile);
+
+
+def write_manifest(manifest, manifest_file):
+    with open(manifest_file + ".tmp", 'w') as ofile:
+        json.dump(manifest, ofile, indent=2, sort_keys=True);
+    os.replace(manifest_file + ".tmp", manifest_file);
+    return;
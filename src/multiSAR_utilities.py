@@ -3,6 +3,7 @@ Some useful functions for comparing pixels across object types
 """
 
 import numpy as np
+from scipy import spatial, sparse
 from Tectonic_Utils.geodesy import haversine
 
 
@@ -28,6 +29,35 @@ def get_nearest_pixel_in_raster(raster_lon, raster_lat, target_lon, target_lat):
     return i_found, j_found, minimum_distance;
 
 
+def get_nearest_pixels_in_raster(raster_lon, raster_lat, target_lons, target_lats, cutoff_km=0.25):
+    """Take a raster (2d arrays with lat and lon) and find the grid locations closest to many targets at once.
+    The raster is indexed once with a KD-tree on unit-sphere coordinates, so nearest means great-circle nearest.
+
+    :param raster_lon: 2d array of longitudes
+    :param raster_lat: 2d array of latitudes
+    :param target_lons: list or array of target longitudes
+    :param target_lats: list or array of target latitudes
+    :param cutoff_km: float, targets farther than this from any pixel are outside the domain
+    :returns: rows, cols (int arrays, -1 for targets outside the domain), distances in km
+    """
+    raster_lon, raster_lat = np.asarray(raster_lon, dtype=float), np.asarray(raster_lat, dtype=float);
+    good_pixels = np.flatnonzero(~np.isnan(raster_lon.ravel()) & ~np.isnan(raster_lat.ravel()));
+    tree = spatial.cKDTree(lonlat_to_unit_xyz(raster_lon.ravel()[good_pixels], raster_lat.ravel()[good_pixels]));
+    chord, nearest = tree.query(lonlat_to_unit_xyz(np.asarray(target_lons, dtype=float),
+                                                   np.asarray(target_lats, dtype=float)));
+    distances = 2 * 6371.0 * np.arcsin(np.minimum(chord / 2, 1));  # chord length to km along the surface
+    rows, cols = np.unravel_index(good_pixels[nearest], np.shape(raster_lon));
+    outside = distances >= cutoff_km;
+    rows, cols = np.where(outside, -1, rows), np.where(outside, -1, cols);
+    return rows, cols, distances;
+
+
+def lonlat_to_unit_xyz(lon, lat):
+    """Convert arrays of lon/lat in degrees into an (n, 3) array of points on the unit sphere."""
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat);
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)));
+
+
 def get_nearest_pixel_in_vector(vector_lon, vector_lat, target_lon, target_lat):
     """Take a vector and find the location closest to the target location.
     Fast function because of numpy math"""
@@ -62,6 +92,75 @@ def find_pixels_idxs_in_InSAR_Obj(InSAR_Data, target_lons, target_lats):
     return closest_index, close_indices;
 
 
+def get_close_pixel_operator(vector_lon, vector_lat, target_lons, target_lats, close_radius=0.0009,
+                             max_distance=0.003, tree=None):
+    """
+    Batch version of find_pixels_idxs_in_InSAR_Obj, built on one KD-tree of the pixels (distances in degrees).
+    Returns a sparse (n_targets x n_pixels) matrix with 1 where a pixel is within close_radius of a target,
+    used with close_pixel_means to average many data vectors at once. Pixels with nan lon/lat are never close.
+
+    :param vector_lon: 1D array of pixel longitudes
+    :param vector_lat: 1D array of pixel latitudes
+    :param target_lons: list or array of target longitudes
+    :param target_lats: list or array of target latitudes
+    :param close_radius: float, degrees. Pixels this close to a target are averaged.
+    :param max_distance: float, degrees. Targets farther than this from the nearest pixel are outside the domain.
+    :param tree: optional cKDTree returned by an earlier call on the same pixels, to reuse across calls
+    :returns: sparse operator, boolean array of targets inside the domain, the tree (built on the finite pixels)
+    """
+    vector_lon, vector_lat = np.asarray(vector_lon, dtype=float), np.asarray(vector_lat, dtype=float);
+    good_pixels = np.flatnonzero(np.isfinite(vector_lon) & np.isfinite(vector_lat));
+    if tree is None:
+        tree = spatial.cKDTree(np.column_stack((vector_lon[good_pixels], vector_lat[good_pixels])));
+    elif tree.n != len(good_pixels):
+        raise ValueError("Error! The tree was not built on the finite pixels of this raster.");
+    targets = np.column_stack((np.asarray(target_lons, dtype=float), np.asarray(target_lats, dtype=float)));
+    if tree.n == 0:
+        return sparse.csr_matrix((len(targets), len(vector_lon))), np.zeros(len(targets), dtype=bool), tree;
+    nearest_distance, _ = tree.query(targets);
+    inside = nearest_distance < max_distance;
+    neighbors = tree.query_ball_point(targets, close_radius);
+    rows = np.repeat(np.arange(len(targets)), [len(x) for x in neighbors]);
+    cols = good_pixels[np.array([j for x in neighbors for j in x], dtype=int)];  # back to indices of all pixels
+    operator = sparse.csr_matrix((np.ones(len(cols)), (rows, cols)), shape=(len(targets), len(vector_lon)));
+    return operator, inside, tree;
+
+
+def close_pixel_means(operator, values):
+    """
+    Nan-mean of the close pixels around each target, for one data vector (n_pixels)
+    or many data vectors at once (n_pixels x k). Targets without any valid close pixels get nan.
+    """
+    values = np.asarray(values, dtype=float);
+    valid = ~np.isnan(values);
+    sums = operator @ np.where(valid, values, 0);
+    counts = operator @ valid.astype(float);
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan);
+
+
+def compute_difference_metrics_batch(array1, array2):
+    """
+    Vectorized compute_difference_metrics_on_same_pixels for many comparisons at once.
+    Each row is one comparison; pixels where either array is nan are left out of that row.
+
+    :param array1: 2D array (n_comparisons x n_pixels), LOS data from platform 1 (like Leveling)
+    :param array2: matching 2D array, LOS data from platform 2 (like UAVSAR)
+    :returns: array of average misfit values, array of r^2 coefficients
+    """
+    array1, array2 = np.atleast_2d(array1), np.atleast_2d(array2);
+    valid = ~np.isnan(array1) & ~np.isnan(array2);
+    n = np.sum(valid, axis=1);
+    a, b = np.where(valid, array1, 0), np.where(valid, array2, 0);
+    with np.errstate(invalid='ignore', divide='ignore'):
+        misfit_metric = np.sum(np.abs(a - b), axis=1) / n;  # average deviation from 1-to-1
+        da = np.where(valid, a - (np.sum(a, axis=1) / n)[:, np.newaxis], 0);
+        db = np.where(valid, b - (np.sum(b, axis=1) / n)[:, np.newaxis], 0);
+        corr = np.sum(da * db, axis=1) / np.sqrt(np.sum(da ** 2, axis=1) * np.sum(db ** 2, axis=1));
+    r2 = corr ** 2;
+    return misfit_metric, r2;
+
+
 def compute_difference_metrics_on_same_pixels(list1, list2):
     """
     :param list1: a list of LOS data from platform 1 (like Leveling)
@@ -0,0 +1,70 @@
+"""
+A small pipeline of cached stages.
+Each stage declares the files it reads, the config keys it uses, the stages upstream of it, and the files it writes.
+A stage's result is pickled on disk under a key that hashes its input file contents, its config values,
+and the keys of its upstream stages. On the next run, a stage only re-runs if that key changed
+or its output files are missing, and cached upstream results are only loaded when a re-running stage needs them.
+"""
+
+import os
+import collections
+from . import cache_utilities
+
+# function: called as function(config, upstream_results), where upstream_results is {stage name: result}
+# inputs: function of config that returns a list of input filenames, or None
+# config_keys: list of config keys whose values affect this stage
+# upstream: list of names of earlier stages whose results this stage uses
+# outputs: function of config that returns a list of filenames that must exist to reuse the cache, or None
+Stage = collections.namedtuple('Stage', ['name', 'function', 'inputs', 'config_keys', 'upstream', 'outputs']);
+
+
+def get_stage_keys(stages, config):
+    """Compute the cache key of every stage, in order. Upstream keys feed into downstream keys."""
+    keys = {};
+    for stage in stages:
+        input_files = stage.inputs(config) if stage.inputs is not None else [];
+        params = {"name": stage.name,
+                  "config": {key: config.get(key) for key in stage.config_keys},
+                  "upstream": [keys[name] for name in stage.upstream]};
+        keys[stage.name] = cache_utilities.combined_hash(params, input_files);
+    return keys;
+
+
+def run_pipeline(stages, config, cache_dir, force=()):
+    """
+    Run a list of stages (in dependency order), reusing cached results where nothing has changed.
+
+    :param stages: list of Stage
+    :param config: dictionary of parameters
+    :param cache_dir: string, directory for the pickled stage results
+    :param force: names of stages to re-run regardless of the cache
+    :returns: dictionary of {stage name: result} for every stage that was run or loaded
+    """
+    stage_dict = {stage.name: stage for stage in stages};
+    keys = get_stage_keys(stages, config);
+    results = {};
+
+    def get_result(name):
+        if name in results:
+            return results[name];
+        stage = stage_dict[name];
+        outputs = stage.outputs(config) if stage.outputs is not None else [];
+        found, result = False, None;
+        if name not in force and all(os.path.isfile(x) for x in outputs):
+            found, result = cache_utilities.read_cached_object(cache_dir, name, keys[name]);
+        if found:
+            print("Stage %s: unchanged, using cached result" % name);
+        else:
+            upstream_results = {upstream_name: get_result(upstream_name) for upstream_name in stage.upstream};
+            print("Stage %s: running" % name);
+            result = stage.function(config, upstream_results);
+            cache_utilities.write_cached_object(cache_dir, name, keys[name], result);
+        results[name] = result;
+        return result;
+
+    # Only the final stages are requested directly. Their upstream stages are loaded or run on demand.
+    used_upstream = set(name for stage in stages for name in stage.upstream);
+    for stage in stages:
+        if stage.name not in used_upstream:
+            get_result(stage.name);
+    return results;
@@ -0,0 +1,104 @@
+"""
+Run independent tasks (like one data type and one interval of a prep pipeline) in a process pool.
+Each task runs in its own working directory, reports its wall time,
+and is skipped if its inputs and parameters hash the same as the last successful run.
+"""
+
+import os
+import time
+import collections
+import concurrent.futures
+from . import cache_utilities
+
+# Task functions are called as function(*args, work_dir=work_dir).
+# params and input_files define the task's hash. output_files must exist for a task to be skipped.
+Task = collections.namedtuple('Task', ['name', 'function', 'args', 'params', 'input_files', 'output_files']);
+
+
+def get_task_hash(task):
+    return cache_utilities.combined_hash({"name": task.name, "params": task.params}, task.input_files);
+
+
+def make_paths_absolute(value, path_keys):
+    """Recursively replace the strings stored under path_keys that name existing files or directories with
+    absolute paths, so tasks still find them after changing into their own working directories.
+    Only the named keys are touched: output names that happen to exist from a previous run are left alone."""
+    if isinstance(value, dict):
+        return {key: _absolute_path(item) if key in path_keys else make_paths_absolute(item, path_keys)
+                for key, item in value.items()};
+    if isinstance(value, list):
+        return [make_paths_absolute(item, path_keys) for item in value];
+    return value;
+
+
+def _absolute_path(value):
+    if isinstance(value, str) and value and os.path.exists(value) and not os.path.isabs(value):
+        trailing = os.sep if value.endswith(os.sep) else '';
+        return os.path.abspath(value) + trailing;
+    return value;
+
+
+def run_one_task(task, work_dir):
+    """Run a task inside its own working directory. Returns the task name and its wall time in seconds."""
+    os.makedirs(work_dir, exist_ok=True);
+    original_dir = os.getcwd();
+    start = time.time();
+    os.chdir(work_dir);
+    try:
+        task.function(*task.args, work_dir=work_dir);
+    finally:
+        os.chdir(original_dir);
+    return task.name, time.time() - start;
+
+
+def run_tasks(tasks, work_root, manifest_file, num_workers=1):
+    """
+    Run a list of independent tasks, skipping the ones that are unchanged since the last successful run.
+
+    :param tasks: list of Task
+    :param work_root: string, directory under which each task gets its own working directory
+    :param manifest_file: string, json file recording the hash of each task's last successful run
+    :param num_workers: int, number of processes. With 1, tasks run one after another in this process.
+    :returns: dictionary of {task name: wall time in seconds} for tasks that ran, and a list of failed task names
+    """
+    manifest = cache_utilities.read_manifest(manifest_file);
+    task_hashes = {task.name: get_task_hash(task) for task in tasks};
+    to_run = [];
+    for task in tasks:
+        outputs_exist = all(os.path.isfile(x) for x in task.output_files);
+        if manifest.get(task.name) == task_hashes[task.name] and outputs_exist:
+            print("Skipping task %s: inputs and config unchanged since last run" % task.name);
+        else:
+            to_run.append(task);
+
+    timings, failures = {}, [];
+
+    def record_success(name, elapsed):
+        timings[name] = elapsed;
+        manifest[name] = task_hashes[name];
+        cache_utilities.write_manifest(manifest, manifest_file);  # written after every task, in case of crashes
+
+    if num_workers > 1 and len(to_run) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(run_one_task, task, os.path.join(work_root, task.name)): task.name
+                       for task in to_run};
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    record_success(*future.result());
+                except Exception as e:
+                    print("Task %s failed: %s" % (futures[future], e));
+                    failures.append(futures[future]);
+    else:
+        for task in to_run:
+            try:
+                record_success(*run_one_task(task, os.path.join(work_root, task.name)));
+            except Exception as e:
+                print("Task %s failed: %s" % (task.name, e));
+                failures.append(task.name);
+
+    print("\nTask timing summary:");
+    for name in sorted(timings.keys()):
+        print("   %-40s %8.1f s" % (name, timings[name]));
+    for name in failures:
+        print("   %-40s   FAILED" % name);
+    return timings, failures;